@@ -0,0 +1,518 @@
+# -*- coding: utf-8 -*-
+"""
+plaid - plaid looks at integrated data
+F.H. Gjørup 2025-2026
+Aarhus University, Denmark
+MAX IV Laboratory, Lund University, Sweden
+
+This module provides functions for the analysis of stacks of diffraction patterns,
+including out-of-core decomposition of the stack into component patterns,
+tiled computation of frame-frame and lagged correlation matrices, clustering
+of the frames and detection of change points along the frame axis.
+The stack is accessed through a get_chunk(i, j) callable returning the frames i:j,
+so only a chunk of frames is held in memory at a time.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+def _get_chunk_bounds(n, m, chunk_bytes=2**26):
+    """Get the (start, stop) frame indices of the chunks of a stack of n frames with m bins."""
+    chunk_size = max(1, chunk_bytes // (8 * max(1, m)))
+    return [(i, min(i + chunk_size, n)) for i in range(0, n, chunk_size)]
+
+def randomized_pca(get_chunk, shape, n_components=5, n_oversamples=10, n_iter=2, chunk_bytes=2**26,
+                   seed=None, progress=None):
+    """
+    Principal component analysis of a stack of patterns by randomized SVD of the
+    mean-centred stack (Halko et al., 2011), reading the stack chunk by chunk.
+    The stack is read 3 + 2*n_iter times and only arrays of shape
+    (frames, n_components + n_oversamples) are held in memory besides a chunk.
+
+    Parameters
+    ----------
+    get_chunk : callable
+        get_chunk(i, j) returning the frames i:j of the stack, shape (j-i, bins).
+    shape : tuple
+        Shape of the stack (frames, bins).
+    n_components : int
+        Number of components.
+    n_oversamples : int
+        Number of additional random vectors used to improve the accuracy.
+    n_iter : int
+        Number of power iterations used to improve the accuracy.
+    chunk_bytes : int
+        Approximate size of the chunks of the stack (as float64).
+    seed : int or None
+        Seed of the random number generator.
+    progress : callable or None
+        progress(fraction) called with the completed fraction of the passes over
+        the stack, returning False to cancel the decomposition.
+
+    Returns
+    -------
+    tuple or None
+        (mean, components, scores, explained_variance_ratio), where the stack is
+        approximated by mean + scores @ components. The scores have unit root mean
+        square, so the components have the units of the stack. None if cancelled.
+    """
+    n, m = shape
+    n_vectors = min(n_components + n_oversamples, n, m)
+    n_components = min(n_components, n_vectors)
+    bounds = _get_chunk_bounds(n, m, chunk_bytes)
+    n_passes = 3 + 2 * n_iter
+    passes = iter(range(n_passes + 1))
+
+    def advance():
+        return progress is None or progress(next(passes) / n_passes) is not False
+
+    # mean and total sum of squares
+    if not advance():
+        return None
+    mean, sum_sq = np.zeros(m), 0.
+    for i, j in bounds:
+        A = np.asarray(get_chunk(i, j), dtype=np.float64)
+        mean += A.sum(axis=0)
+        sum_sq += np.sum(A**2)
+    mean /= n
+    total_var = max(sum_sq - n * np.sum(mean**2), np.finfo(float).tiny)
+
+    # range finder Y = (A - mean) @ Omega, refined by power iterations
+    rng = np.random.default_rng(seed)
+    Z = rng.standard_normal((m, n_vectors))
+    for it in range(n_iter + 1):
+        if not advance():
+            return None
+        Y = np.empty((n, n_vectors))
+        for i, j in bounds:
+            Y[i:j] = (np.asarray(get_chunk(i, j), dtype=np.float64) - mean) @ Z
+        Q, _ = np.linalg.qr(Y)
+        if it == n_iter:
+            break
+        if not advance():
+            return None
+        Z = np.zeros((m, n_vectors))
+        for i, j in bounds:
+            Z += (np.asarray(get_chunk(i, j), dtype=np.float64) - mean).T @ Q[i:j]
+        Z, _ = np.linalg.qr(Z)
+
+    # project the stack onto the range, B = Q.T @ (A - mean), and decompose B
+    if not advance():
+        return None
+    B = np.zeros((n_vectors, m))
+    for i, j in bounds:
+        B += Q[i:j].T @ (np.asarray(get_chunk(i, j), dtype=np.float64) - mean)
+    U, s, Vt = np.linalg.svd(B, full_matrices=False)
+    U = Q @ U[:, :n_components]
+    s, Vt = s[:n_components], Vt[:n_components]
+    # fix the sign of each component so that its sum is positive
+    sign = np.where(Vt.sum(axis=1) < 0, -1., 1.)
+    components = Vt * (sign * s / np.sqrt(n))[:, None]
+    scores = U * (sign * np.sqrt(n))
+    if progress is not None:
+        progress(1.)
+    return mean, components, scores, s**2 / total_var
+
+def nmf(get_chunk, shape, n_components=5, n_iter=100, chunk_bytes=2**26, seed=None, progress=None):
+    """
+    Non-negative matrix factorization of a stack of patterns by multiplicative
+    updates (Lee & Seung, 2001), reading the stack chunk by chunk. Each iteration
+    updates the scores of a chunk and accumulates the sums needed to update the
+    components in a single pass over the stack. Negative values are set to zero.
+
+    Parameters
+    ----------
+    get_chunk : callable
+        get_chunk(i, j) returning the frames i:j of the stack, shape (j-i, bins).
+    shape : tuple
+        Shape of the stack (frames, bins).
+    n_components : int
+        Number of components.
+    n_iter : int
+        Number of iterations (passes over the stack).
+    chunk_bytes : int
+        Approximate size of the chunks of the stack (as float64).
+    seed : int or None
+        Seed of the random number generator.
+    progress : callable or None
+        progress(fraction) called with the completed fraction of the passes over
+        the stack, returning False to cancel the decomposition.
+
+    Returns
+    -------
+    tuple or None
+        (components, scores), where the stack is approximated by scores @ components.
+        The scores are scaled to a mean of one, so the components are the average
+        contributions to the stack. None if cancelled.
+    """
+    n, m = shape
+    bounds = _get_chunk_bounds(n, m, chunk_bytes)
+    eps = np.finfo(np.float64).eps
+
+    # initialize with random factors matching the mean of the stack
+    mean = sum(np.clip(np.asarray(get_chunk(i, j), dtype=np.float64), 0, None).sum() for i, j in bounds) / (n * m)
+    rng = np.random.default_rng(seed)
+    scale = np.sqrt(max(mean, eps) / n_components)
+    W = rng.random((n, n_components)) * scale
+    H = rng.random((n_components, m)) * scale
+
+    for it in range(n_iter):
+        if progress is not None and progress(it / n_iter) is False:
+            return None
+        HHt = H @ H.T
+        WtA, WtW = np.zeros((n_components, m)), np.zeros((n_components, n_components))
+        for i, j in bounds:
+            A = np.clip(np.asarray(get_chunk(i, j), dtype=np.float64), 0, None)
+            W[i:j] *= (A @ H.T) / (W[i:j] @ HHt + eps)
+            WtA += W[i:j].T @ A
+            WtW += W[i:j].T @ W[i:j]
+        H *= WtA / (WtW @ H + eps)
+    # scale the scores to a mean of one
+    w = W.mean(axis=0)
+    w[w <= 0] = 1.
+    if progress is not None:
+        progress(1.)
+    return H * w[:, None], W / w
+
+def decompose_stack(I, method="pca", n_components=5, frame_mask=None, fill=None, progress=None, **kwargs):
+    """
+    Decompose the stack I (frames, bins) into n_components component patterns and
+    their per-frame weights by randomized PCA ('pca') or NMF ('nmf'), reading it
+    chunk by chunk. Masked frames (frame_mask False) are replaced by the fill
+    pattern, e.g. the average pattern, and get NaN weights.
+    kwargs are passed to the decomposition function. progress is an optional
+    callable progress(fraction), returning False to cancel.
+    Returns (components, scores, params), or None if cancelled.
+    """
+    def get_chunk(i, j):
+        chunk = I[i:j]
+        if frame_mask is not None and not frame_mask[i:j].all():
+            chunk = np.array(chunk)
+            chunk[~frame_mask[i:j]] = fill
+        return chunk
+
+    if method == "pca":
+        result = randomized_pca(get_chunk, I.shape, n_components, progress=progress, **kwargs)
+        if result is None:
+            return None
+        _, components, scores, explained_variance_ratio = result
+        params = {"explained_variance_ratio": explained_variance_ratio}
+    elif method == "nmf":
+        result = nmf(get_chunk, I.shape, n_components, progress=progress, **kwargs)
+        if result is None:
+            return None
+        components, scores = result
+        params = {}
+    else:
+        raise ValueError(f"Unknown decomposition method '{method}', expected 'pca' or 'nmf'.")
+    if frame_mask is not None:
+        scores[~frame_mask] = np.nan
+    params = {"method": method, "n_components": len(components), **kwargs, **params}
+    return components, scores, params
+
+def standardize_frames(I, centered=True, chunk_bytes=2**26):
+    """
+    Scale each frame of the stack I (frames, bins) to unit norm, after subtracting
+    its mean if centered is True, chunk by chunk. The dot product of two
+    standardized frames is their Pearson correlation (centered) or cosine similarity.
+    Returns a float32 array.
+    """
+    Z = np.empty(I.shape, dtype=np.float32)
+    chunk_size = max(1, chunk_bytes // (4 * max(1, I.shape[1])))
+    for i in range(0, I.shape[0], chunk_size):
+        z = I[i:i+chunk_size].astype(np.float32)
+        if centered:
+            z -= z.mean(axis=1, keepdims=True)
+        norm = np.linalg.norm(z, axis=1, keepdims=True)
+        Z[i:i+chunk_size] = z / np.where(norm > 0, norm, 1)
+    return Z
+
+def binned_correlation(Z, factor=1, frame_mask=None, chunk_bytes=2**26):
+    """
+    Get the frame-frame correlation matrix of the standardized stack Z (see
+    standardize_frames) averaged over blocks of factor x factor frames. As the
+    average of the dot products of two groups of frames equals the dot product of
+    their average frames, the binned matrix is computed exactly from the block
+    averages of Z, i.e. at the cost of a (frames/factor)**2 matrix.
+    Masked frames (frame_mask False) are excluded from the averages, and blocks
+    without valid frames are NaN.
+    Returns a float32 array of shape (ceil(frames/factor),)*2.
+    """
+    n, m = Z.shape
+    factor = max(int(factor), 1)
+    weights = np.ones(n, dtype=np.float32) if frame_mask is None else np.asarray(frame_mask, dtype=np.float32)
+    n_bins = -(-n // factor)
+    Zb = np.zeros((n_bins, m), dtype=np.float32)
+    counts = np.zeros(n_bins, dtype=np.float32)
+    # process whole blocks of frames at a time
+    chunk_size = max(1, chunk_bytes // (4 * max(1, m) * factor)) * factor
+    for i in range(0, n, chunk_size):
+        j = min(i + chunk_size, n)
+        starts = np.arange(0, j - i, factor)
+        Zb[i//factor:i//factor+len(starts)] = np.add.reduceat(Z[i:j] * weights[i:j, None], starts, axis=0)
+        counts[i//factor:i//factor+len(starts)] = np.add.reduceat(weights[i:j], starts)
+    Zb /= np.where(counts > 0, counts, 1)[:, None]
+    im = Zb @ Zb.T
+    im[counts == 0, :] = np.nan
+    im[:, counts == 0] = np.nan
+    return im
+
+def correlation_tile(Z, rows, cols, frame_mask=None, tile_size=1024, max_workers=None):
+    """
+    Get a full-resolution tile of the frame-frame correlation matrix of the
+    standardized stack Z (see standardize_frames), i.e. Z[rows] @ Z[cols].T,
+    computed as float32 matrix products of tile_size x tile_size blocks in a
+    thread pool. If rows equals cols, only the upper triangle of blocks is
+    computed. Masked frames (frame_mask False) are NaN.
+
+    Parameters
+    ----------
+    Z : np.ndarray
+        Standardized stack, shape (frames, bins).
+    rows, cols : slice
+        The frames of the rows and columns of the tile.
+    frame_mask : np.ndarray or None
+        Boolean mask of the valid frames.
+    tile_size : int
+        Number of frames of the blocks computed by each task.
+    max_workers : int or None
+        Maximum number of threads (see concurrent.futures.ThreadPoolExecutor).
+
+    Returns
+    -------
+    np.ndarray
+        The correlation tile, float32.
+    """
+    rows = range(*rows.indices(Z.shape[0]))
+    cols = range(*cols.indices(Z.shape[0]))
+    out = np.empty((len(rows), len(cols)), dtype=np.float32)
+    symmetric = rows == cols
+    Zr, Zc = Z[rows.start:rows.stop:rows.step], Z[cols.start:cols.stop:cols.step]
+
+    def compute(a, c):
+        block = Zr[a:a+tile_size] @ Zc[c:c+tile_size].T
+        out[a:a+tile_size, c:c+tile_size] = block
+        if symmetric and a != c:
+            out[c:c+tile_size, a:a+tile_size] = block.T
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(compute, a, c)
+                   for a in range(0, len(rows), tile_size)
+                   for c in range(a if symmetric else 0, len(cols), tile_size)]
+        for future in futures:
+            future.result()
+    if frame_mask is not None:
+        frame_mask = np.asarray(frame_mask)
+        out[~frame_mask[rows.start:rows.stop:rows.step], :] = np.nan
+        out[:, ~frame_mask[cols.start:cols.stop:cols.step]] = np.nan
+    return out
+
+def lagged_correlation(Z, max_lag=50, frame_mask=None):
+    """
+    Get the correlation of each frame of the standardized stack Z (see
+    standardize_frames) with the frames 1 to max_lag frames later, i.e. the
+    (frames, max_lag) matrix of the row-wise dot products Z[i] . Z[i+lag],
+    computed as one vectorized product per lag. Entries beyond the last frame or
+    involving masked frames (frame_mask False) are NaN.
+    """
+    n = Z.shape[0]
+    out = np.full((n, max_lag), np.nan, dtype=np.float32)
+    for lag in range(1, min(max_lag, n-1) + 1):
+        out[:-lag, lag-1] = np.einsum('ij,ij->i', Z[:-lag], Z[lag:])
+        if frame_mask is not None:
+            out[:-lag, lag-1][~(frame_mask[:-lag] & frame_mask[lag:])] = np.nan
+    return out
+
+def kmeans(X, n_clusters=3, n_iter=100, tol=1e-6, seed=None, chunk_size=65536, progress=None):
+    """
+    Cluster the rows of X (samples, features) by k-means (Lloyd's algorithm with
+    k-means++ initialization). The distances are computed chunk by chunk, so the
+    time and memory scale linearly with the number of samples.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        Samples, e.g. the component scores of the frames, shape (samples, features).
+    n_clusters : int
+        Number of clusters.
+    n_iter : int
+        Maximum number of iterations.
+    tol : float
+        Stop when the centers move less than tol relative to the spread of X.
+    seed : int or None
+        Seed of the random number generator.
+    chunk_size : int
+        Number of samples processed at a time.
+    progress : callable or None
+        progress(fraction) called with the completed fraction of the iterations,
+        returning False to cancel the clustering.
+
+    Returns
+    -------
+    tuple or None
+        (labels, centers), None if cancelled.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    n = X.shape[0]
+    n_clusters = max(1, min(n_clusters, n))
+    rng = np.random.default_rng(seed)
+
+    def assign(centers):
+        labels = np.empty(n, dtype=int)
+        d2 = np.empty(n)
+        c2 = np.sum(centers**2, axis=1)
+        for i in range(0, n, chunk_size):
+            x = X[i:i+chunk_size]
+            d = c2 - 2 * x @ centers.T  # squared distances up to the constant |x|**2
+            labels[i:i+chunk_size] = np.argmin(d, axis=1)
+            d2[i:i+chunk_size] = np.maximum(d[np.arange(len(x)), labels[i:i+chunk_size]] + np.sum(x**2, axis=1), 0)
+        return labels, d2
+
+    # k-means++ initialization, sampling new centers proportional to the squared distance
+    centers = X[[rng.integers(n)]]
+    d2 = np.sum((X - centers[0])**2, axis=1)
+    for _ in range(1, n_clusters):
+        p = d2 / d2.sum() if d2.sum() > 0 else None
+        centers = np.vstack((centers, X[rng.choice(n, p=p)]))
+        d2 = np.minimum(d2, np.sum((X - centers[-1])**2, axis=1))
+
+    scale = max(np.sqrt(np.mean(np.var(X, axis=0))), np.finfo(float).tiny)
+    for it in range(n_iter):
+        if progress is not None and progress(it / n_iter) is False:
+            return None
+        labels, d2 = assign(centers)
+        counts = np.bincount(labels, minlength=n_clusters)
+        sums = np.stack([np.bincount(labels, weights=x, minlength=n_clusters) for x in X.T], axis=1)
+        new_centers = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+        # re-seed empty clusters at the samples furthest from their center
+        for c in np.flatnonzero(counts == 0):
+            new_centers[c] = X[np.argmax(d2)]
+            d2[np.argmax(d2)] = 0
+        shift = np.max(np.linalg.norm(new_centers - centers, axis=1))
+        centers = new_centers
+        if shift <= tol * scale:
+            break
+    labels, _ = assign(centers)
+    if progress is not None:
+        progress(1.)
+    return labels, centers
+
+def cluster_means(get_chunk, shape, labels, n_clusters, chunk_bytes=2**26):
+    """
+    Get the mean pattern of the frames of each cluster, reading the stack chunk by
+    chunk. Frames with negative labels are ignored, and empty clusters are NaN.
+    Returns an array of shape (n_clusters, bins).
+    """
+    n, m = shape
+    sums = np.zeros((n_clusters, m))
+    counts = np.bincount(labels[labels >= 0], minlength=n_clusters)
+    for i, j in _get_chunk_bounds(n, m, chunk_bytes):
+        valid = labels[i:j] >= 0
+        A = np.asarray(get_chunk(i, j), dtype=np.float64)[valid]
+        # sum the frames of each cluster as a product with the one-hot label matrix
+        one_hot = labels[i:j][valid] == np.arange(n_clusters)[:, None]
+        sums += one_hot @ A
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts[:, None]
+
+def cluster_frames(I, n_clusters=3, n_components=5, scores=None, frame_mask=None, seed=None, progress=None):
+    """
+    Cluster the frames of the stack I (frames, bins) by k-means on their principal
+    component scores (see randomized_pca and kmeans), and compute the mean pattern
+    of each cluster. If scores is provided, e.g. from a previous decomposition, the
+    PCA is skipped. Masked frames (frame_mask False) or frames with non-finite
+    scores are not clustered and get the label -1.
+    progress is an optional callable progress(fraction), returning False to cancel.
+    Returns (labels, means), or None if cancelled.
+    """
+    n = I.shape[0]
+    valid = np.ones(n, dtype=bool) if frame_mask is None else np.asarray(frame_mask, dtype=bool).copy()
+    if scores is None:
+        # fit the PCA to the valid frames only
+        frames = np.flatnonzero(valid)
+        def get_chunk(i, j):
+            return I[i:j] if frame_mask is None else I[frames[i:j]]
+        def pca_progress(fraction):
+            return progress is None or progress(0.6 * fraction) is not False
+        result = randomized_pca(get_chunk, (len(frames), I.shape[1]), n_components, seed=seed, progress=pca_progress)
+        if result is None:
+            return None
+        scores = np.full((n, result[2].shape[1]), np.nan)
+        scores[frames] = result[2]
+    valid &= np.all(np.isfinite(scores), axis=1)
+    def kmeans_progress(fraction):
+        return progress is None or progress(0.6 + 0.3 * fraction) is not False
+    result = kmeans(scores[valid], n_clusters, seed=seed, progress=kmeans_progress)
+    if result is None:
+        return None
+    labels = np.full(n, -1, dtype=int)
+    labels[valid] = result[0]
+    means = cluster_means(lambda i, j: I[i:j], I.shape, labels, n_clusters)
+    if progress is not None:
+        progress(1.)
+    return labels, means
+
+def _best_split(S, a, b, min_size):
+    """
+    Get the best split point of the segment a:b of a signal from its cumulative sum
+    S (frames+1, d), and the reduction of the squared error cost by splitting there.
+    Returns (gain, t), or (0, None) if the segment is too short to be split.
+    """
+    t = np.arange(a + min_size, b - min_size + 1)
+    if t.size == 0:
+        return 0., None
+    s_left = S[t] - S[a]
+    s_right = S[b] - S[t]
+    s_all = S[b] - S[a]
+    # cost(a,b) - cost(a,t) - cost(t,b), the sums of squares cancel
+    gain = (np.sum(s_left**2, axis=1) / (t - a) + np.sum(s_right**2, axis=1) / (b - t)
+            - np.sum(s_all**2) / (b - a))
+    i = np.argmax(gain)
+    return float(gain[i]), int(t[i])
+
+def detect_change_points(X, n_change_points=None, penalty=None, min_size=2, max_change_points=50):
+    """
+    Detect change points of the mean of the signal X (frames,) or (frames, d), e.g. roi
+    integrals or component scores, by greedy binary segmentation with a squared error
+    cost. Each column is scaled by its noise level, estimated from the median absolute
+    frame-to-frame difference, and the cost of every split point of a segment is
+    evaluated at once from a cumulative sum, so the runtime scales linearly with the
+    number of frames. Frames with non-finite values are ignored.
+    If n_change_points is None, segments are split (up to max_change_points) while the
+    cost reduction exceeds the penalty, by default a BIC-like 2*(d+1)*log(frames).
+    Returns (indices, gains), the indices of the first frame after each change point
+    in ascending order and the cost reduction of each split.
+    """
+    X = np.asarray(X, dtype=float)
+    if X.ndim == 1:
+        X = X[:, None]
+    valid = np.flatnonzero(np.all(np.isfinite(X), axis=1))
+    X = X[valid]
+    n, d = X.shape
+    automatic = n_change_points is None
+    if automatic:
+        n_change_points = max_change_points
+    if penalty is None:
+        penalty = 2 * (d + 1) * np.log(max(n, 2))
+    # scale each column by its noise level (MAD of the first differences)
+    dX = np.diff(X, axis=0)
+    sigma = np.median(np.abs(dX - np.median(dX, axis=0)), axis=0) / (0.6745 * np.sqrt(2)) if n > 1 else np.ones(d)
+    sigma = np.where(sigma > 0, sigma, np.std(X, axis=0))
+    sigma[~(sigma > 0)] = 1.
+    S = np.zeros((n + 1, d))
+    np.cumsum((X - X.mean(axis=0)) / sigma, axis=0, out=S[1:])
+    # candidate splits of the current segments, (gain, t, a, b)
+    candidates = [(*_best_split(S, 0, n, min_size), 0, n)]
+    change_points, gains = [], []
+    while candidates and len(change_points) < n_change_points:
+        gain, t, a, b = candidates.pop(max(range(len(candidates)), key=lambda i: candidates[i][0]))
+        if t is None or (automatic and gain <= penalty):
+            break
+        change_points.append(t)
+        gains.append(gain)
+        for a_, b_ in ((a, t), (t, b)):
+            gain_, t_ = _best_split(S, a_, b_, min_size)
+            if t_ is not None:
+                candidates.append((gain_, t_, a_, b_))
+    order = np.argsort(change_points)
+    return valid[np.asarray(change_points, dtype=int)[order]], np.asarray(gains)[order]
@@ -9,13 +9,136 @@ This module provides a class to hold azimuthal integration data and perform vari
 including loading data from HDF5 files, converting between q and 2theta, and normalizing intensity data.
 
 """
+import hashlib
+from functools import partial
 import numpy as np
 from PyQt6.QtWidgets import  QInputDialog, QMessageBox
 import h5py as h5
 from plaid.nexus import (get_nx_monitor, get_nx_sample, get_nx_transformations, 
                          get_translations_from_nx_transformations)
-from plaid.misc import q_to_tth, tth_to_q, get_map_shape_and_indices, average_blocks
-from plaid.io import export_xy
+from plaid.misc import (q_to_tth, tth_to_q, get_map_shape_and_indices, average_blocks, average_blocks_error,
+                        estimate_background, robust_zscore, despike_frames,
+                        smooth_stack, get_frame_fingerprints, SMOOTHING_KERNELS)
+from plaid.analysis import (decompose_stack, standardize_frames, binned_correlation,
+                            correlation_tile, lagged_correlation, cluster_frames,
+                            detect_change_points)
+from plaid.io import export_xy, export_nxazint1d, DerivedCache
+
+class ProcessingPipeline():
+    """
+    A memoized processing pipeline for azimuthal integration data.
+    Stages are applied in the order they are added, each as func(I, index) -> I,
+    where I holds the frames selected by index (None for all frames).
+    Stages marked as frame_local can be applied to a subset of the frames,
+    otherwise the full stack is processed and indexed afterwards.
+    The processed full stack is memoized for each combination of active stages
+    and returned as a read-only array. Memoized stacks depending on a stage are
+    invalidated with invalidate(stage), or automatically if the arrays returned
+    by the stage inputs callable are replaced.
+    The output of stages marked as cached is kept separately from the memoized
+    stacks, and processing resumes from the longest cached leading combination
+    of the active stages, so expensive stages are not recomputed when later
+    stages are toggled.
+    Parameters:
+    - max_memo: The maximum number of memoized stacks.
+    - max_cached: The maximum number of cached stage outputs.
+    """
+    def __init__(self, max_memo=2, max_cached=2):
+        self.stages = {}  # {name: (func, frame_local, inputs, cached)}
+        self.max_memo = max_memo
+        self.max_cached = max_cached
+        self._memo = {}  # {tuple of stage names: processed stack}
+        self._cache = {}  # {tuple of stage names ending with a cached stage: processed stack}
+        self._source = None  # the unprocessed stack the memoized stacks are derived from
+        self._inputs = {}  # {name: tuple of stage inputs used for the memoized stacks}
+
+    def add_stage(self, name, func, frame_local=True, inputs=None, cached=False):
+        """
+        Add a processing stage.
+        - name: The name of the stage.
+        - func: A callable func(I, index) returning the processed intensities.
+        - frame_local: If True, the stage can be applied to a subset of the frames.
+          May be a callable returning a bool, if it depends on the stage parameters.
+        - inputs: An optional callable returning a tuple of the stage input arrays.
+        - cached: If True, the stage output is cached separately (see the class docstring).
+        """
+        self.stages[name] = (func, frame_local, inputs, cached)
+        self.invalidate(name)
+
+    def invalidate(self, stage=None):
+        """Invalidate the memoized stacks depending on stage, or all if stage is None."""
+        for store in (self._memo, self._cache):
+            for key in list(store.keys()):
+                if stage is None or stage in key:
+                    del store[key]
+        if stage is None:
+            self._source = None
+
+    def _check_inputs(self, I):
+        """Invalidate memoized stacks if the source or stage inputs have been replaced."""
+        if self._source is not I:
+            self.invalidate()
+            self._source = I
+        for name, (func, frame_local, inputs, cached) in self.stages.items():
+            current = inputs() if inputs is not None else ()
+            previous = self._inputs.get(name, ())
+            if len(current) != len(previous) or any(a is not b for a, b in zip(current, previous)):
+                self.invalidate(name)
+                self._inputs[name] = current
+
+    @staticmethod
+    def _store(store, key, out, max_size):
+        """Store a read-only view of out in store, evicting the oldest entries beyond max_size."""
+        out = out.view()
+        out.flags.writeable = False
+        while len(store) >= max(max_size, 1):
+            del store[next(iter(store))]
+        store[key] = out
+        return out
+
+    def _is_frame_local(self, name):
+        """Check if the named stage can currently be applied to a subset of the frames."""
+        frame_local = self.stages[name][1]
+        return frame_local() if callable(frame_local) else frame_local
+
+    def _get_cached_prefix(self, key):
+        """Get the number of leading stages of key with a cached output and the output (or 0, None)."""
+        for j in range(len(key), 0, -1):
+            if key[:j] in self._cache:
+                return j, self._cache[key[:j]]
+        return 0, None
+
+    def run(self, I, stages, index=None):
+        """
+        Apply the named stages to the intensities I[index] (all frames if index is None).
+        The stages are applied in the pipeline order, regardless of the order of stages.
+        """
+        self._check_inputs(I)
+        key = tuple(name for name in self.stages if name in stages)
+        if key in self._cache:
+            out = self._cache[key]
+            return out if index is None else out[index]
+        if key not in self._memo:
+            start, cached = self._get_cached_prefix(key)
+            if index is not None and all(self._is_frame_local(name) for name in key[start:]):
+                # process only the requested frames (copy if unprocessed to protect the raw stack)
+                I = (cached if cached is not None else I)[index]
+                I = I if key[start:] else np.array(I)
+                for name in key[start:]:
+                    I = self.stages[name][0](I, index)
+                return I
+            out = cached if cached is not None else I
+            for j in range(start, len(key)):
+                out = self.stages[key[j]][0](out, None)
+                if self.stages[key[j]][3]:
+                    out = self._store(self._cache, key[:j+1], out, self.max_cached)
+            if key in self._cache:
+                out = self._cache[key]
+                return out if index is None else out[index]
+            # return a read-only view to protect the memoized (or raw) stack
+            self._store(self._memo, key, out, self.max_memo)
+        out = self._memo[key]
+        return out if index is None else out[index]
 
 class AzintData():
     """
@@ -48,14 +171,51 @@ class AzintData():
         self.I0 = None
         self.shape = None  # Shape of the intensity data
         self._shapes = []  # Shapes of individual files loaded
-        self.reduction_factor = 1 # Reduction factor applied to the data (compounded if multiple reductions are applied)
+        self.reduction_factor = 1 # Reduction factor applied to the data (see set_reduction_factor)
+        self._pyramid = {}  # {reduction_factor: (I, I_error)} (see build_reduction_pyramid)
+        self.max_pyramid_levels = 2  # Number of reduction levels kept in the pyramid
+        self._raw_I0 = None  # Unreduced I0 data
+        self._raw_map = (None, None)  # Unreduced map shape and indices
         self.instrument_name = None  # Name of the instrument, if available
         self.source_name = None  # Name of the source, if available
         self._load_func = None
         self.map_shape = None  # Shape of the loaded data files used for mapping (PLACEHOLDER)
         self.map_indices = None  # Indices of the loaded data files used for mapping (PLACEHOLDER)
 
+        self.frame_mask = None  # Boolean mask of the valid frames, None if all are valid (see detect_outlier_frames)
         self.y_bgr = None  # Background intensity data
+        self.bgr_scale = None  # Per-frame scale of the background intensity data (see fit_bgr_scale)
+        self.bgr_offset = None  # Per-frame offset of the background intensity data (see fit_bgr_scale)
+        self.bgr_stack = None  # Per-frame background estimate (see estimate_bgr_stack)
+        self.bgr_stack_params = None  # Parameters of the per-frame background estimate
+        self.use_bgr_stack = False  # Subtract the per-frame background estimate
+        self.despike_params = None  # Parameters of the despiking along the frame axis, None if disabled (see set_despike)
+        self.smooth_params = None  # Parameters of the smoothing, None if disabled (see set_smoothing)
+        self._smooth_kernels = (None, None)  # Smoothing kernels along the frame and radial axis
+        self._smooth_state = None  # (smooth_params, frame fingerprints, output) of the last full smoothing (see _smooth)
+        self.components = None  # Component patterns of the decomposition of the stack (see decompose)
+        self.component_scores = None  # Per-frame weights of the component patterns, shape (frames, components)
+        self.decomposition_params = None  # Parameters of the decomposition, including the explained variance (PCA)
+        self.cluster_labels = None  # Cluster label of each frame, -1 if not clustered (see get_cluster_func)
+        self.cluster_means = None  # Mean pattern of each cluster, shape (clusters, bins)
+        self.cluster_params = None  # Parameters of the clustering
+        self._derived_cache = None  # Sidecar cache of derived products (see get_derived_cache)
+
+        # memoized processing of the intensity data (see get_I)
+        self.pipeline = ProcessingPipeline()
+        self.pipeline.add_stage("despike", self._despike, frame_local=False, cached=True)
+        self.pipeline.add_stage("bgr_stack", self._subtract_bgr_stack, cached=True,
+                                inputs=lambda: (self.bgr_stack,))
+        self.pipeline.add_stage("smooth", self._smooth, cached=True,
+                                frame_local=lambda: self._smooth_kernels[0] is None)
+        self.pipeline.add_stage("background", self._subtract_background,
+                                inputs=lambda: (self.y_bgr, self.bgr_scale, self.bgr_offset))
+        self.pipeline.add_stage("normalize", self._normalize_I0,
+                                inputs=lambda: (self.I0,))
+        self._average_memo = {}  # {I0_normalized: (I, I0, mean_I, mean_inv_I0)} (see get_average_I)
+        self._prefix_memo = {}  # {I0_normalized: (I, I0, cumsum_I, cumsum_inv_I0)} (see get_range_average_I)
+        self._radial_prefix_memo = None  # (I, x, cumsum_I, cumsum_xI, cumsum_x2I) along the radial axis (see get_roi_sums)
+        self._standardized_memo = {}  # {(centered, roi): (I, Z)} unit-norm frames (see get_standardized_I)
 
         #self.aux_data = {} # {alias: np.array}
 
@@ -89,6 +249,7 @@ class AzintData():
                     return False
                 I0 = np.append(I0, I0_) if I0.size else I0_
         self.I0 = I0
+        self.pipeline.invalidate("normalize")
         return True
     
     def load_map_shape_and_indices(self):
@@ -120,20 +281,84 @@ class AzintData():
         self.map_shape, self.map_indices = get_map_shape_and_indices(y, x)
         return True
 
-    def reduce_data(self, reduction_factor=2, axes=(0,)):
-        """Reduce the azimuthal integration data by averaging non-overlapping blocks."""
-        
-        if self.I is None:
+    def build_reduction_pyramid(self):
+        """
+        Initialize the pyramid of reduced intensity data along the frame axis with
+        the unreduced data. The reduction levels are built lazily when a reduction
+        factor is first requested, each averaged from the largest existing level
+        dividing it, and the max_pyramid_levels most recently used levels are kept,
+        so switching between reduction factors is fast and reversible
+        (see set_reduction_factor).
+        """
+        if self.I is None or self.reduction_factor != 1:
             return
-        self.I = average_blocks(self.I, reduction_factor=reduction_factor, axes=axes)
-        if self.I_error is not None:
-            self.I_error = average_blocks(self.I_error, reduction_factor=reduction_factor, axes=axes)
-        if self.I0 is not None:
-            self.I0 = average_blocks(self.I0, reduction_factor=reduction_factor, axes=axes)
-        #self.y_avg = self.I.mean(axis=0) if self.I is not None else None
-        self.shape = self.I.shape if self.I is not None else None
-        self.map_shape, self.map_indices = None, None  # Invalidate map shape and indices after reduction
-        self.reduction_factor *= reduction_factor
+        self._pyramid = {1: (self.I, self.I_error)}
+
+    def _get_pyramid_level(self, factor):
+        """
+        Get the (I, I_error) reduction level for a reduction factor, averaging
+        it from the largest existing level that divides the factor. The error
+        of the average of k frames is sqrt(sum(I_error**2))/k.
+        """
+        if factor in self._pyramid:
+            # mark the level as recently used
+            self._pyramid[factor] = self._pyramid.pop(factor)
+            return self._pyramid[factor]
+        base = max(f for f in self._pyramid if factor % f == 0)
+        k = factor // base
+        I, I_error = self._pyramid[base]
+        I = average_blocks(I, reduction_factor=k)
+        if I_error is not None:
+            I_error = average_blocks_error(I_error, reduction_factor=k)
+        self._pyramid[factor] = (I, I_error)
+        # evict the least recently used reduction levels, keeping the unreduced data
+        reduced = [f for f in self._pyramid if f != 1]
+        for f in reduced[:max(0, len(reduced) - self.max_pyramid_levels)]:
+            del self._pyramid[f]
+        return self._pyramid[factor]
+
+    def set_reduction_factor(self, reduction_factor):
+        """
+        Set the (absolute) reduction factor of the azimuthal integration data,
+        averaging non-overlapping blocks of frames. The unreduced data is kept,
+        so a reduction factor of 1 reverts to the original data.
+        """
+        if self.I is None or reduction_factor < 1:
+            return
+        if self.reduction_factor == 1:
+            # (re)build the pyramid if the unreduced data has changed
+            if not self._pyramid or self._pyramid[1][0] is not self.I or self._pyramid[1][1] is not self.I_error:
+                self._pyramid = {}
+                self.build_reduction_pyramid()
+            self._raw_I0 = self.I0
+            self._raw_map = (self.map_shape, self.map_indices)
+        if reduction_factor == self.reduction_factor:
+            return
+        self.I, self.I_error = self._get_pyramid_level(reduction_factor)
+        if self._raw_I0 is not None:
+            self.I0 = average_blocks(self._raw_I0, reduction_factor=reduction_factor)
+        if reduction_factor == 1:
+            self.map_shape, self.map_indices = self._raw_map
+        else:
+            self.map_shape, self.map_indices = None, None  # Invalidate map shape and indices after reduction
+        self.pipeline.invalidate()
+        self._average_memo.clear()
+        self._prefix_memo.clear()
+        self._radial_prefix_memo = None
+        self._standardized_memo.clear()
+        self.shape = self.I.shape
+        self.reduction_factor = reduction_factor
+        # the per-frame background estimate and scale no longer match the frames
+        self.bgr_stack, self.bgr_stack_params = None, None
+        self.bgr_scale, self.bgr_offset = None, None
+        self.use_bgr_stack = False
+        self.frame_mask = None
+        self.components, self.component_scores, self.decomposition_params = None, None, None
+        self.cluster_labels, self.cluster_means, self.cluster_params = None, None, None
+
+    def reduce_data(self, reduction_factor=2):
+        """Reduce the azimuthal integration data further by averaging non-overlapping blocks of frames."""
+        self.set_reduction_factor(self.reduction_factor * reduction_factor)
 
     def user_E_dialog(self):
         """Prompt the user for the energy value if not available in the file."""
@@ -178,28 +403,822 @@ class AzintData():
         if self.I is None:
             print("No intensity data loaded.")
             return None
-        I0 = 1
+        stages = []
+        if bgr_subtracted and self.y_bgr is not None:
+            stages.append("background")
         if self.I0 is not None and I0_normalized:
             if self.I0.shape[0] != self.shape[0]:
                 print(f"I0 data shape {self.I0.shape} must match the number of frames {self.shape} in the azimuthal integration data.")
                 return None
-            I0 = self.I0
+            stages.append("normalize")
+        # the full stack is returned as a read-only memoized array
+        return self.pipeline.run(self.I, self._get_source_stages(bgr_subtracted) + stages, index=index)
+
+    def _get_source_stages(self, bgr_subtracted=True):
+        """
+        Get the names of the active pipeline stages applied to the full stack before
+        the background subtraction and normalization, i.e. the despiking if enabled,
+        the subtraction of the per-frame background estimate if use_bgr_stack and
+        bgr_subtracted are True, and the smoothing if enabled.
+        """
+        stages = []
+        if self.despike_params is not None:
+            stages.append("despike")
+        if bgr_subtracted and self.use_bgr_stack and self.bgr_stack is not None:
+            if self.bgr_stack.shape != self.I.shape:
+                print(f"Background stack shape {self.bgr_stack.shape} must match the intensity data shape {self.I.shape}.")
+            else:
+                stages.append("bgr_stack")
+        if self.smooth_params is not None:
+            stages.append("smooth")
+        return stages
+
+    def _get_source(self, bgr_subtracted=True):
+        """
+        Get the intensity data that the processing is applied to, i.e. I processed
+        by the active source stages (see _get_source_stages). The processed stack is
+        cached by the pipeline, so it can be used to validate memoized products
+        derived from it.
+        """
+        stages = self._get_source_stages(bgr_subtracted)
+        if not stages:
+            return self.I
+        return self.pipeline.run(self.I, stages)
+
+    def _despike(self, I, index=None):
+        """Pipeline stage replacing spikes along the frame axis (see plaid.misc.despike_frames)."""
+        return despike_frames(I, **self.despike_params)
+
+    def _subtract_bgr_stack(self, I, index=None):
+        """Pipeline stage subtracting the per-frame background estimate from the intensities I (frames selected by index)."""
+        bgr_stack = self.bgr_stack if index is None else self.bgr_stack[index]
+        return np.subtract(I, bgr_stack, dtype=np.result_type(I.dtype, np.float32))
+
+    def _smooth(self, I, index=None):
+        """
+        Pipeline stage smoothing the intensities I along the frame and/or radial axis
+        (see plaid.misc.smooth_stack). Only applied to a subset of the frames (index)
+        if the frame axis is not smoothed.
+        When the full stack is smoothed again with the same parameters, e.g. after
+        toggling the despiking, only the frames within half a frame kernel of the
+        frames that changed since the last smoothing are recomputed.
+        """
+        frame_kernel, radial_kernel = self._smooth_kernels
         if index is not None:
-            I = self.I[index, :]  # Get the intensity data for the specified index
-            I0 = I0[index] if isinstance(I0, np.ndarray) else I0  # Get the corresponding I0 value
+            return smooth_stack(np.atleast_2d(I), frame_kernel, radial_kernel).reshape(I.shape)
+        fingerprints = get_frame_fingerprints(I)
+        state = self._smooth_state
+        if state is None or state[0] != self.smooth_params or state[1].shape != fingerprints.shape:
+            out = smooth_stack(I, frame_kernel, radial_kernel)
         else:
-            I = self.I
-        if bgr_subtracted and self.y_bgr is not None:
-            I = I - self.y_bgr
+            previous, out = state[1], state[2]
+            changed = ~((fingerprints == previous) | (np.isnan(fingerprints) & np.isnan(previous)))
+            if changed.any():
+                half = len(frame_kernel) // 2 if frame_kernel is not None else 0
+                affected = np.convolve(changed, np.ones(2*half + 1), mode='same') > 0 if half else changed
+                # recompute the runs of affected frames in a copy, as the previous output may be referenced
+                out = out.copy()
+                edges = np.flatnonzero(np.diff(np.concatenate(([0], affected.astype(np.int8), [0]))))
+                for start, stop in zip(edges[::2], edges[1::2]):
+                    out[start:stop] = smooth_stack(I, frame_kernel, radial_kernel, start=start, stop=stop)
+        self._smooth_state = (self.smooth_params, fingerprints, out)
+        return out
+
+    def set_smoothing(self, method=None, frames=0, radial=0, order=2):
+        """
+        Set the smoothing of the intensity data, or disable it if method is None.
+        - method: 'savgol' (Savitzky-Golay) or 'gaussian'.
+        - frames, radial: The window size ('savgol') or standard deviation ('gaussian')
+          along the frame and radial axis in frames and bins, 0 to skip the axis.
+        - order: The polynomial order of the Savitzky-Golay filter.
+        The smoothed stack is cached. If only the radial axis is smoothed, single
+        frames are smoothed on request without processing the full stack.
+        Returns True if successful.
+        """
+        if method is None or not (frames or radial):
+            self.smooth_params, self._smooth_kernels = None, (None, None)
+            self._smooth_state = None
+            self.pipeline.invalidate("smooth")
+            return True
+        if method not in SMOOTHING_KERNELS:
+            print(f"Unknown smoothing method '{method}', expected one of {list(SMOOTHING_KERNELS)}.")
+            return False
+        kwargs = {"order": order} if method == "savgol" else {}
+        try:
+            kernels = tuple(SMOOTHING_KERNELS[method](width, **kwargs) if width else None for width in (frames, radial))
+        except ValueError as e:
+            print(f"Invalid smoothing parameters: {e}")
+            return False
+        smooth_params = {"method": method, "frames": frames, "radial": radial, **kwargs}
+        if smooth_params == self.smooth_params:
+            # unchanged parameters, keep the cached smoothing
+            return True
+        self.smooth_params = smooth_params
+        self._smooth_kernels = kernels
+        self.pipeline.invalidate("smooth")
+        return True
+
+    def set_despike(self, enabled=True, window=5, threshold=5.0):
+        """
+        Toggle the despiking of the intensity data along the frame axis, replacing
+        values deviating more than threshold robust standard deviations from the
+        median of the window-1 neighbouring frames (see plaid.misc.despike_frames).
+        The despiked stack is cached, so later processing stages can be toggled
+        without repeating the despiking.
+        """
+        self.despike_params = {"window": int(window), "threshold": float(threshold)} if enabled else None
+        self.pipeline.invalidate("despike")
+
+    def estimate_bgr_stack(self, method="snip", chunk_size=256, progress=None, **kwargs):
+        """
+        Estimate the background of each frame of the (unnormalized) intensity data
+        with plaid.misc.estimate_background, processing chunk_size frames at a time.
+        The background is estimated from the stages upstream of its subtraction, i.e.
+        the despiked data if despiking is enabled, as the smoothing is applied after
+        the subtraction. kwargs are passed to the estimation method. progress is an
+        optional callable progress(i) called with the number of processed frames,
+        returning False to cancel the estimation. The result is stored as bgr_stack
+        and subtracted from the intensity data if use_bgr_stack is True.
+        Returns True if successful.
+        """
+        if self.I is None:
+            print("No intensity data loaded.")
+            return False
+        n = self.shape[0]
+        source = self.pipeline.run(self.I, ["despike"]) if self.despike_params is not None else self.I
+        bgr_stack = np.empty(source.shape, dtype=np.result_type(source.dtype, np.float32))
+        for i in range(0, n, chunk_size):
+            if progress is not None and not progress(i):
+                return False
+            bgr_stack[i:i+chunk_size] = estimate_background(source[i:i+chunk_size], method=method, **kwargs)
+        if progress is not None:
+            progress(n)
+        bgr_stack.flags.writeable = False
+        self.bgr_stack = bgr_stack
+        # include the despiking of the source, which keys the derived products
+        self.bgr_stack_params = {"method": method, **kwargs, "despike": self.despike_params}
+        self.pipeline.invalidate("bgr_stack")
+        return True
+
+    def set_use_bgr_stack(self, use_bgr_stack):
+        """Toggle the subtraction of the per-frame background estimate (see estimate_bgr_stack)."""
+        self.use_bgr_stack = bool(use_bgr_stack)
+
+    def get_standardized_I(self, centered=True, roi=None, chunk_bytes=2**26):
+        """
+        Get the processed intensity data with each frame scaled to unit norm, after
+        subtracting its mean if centered is True, as a read-only float32 array. The
+        dot product of two standardized frames is then their Pearson correlation
+        (centered) or cosine similarity. If roi (a boolean mask of the radial bins)
+        is provided, only the selected bins are used. The standardized stack is
+        computed chunk by chunk and memoized (for the latest roi only).
+        """
+        I = self.get_I()
+        if I is None:
+            return None
+        roi_key = self._get_roi_key(roi)
+        key = (centered, roi_key)
+        memo = self._standardized_memo.get(key)
+        if memo is None or memo[0] is not I:
+            Z = standardize_frames(I if roi is None else I[:, roi], centered, chunk_bytes)
+            Z.flags.writeable = False
+            memo = (I, Z)
+            if roi is not None:
+                # only keep the standardized stack of the latest roi
+                for k in [k for k in self._standardized_memo if k[1] not in (None, roi_key)]:
+                    del self._standardized_memo[k]
+            self._standardized_memo[key] = memo
+        return memo[1]
+
+    @staticmethod
+    def _get_roi_key(roi):
+        """Get a hashable digest of a boolean mask of the radial bins, or None."""
+        if roi is None:
+            return None
+        roi = np.asarray(roi, dtype=bool)
+        return hashlib.sha1(np.packbits(roi).tobytes() + str(roi.shape).encode()).hexdigest()
+
+    def get_correlation_matrix(self, max_size=1024, roi=None):
+        """
+        Get the frame-frame (Pearson) correlation matrix for display, averaged over
+        blocks of factor x factor frames so that its size does not exceed max_size
+        (see plaid.analysis.binned_correlation). Masked frames are excluded.
+        If roi (a boolean mask of the radial bins) is provided, the correlation is
+        computed over the selected bins only.
+        The matrix is loaded from the derived product cache if available.
+        Returns the matrix and the binning factor.
+        """
+        if self.I is None:
+            print("No intensity data loaded.")
+            return None, 1
+        factor = -(-self.shape[0] // max_size)
+        params = {"factor": factor, "roi": self._get_roi_key(roi)}
+        im = self.load_derived("correlation", params)
+        if im is None or im.shape != (-(-self.shape[0] // factor),)*2:
+            im = binned_correlation(self.get_standardized_I(roi=roi), factor, self.frame_mask)
+            self.save_derived("correlation", im, params)
+        return im, factor
+
+    def get_lagged_correlation(self, max_lag=50, max_size=1024, roi=None):
+        """
+        Get the (Pearson) correlation of each frame with the following 1 to max_lag
+        frames (see plaid.analysis.lagged_correlation), averaged over blocks of factor
+        frames so that the number of rows does not exceed max_size. Masked frames are
+        excluded. If roi (a boolean mask of the radial bins) is provided, the
+        correlation is computed over the selected bins only.
+        Returns the (frames/factor, max_lag) matrix and the binning factor.
+        """
+        if self.I is None:
+            print("No intensity data loaded.")
+            return None, 1
+        im = lagged_correlation(self.get_standardized_I(roi=roi), max_lag, self.frame_mask)
+        factor = -(-self.shape[0] // max_size)
+        if factor > 1:
+            # average the finite correlations of each block of frames
+            starts = np.arange(0, self.shape[0], factor)
+            finite = np.isfinite(im)
+            counts = np.add.reduceat(finite, starts, axis=0)
+            im = np.add.reduceat(np.where(finite, im, 0), starts, axis=0) / np.where(counts > 0, counts, 1)
+            im[counts == 0] = np.nan
+        return im.astype(np.float32, copy=False), factor
+
+    def get_correlation_tile_func(self, roi=None):
+        """
+        Get a callable func(rows, cols) returning full-resolution tiles of the frame-frame
+        correlation matrix of the current processed data (see plaid.analysis.correlation_tile).
+        The callable only holds read-only arrays, so it can be called from a worker thread.
+        """
+        Z = self.get_standardized_I(roi=roi)
+        if Z is None:
+            return None
+        frame_mask = self.frame_mask.copy() if self.frame_mask is not None else None
+        return partial(correlation_tile, Z, frame_mask=frame_mask)
+
+    def find_similar_frames(self, index, k=10, centered=True):
+        """
+        Find the k frames most similar to the frame at index by Pearson correlation
+        (centered) or cosine similarity, computed as a single matrix-vector product
+        with the standardized stack (see get_standardized_I). The frame itself and
+        masked frames are excluded.
+        Returns the frame indices and similarities, sorted by decreasing similarity.
+        """
+        Z = self.get_standardized_I(centered)
+        if Z is None:
+            return None, None
+        similarity = Z @ Z[index]
+        similarity[index] = -np.inf
+        if self.frame_mask is not None:
+            similarity[~self.frame_mask] = -np.inf
+        k = min(k, int(np.count_nonzero(np.isfinite(similarity))))
+        if k <= 0:
+            return np.array([], dtype=int), np.array([], dtype=np.float32)
+        indices = np.argpartition(-similarity, k-1)[:k]
+        indices = indices[np.argsort(-similarity[indices])]
+        return indices, similarity[indices]
+
+    def get_decomposition_func(self, method="pca", n_components=5, **kwargs):
+        """
+        Get a callable func(progress=None) decomposing the processed (background
+        subtracted and I0 normalized) intensity data into n_components component
+        patterns and their per-frame weights, by randomized PCA ('pca') or NMF ('nmf'),
+        returning (components, scores, params) (see plaid.analysis.decompose_stack).
+        The decomposition reads the processed stack chunk by chunk, but the stack
+        itself is held in memory. Masked frames (see set_frame_mask) are replaced by
+        the average pattern during the decomposition and get NaN weights.
+        The callable only holds read-only arrays, so it can be called from a worker thread.
+        Store the result with set_decomposition.
+        """
+        if self.I is None:
+            print("No intensity data loaded.")
+            return None
+        if method not in ("pca", "nmf"):
+            print(f"Unknown decomposition method '{method}', expected 'pca' or 'nmf'.")
+            return None
+        frame_mask = self.frame_mask.copy() if self.frame_mask is not None else None
+        fill = self.get_average_I() if frame_mask is not None else None
+        return partial(decompose_stack, self.get_I(), method, n_components, frame_mask=frame_mask, fill=fill, **kwargs)
+
+    def set_decomposition(self, components, scores, params):
+        """Set the component patterns and per-frame weights of a decomposition (see get_decomposition_func)."""
+        if scores is not None and scores.shape[0] != self.shape[0]:
+            print(f"Component scores shape {scores.shape} must match the number of frames {self.shape}.")
+            return False
+        self.components, self.component_scores, self.decomposition_params = components, scores, params
+        return True
+
+    def decompose(self, method="pca", n_components=5, progress=None, **kwargs):
+        """
+        Decompose the processed intensity data in the calling thread (see
+        get_decomposition_func). progress is an optional callable progress(fraction),
+        returning False to cancel the decomposition. The result is stored as
+        components and component_scores. Returns True if successful.
+        """
+        func = self.get_decomposition_func(method, n_components, **kwargs)
+        if func is None:
+            return False
+        result = func(progress=progress)
+        if result is None:
+            return False
+        return self.set_decomposition(*result)
+
+    def get_cluster_func(self, n_clusters=3, n_components=5):
+        """
+        Get a callable func(progress=None) clustering the frames of the processed
+        intensity data by k-means on their principal component scores, returning the
+        cluster labels and mean patterns (see plaid.analysis.cluster_frames). The scores
+        of a previous PCA decomposition (see decompose) are used if available. Masked
+        frames (see set_frame_mask) are excluded from the fit and labelled -1.
+        The callable only holds read-only arrays, so it can be called from a worker thread.
+        Store the result with set_clusters.
+        """
+        I = self.get_I()
+        if I is None:
+            return None
+        scores = None
+        if self.decomposition_params is not None and self.decomposition_params["method"] == "pca":
+            scores = self.component_scores
+        frame_mask = self.frame_mask.copy() if self.frame_mask is not None else None
+        return partial(cluster_frames, I, n_clusters, n_components, scores=scores, frame_mask=frame_mask)
+
+    def detect_change_points(self, signal, n_change_points=None):
+        """
+        Detect change points along the frame axis of a per-frame signal of shape
+        (frames,) or (frames, d), e.g. roi integrals or component scores, ignoring
+        masked frames (see plaid.analysis.detect_change_points). If n_change_points
+        is None, the number of change points is determined automatically.
+        Returns (indices, gains), the first frame after each change point and the
+        cost reduction of each split, or (None, None) if no data is loaded.
+        """
+        if self.I is None:
+            return None, None
+        signal = np.array(signal, dtype=float)
+        if signal.shape[0] != self.shape[0]:
+            print(f"Signal shape {signal.shape} must match the number of frames {self.shape}.")
+            return None, None
+        if self.frame_mask is not None:
+            signal[~self.frame_mask] = np.nan
+        return detect_change_points(signal, n_change_points)
+
+    def set_clusters(self, labels, means, params=None):
+        """Set the cluster labels of the frames and the cluster mean patterns (see get_cluster_func)."""
+        if labels is not None and labels.shape[0] != self.shape[0]:
+            print(f"Cluster labels shape {labels.shape} must match the number of frames {self.shape}.")
+            return False
+        self.cluster_labels, self.cluster_means, self.cluster_params = labels, means, params
+        return True
+
+    def get_binned_x(self, is_Q=False, radial_factor=1):
+        """Get the radial axis (q or 2theta) averaged over non-overlapping blocks of radial_factor bins."""
+        x = self.get_q() if is_Q else self.get_tth()
+        if x is None:
+            return None
+        return average_blocks(x, reduction_factor=radial_factor)
+
+    def get_binned_I(self, index=None, radial_factor=1, frame_factor=1, I0_normalized=True, bgr_subtracted=True):
+        """
+        Get the intensity data at I[index] (see get_I), averaged over non-overlapping
+        blocks of radial_factor radial bins and, for multiple frames, frame_factor frames.
+        The binning is applied as a view on request and leaves the intensity data unchanged.
+        """
+        I = self.get_I(index=index, I0_normalized=I0_normalized, bgr_subtracted=bgr_subtracted)
+        return self._bin(I, average_blocks, radial_factor, frame_factor)
+
+    def get_binned_I_error(self, index=None, radial_factor=1, frame_factor=1, I0_normalized=True):
+        """
+        Get the intensity errors at I_error[index] (see get_I_error), binned as in
+        get_binned_I with the errors propagated in quadrature.
+        """
+        I_error = self.get_I_error(index=index, I0_normalized=I0_normalized)
+        return self._bin(I_error, average_blocks_error, radial_factor, frame_factor)
+
+    @staticmethod
+    def _bin(arr, func, radial_factor=1, frame_factor=1):
+        """Bin arr along the radial (last) axis and, if 2D, the frame axis with func."""
+        if arr is None:
+            return None
+        arr = func(arr, reduction_factor=radial_factor, axes=(arr.ndim-1,))
+        if arr.ndim == 2:
+            arr = func(arr, reduction_factor=frame_factor, axes=(0,))
+        return arr
+
+    def detect_outlier_frames(self, threshold=8.0, use_I0=True, chunk_bytes=2**26):
+        """
+        Detect outlier frames, such as beam dumps, shutter closures and zingers,
+        by robust z-scores (see plaid.misc.robust_zscore) of the logarithm of the
+        per-frame
+        - total intensity,
+        - I0 (if set and use_I0 is True),
+        - difference to the neighbouring frames, i.e. the smaller of the mean
+          absolute differences to the previous and the next frame relative to the
+          mean intensity of the two frames, such that single deviating frames are
+          detected, but not steps in the data.
+        The logarithm and the relative differences make the scores independent of
+        the intensity scale, so gradual changes of the intensity are not flagged. The metrics are computed from the unnormalized intensities
+        in a single chunked pass over the stack. Returns a boolean mask of the valid
+        frames, i.e. frames where all absolute z-scores are below threshold.
+        """
+        if self.I is None:
+            print("No intensity data loaded.")
+            return None
+        n = self.I.shape[0]
+        chunk_size = max(1, chunk_bytes // (8 * max(1, np.prod(self.I.shape[1:]))))
+        total = np.zeros(n)
+        diff = np.full(n+1, np.nan)  # diff[i] is the difference between frame i-1 and i
+        for i in range(0, n, chunk_size):
+            # include the last frame of the previous chunk for the differences
+            j = max(i-1, 0)
+            I = self.I[j:i+chunk_size].astype(np.float64)
+            total[i:i+chunk_size] = I[i-j:].sum(axis=1)
+            diff[j+1:j+I.shape[0]] = np.mean(np.abs(np.diff(I, axis=0)), axis=1)
+        # relative to the mean intensity of each pair of frames
+        pair_mean = (total[:-1] + total[1:]) / (2 * np.prod(self.I.shape[1:]))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            diff[1:n] = np.abs(diff[1:n] / pair_mean)
+        metrics = [total, np.fmin(diff[:-1], diff[1:])]
+        if use_I0 and self.I0 is not None and self.I0.shape[0] == n:
+            metrics.append(self.I0)
+        tiny = np.finfo(np.float64).tiny
+        with np.errstate(invalid='ignore'):
+            scores = [robust_zscore(np.log(np.clip(metric, tiny, None))) for metric in metrics]
+            outliers = np.any([np.abs(z) > threshold for z in scores], axis=0)
+        return ~outliers
+
+    def set_frame_mask(self, frame_mask):
+        """
+        Set the boolean mask of the valid frames, or None if all frames are valid.
+        The averages, roi maps and exports only include the valid frames.
+        """
+        if frame_mask is not None:
+            frame_mask = np.asarray(frame_mask, dtype=bool)
+            if frame_mask.shape != (self.shape[0],):
+                print(f"Frame mask shape {frame_mask.shape} must match the number of frames {self.shape[0]}.")
+                return
+            if not frame_mask.any():
+                print("The frame mask must include at least one valid frame.")
+                return
+            if frame_mask.all():
+                frame_mask = None
+        self.frame_mask = frame_mask
+
+    def _get_frame_weights(self, I0_normalized, index=slice(None)):
+        """
+        Get the per-frame weights of the frames selected by index used for averaging,
+        i.e. 1/I0 (or 1) for valid frames and 0 for masked frames, as float64.
+        """
+        n = len(range(*index.indices(self.shape[0])))
+        w = 1 / self.I0[index].astype(np.float64) if I0_normalized else np.ones(n)
+        if self.frame_mask is not None:
+            w = w * self.frame_mask[index]
+        return w
+
+    def _subtract_background(self, I, index=None):
+        """
+        Pipeline stage subtracting the background from the intensities I (frames
+        selected by index), scaled and offset per frame if fitted (see fit_bgr_scale).
+        """
+        if self.bgr_scale is None:
+            return I - self.y_bgr
+        scale = self.bgr_scale if index is None else self.bgr_scale[index]
+        offset = self.bgr_offset if index is None else self.bgr_offset[index]
+        I_bgr = np.multiply.outer(scale, self.y_bgr) + np.asarray(offset)[..., None]
+        return (I - I_bgr).astype(np.result_type(I.dtype, np.float32), copy=False)
+
+    def fit_bgr_scale(self, mask, fit_offset=True, chunk_bytes=2**26):
+        """
+        Fit a scale a and offset c of the background intensity data y_bgr to each
+        frame by least squares over the radial bins selected by the boolean mask,
+        minimizing sum((I - a*y_bgr - c)**2). The 2x2 normal equations are solved
+        in closed form for all frames at once from the masked sums of I and y_bgr*I,
+        which are accumulated in a single chunked pass over the stack.
+        If fit_offset is False, only the scale is fitted.
+        Returns True if successful.
+        """
+        if self.I is None or self.y_bgr is None:
+            print("Intensity and background intensity data must be set to fit the background scale.")
+            return False
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != self.x.shape:
+            print(f"Mask shape {mask.shape} must match the radial axis shape {self.x.shape}.")
+            return False
+        y_bgr = self.y_bgr[mask].astype(np.float64)
+        m = y_bgr.shape[0]
+        source = self._get_source()
+        n = source.shape[0]
+        chunk_size = max(1, chunk_bytes // (8 * max(1, m)))
+        sum_I, sum_bI = np.zeros(n), np.zeros(n)
+        for i in range(0, n, chunk_size):
+            I = source[i:i+chunk_size][:, mask].astype(np.float64)
+            sum_I[i:i+I.shape[0]] = I.sum(axis=1)
+            sum_bI[i:i+I.shape[0]] = I @ y_bgr
+        sum_b, sum_bb = np.sum(y_bgr), np.sum(y_bgr**2)
+        if fit_offset:
+            det = m*sum_bb - sum_b**2
+            if m < 2 or det <= 0:
+                print("The background intensity data must vary within the mask to fit a scale and offset.")
+                return False
+            scale = (m*sum_bI - sum_b*sum_I) / det
+            offset = (sum_bb*sum_I - sum_b*sum_bI) / det
+        else:
+            if sum_bb <= 0:
+                print("The background intensity data must be non-zero within the mask to fit a scale.")
+                return False
+            scale = sum_bI / sum_bb
+            offset = np.zeros(n)
+        self.bgr_scale, self.bgr_offset = scale, offset
+        self.pipeline.invalidate("background")
+        return True
+
+    def clear_bgr_scale(self):
+        """Remove the per-frame scale and offset of the background intensity data."""
+        self.bgr_scale, self.bgr_offset = None, None
+        self.pipeline.invalidate("background")
+
+    def _normalize_I0(self, I, index=None):
+        """Pipeline stage normalizing the intensities I (frames selected by index) by I0."""
+        I0 = self.I0 if index is None else self.I0[index]
         return (I.T / I0).T
     
     def get_average_I(self, I0_normalized=True,bgr_subtracted=True):
-        """Get the average intensity data, normalized by I0 if set."""
+        """
+        Get the average intensity data, normalized by I0 if set.
+        The average is computed chunk by chunk and memoized without the background,
+        which is subtracted algebraically, so changing the background is cheap.
+        The memoized average is persisted in the derived product cache, and
+        loaded from it if the memo is outdated.
+        """
         if self.I is None:
             print("No intensity data loaded.")
             return None
-        I = self.get_I(index=None, I0_normalized=I0_normalized,bgr_subtracted=bgr_subtracted)
-        return np.mean(I, axis=0) if I is not None else None
+        I0_normalized = I0_normalized and self.I0 is not None
+        if I0_normalized and self.I0.shape[0] != self.shape[0]:
+            print(f"I0 data shape {self.I0.shape} must match the number of frames {self.shape} in the azimuthal integration data.")
+            return None
+        source = self._get_source(bgr_subtracted)
+        source_stages = self._get_source_stages(bgr_subtracted)
+        bgr_subtracted = bgr_subtracted and self.y_bgr is not None
+        base = self._average_memo.get(I0_normalized)
+        if (base is None or base[0] is not source or (I0_normalized and base[1] is not self.I0)
+                or base[4] is not self.frame_mask):
+            params = {"I0_normalized": I0_normalized, "source_stages": source_stages}
+            # the cached average base is mean(I/I0) with mean(1/I0) appended
+            cached = self.load_derived("average", params)
+            if cached is not None and cached.shape == (self.x.shape[0]+1,):
+                base = (source, self.I0 if I0_normalized else None, cached[:-1], float(cached[-1]), self.frame_mask)
+            else:
+                base = self._compute_average_base(I0_normalized, source)
+                self.save_derived("average", np.append(base[2], base[3]), params)
+            self._average_memo[I0_normalized] = base
+        # mean((I-y_bgr)/I0) = mean(I/I0) - y_bgr*mean(1/I0)
+        _, _, mean_I, mean_inv_I0, _ = base
+        y_avg = mean_I - self.y_bgr * mean_inv_I0 if bgr_subtracted else mean_I
+        if bgr_subtracted and self.bgr_scale is not None:
+            # mean((I-a*y_bgr-c)/I0) = mean(I/I0) - y_bgr*mean(a/I0) - mean(c/I0)
+            w = self._get_frame_weights(I0_normalized)
+            n = np.count_nonzero(self.frame_mask) if self.frame_mask is not None else self.shape[0]
+            y_avg = mean_I - self.y_bgr * np.sum(self.bgr_scale*w) / n - np.sum(self.bgr_offset*w) / n
+        y_avg = y_avg.astype(source.dtype) if source.dtype.kind == 'f' else y_avg
+        return y_avg
+
+    def _compute_average_base(self, I0_normalized, source=None, chunk_bytes=2**26):
+        """
+        Compute the average of I/I0 (or I) and of 1/I0 (or 1) over the valid frames
+        (see set_frame_mask) chunk by chunk with float64 accumulation, as weighted sums
+        without materializing the normalized (or masked) stack. I is the source
+        intensity data (see _get_source), or self.I if source is None.
+        Returns a tuple of (I, I0, mean_I, mean_inv_I0, frame_mask), where I, I0 and
+        frame_mask are the source arrays used to validate the memoized result.
+        """
+        source = self.I if source is None else source
+        n = source.shape[0]
+        chunk_size = max(1, chunk_bytes // (8 * max(1, np.prod(source.shape[1:]))))
+        w = self._get_frame_weights(I0_normalized)
+        n_valid = np.count_nonzero(self.frame_mask) if self.frame_mask is not None else n
+        sum_I = np.zeros(source.shape[1:], dtype=np.float64)
+        for i in range(0, n, chunk_size):
+            sum_I += w[i:i+chunk_size] @ source[i:i+chunk_size].astype(np.float64)
+        mean_inv_I0 = np.sum(w) / n_valid
+        return (source, self.I0 if I0_normalized else None, sum_I / n_valid, mean_inv_I0, self.frame_mask)
+
+    def get_range_average_I(self, start, stop, I0_normalized=True, bgr_subtracted=True):
+        """
+        Get the average intensity data of the frames in the range [start, stop),
+        normalized by I0 if set. The average is computed in O(radial bins) from
+        cumulative sums along the frame axis, which are computed on the first call.
+        """
+        if self.I is None:
+            print("No intensity data loaded.")
+            return None
+        I0_normalized = I0_normalized and self.I0 is not None
+        if I0_normalized and self.I0.shape[0] != self.shape[0]:
+            print(f"I0 data shape {self.I0.shape} must match the number of frames {self.shape} in the azimuthal integration data.")
+            return None
+        start, stop = int(np.clip(start, 0, self.shape[0])), int(np.clip(stop, 0, self.shape[0]))
+        if stop <= start:
+            print(f"Invalid frame range [{start}, {stop}).")
+            return None
+        source = self._get_source(bgr_subtracted)
+        prefix = self._prefix_memo.get(I0_normalized)
+        if (prefix is None or prefix[0] is not source or (I0_normalized and prefix[1] is not self.I0)
+                or prefix[5] is not self.frame_mask):
+            prefix = self._compute_prefix_sums(I0_normalized, source)
+            self._prefix_memo[I0_normalized] = prefix
+        _, _, cumsum_I, cumsum_inv_I0, cumsum_n, _ = prefix
+        n = cumsum_n[stop] - cumsum_n[start]
+        if n == 0:
+            print(f"No valid frames in the range [{start}, {stop}).")
+            return None
+        y_avg = (cumsum_I[stop] - cumsum_I[start]) / n
+        if bgr_subtracted and self.y_bgr is not None and self.bgr_scale is not None:
+            # mean((I-a*y_bgr-c)/I0) = mean(I/I0) - y_bgr*mean(a/I0) - mean(c/I0)
+            w = self._get_frame_weights(I0_normalized, slice(start, stop))
+            y_avg = (y_avg - self.y_bgr * np.sum(self.bgr_scale[start:stop]*w) / n
+                     - np.sum(self.bgr_offset[start:stop]*w) / n)
+        elif bgr_subtracted and self.y_bgr is not None:
+            # mean((I-y_bgr)/I0) = mean(I/I0) - y_bgr*mean(1/I0)
+            y_avg = y_avg - self.y_bgr * (cumsum_inv_I0[stop] - cumsum_inv_I0[start]) / n
+        return y_avg.astype(source.dtype) if source.dtype.kind == 'f' else y_avg
+
+    def _compute_prefix_sums(self, I0_normalized, source=None, chunk_bytes=2**26):
+        """
+        Compute the cumulative sums of I/I0 (or I), of 1/I0 (or 1) and of the number of
+        valid frames (see set_frame_mask) along the frame axis chunk by chunk with float64
+        accumulation, prepended with zeros, such that the sum of frames [a, b) is
+        cumsum[b] - cumsum[a]. Masked frames do not contribute to the sums. I is the
+        source intensity data (see _get_source), or self.I if source is None.
+        Returns a tuple of (I, I0, cumsum_I, cumsum_inv_I0, cumsum_n, frame_mask), where
+        I, I0 and frame_mask are the source arrays used to validate the memoized result.
+        """
+        source = self.I if source is None else source
+        n = source.shape[0]
+        chunk_size = max(1, chunk_bytes // (8 * max(1, np.prod(source.shape[1:]))))
+        w = self._get_frame_weights(I0_normalized)
+        cumsum_I = np.zeros((n+1,) + source.shape[1:], dtype=np.float64)
+        for i in range(0, n, chunk_size):
+            I = source[i:i+chunk_size].astype(np.float64)
+            I *= w[i:i+chunk_size, None]
+            np.cumsum(I, axis=0, out=cumsum_I[i+1:i+1+I.shape[0]])
+            cumsum_I[i+1:i+1+I.shape[0]] += cumsum_I[i]
+        cumsum_inv_I0 = np.concatenate(([0.], np.cumsum(w)))
+        valid = self.frame_mask if self.frame_mask is not None else np.ones(n, dtype=bool)
+        cumsum_n = np.concatenate(([0], np.cumsum(valid)))
+        return (source, self.I0 if I0_normalized else None, cumsum_I, cumsum_inv_I0, cumsum_n, self.frame_mask)
+
+    def get_roi_sums(self, start, stop, I0_normalized=True, bgr_subtracted=True, linear_background=False):
+        """
+        Get the per-frame sums of I, x*I and x^2*I over the radial bins [start, stop),
+        normalized by I0 if set. If linear_background is True, a linear background
+        through the first and last bin of the roi is subtracted from each frame.
+        The sums are computed in O(frames) from cumulative sums of the raw intensities
+        along the radial axis, which are computed on the first call. The background
+        and I0 are applied algebraically, since sum((I-y_bgr)/I0) = (sum(I)-sum(y_bgr))/I0.
+        Returns a tuple of (number of bins, sum_I, sum_xI, sum_x2I) or None.
+        """
+        if self.I is None:
+            print("No intensity data loaded.")
+            return None
+        start, stop = int(np.clip(start, 0, self.shape[1])), int(np.clip(stop, 0, self.shape[1]))
+        if stop <= start:
+            print(f"Invalid radial range [{start}, {stop}).")
+            return None
+        source = self._get_source(bgr_subtracted)
+        prefix = self._radial_prefix_memo
+        if prefix is None or prefix[0] is not source or prefix[1] is not self.x:
+            prefix = self._compute_radial_prefix_sums(source)
+            self._radial_prefix_memo = prefix
+        _, x, cumsum_I, cumsum_xI, cumsum_x2I = prefix
+        x = np.asarray(x, dtype=np.float64)[start:stop]
+        m = stop - start
+        sum_I = cumsum_I[:, stop] - cumsum_I[:, start]
+        sum_xI = cumsum_xI[:, stop] - cumsum_xI[:, start]
+        sum_x2I = cumsum_x2I[:, stop] - cumsum_x2I[:, start]
+        first, last = source[:, start].astype(np.float64), source[:, stop-1].astype(np.float64)
+        if bgr_subtracted and self.y_bgr is not None:
+            # the background a*y_bgr + c is subtracted with a = 1 and c = 0 unless fitted
+            y_bgr = self.y_bgr[start:stop].astype(np.float64)
+            a, c = (self.bgr_scale, self.bgr_offset) if self.bgr_scale is not None else (1., 0.)
+            sum_I = sum_I - a*np.sum(y_bgr) - c*m
+            sum_xI = sum_xI - a*np.sum(x*y_bgr) - c*np.sum(x)
+            sum_x2I = sum_x2I - a*np.sum(x**2*y_bgr) - c*np.sum(x**2)
+            first, last = first - a*y_bgr[0] - c, last - a*y_bgr[-1] - c
+        if linear_background:
+            # the linear background is first*w0 + last*w1 with w1 = (j-start)/(m-1), w0 = 1-w1
+            w1 = np.arange(m)/(m-1) if m > 1 else np.zeros(1)
+            w0 = 1 - w1
+            sum_I = sum_I - first*np.sum(w0) - last*np.sum(w1)
+            sum_xI = sum_xI - first*np.sum(x*w0) - last*np.sum(x*w1)
+            sum_x2I = sum_x2I - first*np.sum(x**2*w0) - last*np.sum(x**2*w1)
+        if I0_normalized and self.I0 is not None:
+            if self.I0.shape[0] != self.shape[0]:
+                print(f"I0 data shape {self.I0.shape} must match the number of frames {self.shape} in the azimuthal integration data.")
+                return None
+            sum_I, sum_xI, sum_x2I = sum_I / self.I0, sum_xI / self.I0, sum_x2I / self.I0
+        return m, sum_I, sum_xI, sum_x2I
+
+    def get_roi_maps(self, rois, quantity="mean", is_Q=None, I0_normalized=True, bgr_subtracted=True,
+                     linear_background=False, ignore_negative=False, chunk_bytes=2**26):
+        """
+        Get a per-frame quantity for each of the radial rois, given as a list of
+        (start, stop) bin ranges, computed vectorized over all frames:
+        - 'mean': The mean intensity.
+        - 'area': The integrated intensity (sum of intensity times the mean bin width).
+        - 'centroid': The intensity weighted mean position.
+        - 'variance': The intensity weighted variance of the position (peak width).
+        The radial positions are given in Q if is_Q is True, in 2theta if False, or in the
+        native units of the data if None. Unless ignore_negative is True, the quantities are
+        computed from the radial prefix sums (see get_roi_sums), otherwise negative
+        intensities are set to zero and the sums are computed in a single chunked pass
+        over the stack. Both are shared by all rois.
+        Returns an array of shape (number of rois, frames) or None.
+        """
+        if self.I is None:
+            print("No intensity data loaded.")
+            return None
+        rois = [(int(start), int(stop)) for start, stop in rois]
+        sums = []
+        if ignore_negative:
+            x = np.asarray(self.x, dtype=np.float64)
+            n = self.shape[0]
+            sums = [(stop-start, np.zeros(n), np.zeros(n), np.zeros(n)) for start, stop in rois]
+            chunk_size = max(1, chunk_bytes // (8 * max(1, self.shape[1])))
+            for i in range(0, n, chunk_size):
+                I = self.get_I(index=slice(i, i+chunk_size), I0_normalized=I0_normalized, bgr_subtracted=bgr_subtracted)
+                if I is None:
+                    return None
+                for (start, stop), (_, sum_I, sum_xI, sum_x2I) in zip(rois, sums):
+                    I_roi = np.clip(I[:, start:stop], 0, None).astype(np.float64)
+                    sum_I[i:i+I_roi.shape[0]] = I_roi.sum(axis=1)
+                    sum_xI[i:i+I_roi.shape[0]] = I_roi @ x[start:stop]
+                    sum_x2I[i:i+I_roi.shape[0]] = I_roi @ x[start:stop]**2
+        else:
+            for start, stop in rois:
+                roi_sums = self.get_roi_sums(start, stop, I0_normalized=I0_normalized,
+                                             bgr_subtracted=bgr_subtracted, linear_background=linear_background)
+                if roi_sums is None:
+                    return None
+                sums.append(roi_sums)
+        maps = []
+        for (start, stop), roi_sums in zip(rois, sums):
+            z = self._get_roi_quantity(start, stop, roi_sums, quantity, is_Q)
+            if z is None:
+                return None
+            maps.append(z)
+        maps = np.array(maps, dtype=np.float64)
+        if self.frame_mask is not None:
+            maps[:, ~self.frame_mask] = np.nan
+        return maps
+
+    def _get_roi_quantity(self, start, stop, sums, quantity, is_Q=None):
+        """Get a roi quantity from the roi sums (m, sum_I, sum_xI, sum_x2I), see get_roi_maps."""
+        m, sum_I, sum_xI, sum_x2I = sums
+        if quantity == "mean":
+            return sum_I / m
+        # convert positions to the requested units using the local derivative of
+        # the conversion, since the moments are computed in the native units
+        convert, scale = None, 1.
+        if is_Q is not None and is_Q != self.is_q:
+            if self.E is None:
+                print("Energy not set. Cannot convert the radial units.")
+                return None
+            convert = (lambda x: tth_to_q(x, self.E)) if is_Q else (lambda x: q_to_tth(x, self.E))
+        x = np.asarray(self.x, dtype=np.float64)
+        dx = (x[stop-1] - x[start]) / (m-1) if m > 1 else np.mean(np.diff(x))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            centroid = sum_xI / sum_I
+            if convert is not None:
+                h = dx / 2
+                scale = (convert(centroid + h) - convert(centroid - h)) / (2*h)
+            if quantity == "area":
+                return sum_I * dx * scale
+            if quantity == "centroid":
+                return convert(centroid) if convert is not None else centroid
+            if quantity == "variance":
+                variance = sum_x2I / sum_I - centroid**2
+                return variance * scale**2
+        print(f"Unknown roi quantity '{quantity}'.")
+        return None
+
+    def _compute_radial_prefix_sums(self, source=None, chunk_bytes=2**26):
+        """
+        Compute the cumulative sums of I, x*I and x^2*I along the radial axis chunk by chunk
+        with float64 accumulation, prepended with zeros, such that the sum of bins
+        [a, b) is cumsum[:, b] - cumsum[:, a]. I is the source intensity data
+        (see _get_source), or self.I if source is None.
+        Returns a tuple of (I, x, cumsum_I, cumsum_xI, cumsum_x2I), where I and x are the
+        source arrays used to validate the memoized result.
+        """
+        source = self.I if source is None else source
+        n, m = source.shape[0], source.shape[1]
+        chunk_size = max(1, chunk_bytes // (8 * max(1, m)))
+        x = np.asarray(self.x, dtype=np.float64)
+        cumsum_I = np.zeros((n, m+1), dtype=np.float64)
+        cumsum_xI = np.zeros((n, m+1), dtype=np.float64)
+        cumsum_x2I = np.zeros((n, m+1), dtype=np.float64)
+        for i in range(0, n, chunk_size):
+            I = source[i:i+chunk_size].astype(np.float64)
+            np.cumsum(I, axis=1, out=cumsum_I[i:i+I.shape[0], 1:])
+            np.cumsum(I*x, axis=1, out=cumsum_xI[i:i+I.shape[0], 1:])
+            np.cumsum(I*x**2, axis=1, out=cumsum_x2I[i:i+I.shape[0], 1:])
+        return (source, self.x, cumsum_I, cumsum_xI, cumsum_x2I)
 
     def get_I_error(self, index=None, I0_normalized=True):
         """
@@ -226,10 +1245,15 @@ class AzintData():
         if self.I_error is None:
             return None
         I_error = self.get_I_error(index=None, I0_normalized=I0_normalized)
-        return np.mean(I_error, axis=0) if I_error is not None else None
+        if I_error is None:
+            return None
+        if self.frame_mask is not None:
+            return self.frame_mask @ I_error / np.count_nonzero(self.frame_mask)
+        return np.mean(I_error, axis=0)
 
     def set_y_bgr(self, y_bgr):
-        """Set the background intensity data."""
+        """Set the background intensity data, removing any fitted scale and offset."""
+        self.clear_bgr_scale()
         if y_bgr is None:
             self.y_bgr = None
             return
@@ -247,6 +1271,9 @@ class AzintData():
         
     def set_I0(self, I0):
         """Set the I0 data."""
+        self.pipeline.invalidate("normalize")
+        self._average_memo.pop(True, None)
+        self._prefix_memo.pop(True, None)
         if isinstance(I0, np.ndarray):
             self.I0 = I0
         elif isinstance(I0, (list, tuple)):
@@ -254,6 +1281,13 @@ class AzintData():
         else:
             print("I0 data must be a numpy array or a list/tuple.")
             return
+        if self.reduction_factor > 1:
+            # keep the unreduced I0 data aligned with the reduction pyramid
+            if self.I0.shape[0] == self._pyramid[1][0].shape[0]:
+                self._raw_I0 = self.I0
+                self.I0 = average_blocks(self.I0, reduction_factor=self.reduction_factor)
+            else:
+                self._raw_I0 = None
         
         if self.I is None:
             # Don't normalize (yet)
@@ -263,21 +1297,72 @@ class AzintData():
             print(f"I0 data shape {self.I0.shape} must match the number of frames {self.I.shape} in the azimuthal integration data.")
             return
     
-    def export_pattern(self, fname, index, is_Q=False, I0_normalized=True, kwargs={}):
+    def get_processing_params(self):
+        """
+        Get a dictionary describing the current processing of the intensity data,
+        used to key derived products in the derived product cache.
+        """
+        def digest(arr):
+            if arr is None:
+                return None
+            return hashlib.sha1(np.ascontiguousarray(arr).tobytes()).hexdigest()
+        return {"shape": self.shape,
+                "x": digest(self.x),
+                "reduction_factor": self.reduction_factor,
+                "I0": digest(self.I0),
+                "y_bgr": digest(self.y_bgr),
+                "bgr_scale": digest(self.bgr_scale),
+                "bgr_offset": digest(self.bgr_offset),
+                "frame_mask": digest(self.frame_mask),
+                "bgr_stack": self.bgr_stack_params if self.use_bgr_stack else None,
+                "despike": self.despike_params,
+                "smooth": self.smooth_params,
+                }
+
+    def get_derived_cache(self):
+        """Get the derived product cache of the loaded file(s), or None if unavailable."""
+        if self._derived_cache is None and self.fnames:
+            try:
+                self._derived_cache = DerivedCache(self.fnames)
+            except Exception as e:
+                print(f"Derived product cache unavailable: {e}")
+                self._derived_cache = False
+        return self._derived_cache or None
+
+    def load_derived(self, name, params=None):
+        """
+        Load a derived product (e.g. 'average', 'correlation') from the cache,
+        keyed by the current processing parameters and the optional params.
+        Returns None if the product is not cached.
+        """
+        cache = self.get_derived_cache()
+        if cache is None or self.I is None:
+            return None
+        return cache.load(name, {**self.get_processing_params(), **(params or {})})
+
+    def save_derived(self, name, data, params=None):
+        """
+        Save a derived product to the cache, keyed by the current processing
+        parameters and the optional params.
+        """
+        cache = self.get_derived_cache()
+        if cache is None or self.I is None:
+            return False
+        return cache.save(name, data, {**self.get_processing_params(), **(params or {})})
+
+    def export_pattern(self, fname, index, is_Q=False, I0_normalized=True, radial_factor=1, kwargs={}):
         """
         Export the azimuthal integration data at the current index to a text file.  
         If I0_normalized is True, normalize the intensity data by I0.  
+        The data are binned radially by radial_factor (see get_binned_I).  
         kwargs passed to np.savetxt  
         """
         if self.I is None:
             print("No intensity data loaded.")
             return False
-        if is_Q:
-            x = self.get_q()
-        else:
-            x = self.get_tth()
-        y = self.get_I(index=index, I0_normalized=I0_normalized)
-        y_e = self.get_I_error(index=index, I0_normalized=I0_normalized)
+        x = self.get_binned_x(is_Q=is_Q, radial_factor=radial_factor)
+        y = self.get_binned_I(index=index, radial_factor=radial_factor, I0_normalized=I0_normalized)
+        y_e = self.get_binned_I_error(index=index, radial_factor=radial_factor, I0_normalized=I0_normalized)
         if x is None or y is None:
             print("Error retrieving data for export.")
             return False
@@ -285,21 +1370,19 @@ class AzintData():
         export_xy(fname,x,y,y_e, kwargs)
         return True
     
-    def export_average_pattern(self, fname, is_Q=False, I0_normalized=True, kwargs={}):
+    def export_average_pattern(self, fname, is_Q=False, I0_normalized=True, radial_factor=1, kwargs={}):
         """
         Export the average azimuthal integration data to a text file.  
         If I0_normalized is True, normalize the intensity data by I0.  
+        The data are binned radially by radial_factor (see get_binned_I).  
         kwargs passed to np.savetxt  
         """
         if self.I is None:
             print("No intensity data loaded.")
             return False
-        if is_Q:
-            x = self.get_q()
-        else:
-            x = self.get_tth()
-        y = self.get_average_I(I0_normalized=I0_normalized)
-        y_e = self.get_average_I_error(I0_normalized=I0_normalized)
+        x = self.get_binned_x(is_Q=is_Q, radial_factor=radial_factor)
+        y = self._bin(self.get_average_I(I0_normalized=I0_normalized), average_blocks, radial_factor)
+        y_e = self._bin(self.get_average_I_error(I0_normalized=I0_normalized), average_blocks_error, radial_factor)
         
         if x is None or y is None:
             print("Error retrieving data for export.")
@@ -308,6 +1391,75 @@ class AzintData():
         export_xy(fname,x,y,y_e, kwargs)
         return True
     
+    def export_range_average_pattern(self, fname, start, stop, is_Q=False, I0_normalized=True, radial_factor=1, kwargs={}):
+        """
+        Export the average azimuthal integration data of the frames in the range
+        [start, stop) to a text file.  
+        If I0_normalized is True, normalize the intensity data by I0.  
+        The data are binned radially by radial_factor (see get_binned_I).  
+        kwargs passed to np.savetxt  
+        """
+        if self.I is None:
+            print("No intensity data loaded.")
+            return False
+        x = self.get_binned_x(is_Q=is_Q, radial_factor=radial_factor)
+        y = self._bin(self.get_range_average_I(start, stop, I0_normalized=I0_normalized), average_blocks, radial_factor)
+        y_e = self.get_I_error(index=slice(start, stop), I0_normalized=I0_normalized)
+        if y_e is not None and self.frame_mask is not None:
+            valid = self.frame_mask[start:stop]
+            y_e = valid @ y_e / max(np.count_nonzero(valid), 1)
+        elif y_e is not None:
+            y_e = np.mean(y_e, axis=0)
+        y_e = self._bin(y_e, average_blocks_error, radial_factor)
+
+        if x is None or y is None:
+            print("Error retrieving data for export.")
+            return False
+
+        export_xy(fname,x,y,y_e, kwargs)
+        return True
+
+    def export_nxazint1d(self, fname, is_Q=False, I0_normalized=True, aux_data=None, chunk_size=256, progress=None,
+                         radial_factor=1):
+        """
+        Export the processed (I0-normalized, background-subtracted and reduced)
+        intensity data to a chunked and compressed NXazint1d HDF5 file.
+        The stack is processed, binned radially by radial_factor (see get_binned_I)
+        and written chunk_size frames at a time.
+        aux_data is an optional dictionary of auxiliary 1D data {alias: np.ndarray}.
+        progress is passed to plaid.io.export_nxazint1d.
+        Returns True if successful, False if the export failed and None if it was interrupted.
+        """
+        if self.I is None:
+            print("No intensity data loaded.")
+            return False
+        x = self.get_binned_x(is_Q=is_Q, radial_factor=radial_factor)
+        if x is None:
+            print("Error retrieving data for export.")
+            return False
+        n = self.shape[0]
+        frames = (self._mask_frames(self.get_binned_I(index=slice(i, i+chunk_size), radial_factor=radial_factor,
+                                                      I0_normalized=I0_normalized), slice(i, i+chunk_size))
+                  for i in range(0, n, chunk_size))
+        errors = None
+        if self.I_error is not None:
+            errors = (self._mask_frames(self.get_binned_I_error(index=slice(i, i+chunk_size), radial_factor=radial_factor,
+                                                                I0_normalized=I0_normalized), slice(i, i+chunk_size))
+                      for i in range(0, n, chunk_size))
+        # only save the monitor if the data are not already normalized
+        I0 = self.I0 if not I0_normalized else None
+        return export_nxazint1d(fname, x, frames, n, is_Q=is_Q, errors=errors, energy=self.E,
+                                I0=I0, aux_data=aux_data, map_shape=self.map_shape,
+                                map_indices=self.map_indices, instrument_name=self.instrument_name,
+                                source_name=self.source_name, progress=progress)
+
+    def _mask_frames(self, I, index):
+        """Set the frames I (selected by the slice index) masked by the frame mask to NaN."""
+        if self.frame_mask is None or I is None or np.all(self.frame_mask[index]):
+            return I
+        I_masked = np.where(self.frame_mask[index, None], I, np.nan)
+        return I_masked.astype(I.dtype, copy=False) if I.dtype.kind == 'f' else I_masked
+
     def get_info_string(self):
         """Get the instrument (and source) name from the azimuthal integration data."""
         name = ""
@@ -329,6 +1481,10 @@ class AzintData():
             if name:
                 name += " - "
             name += f"reduced x{self.reduction_factor}"
+        if self.frame_mask is not None:
+            if name:
+                name += " - "
+            name += f"{np.count_nonzero(~self.frame_mask)} frames masked"
         return name
 
 class AuxData:
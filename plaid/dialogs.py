@@ -17,7 +17,117 @@ from PyQt6 import QtCore
 import pyqtgraph as pg
 import h5py as h5
 import numpy as np
+import os
 import re
+import threading
+
+# cache of HDF5 path search indices {(file path, size, mtime): [(path, shape, NX_class, long_name, search text), ...]}
+# in the order of last use, see _get_h5_index and _store_h5_index
+_H5_INDEX_CACHE = {}
+_H5_INDEX_CACHE_SIZE = 8  # Maximum number of indexed files kept in the cache
+_H5_INDEX_LOCK = threading.Lock()  # The cache is updated from the index worker threads
+# running index workers, kept alive until finished
+_H5_INDEX_WORKERS = set()
+
+
+def _get_h5_index_key(fname):
+    """Get the search index cache key of an HDF5 file, or None if the file is not found."""
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return None
+    return (os.path.abspath(fname), stat.st_size, stat.st_mtime_ns)
+
+
+def _get_h5_index(key):
+    """Get a cached search index, marking it as recently used, or None if not cached."""
+    with _H5_INDEX_LOCK:
+        index = _H5_INDEX_CACHE.pop(key, None)
+        if index is not None:
+            _H5_INDEX_CACHE[key] = index
+        return index
+
+
+def _store_h5_index(key, index):
+    """
+    Store a search index in the cache, replacing outdated indices of the same file
+    and evicting the least recently used indices beyond _H5_INDEX_CACHE_SIZE files.
+    """
+    with _H5_INDEX_LOCK:
+        for k in [k for k in _H5_INDEX_CACHE if k[0] == key[0]]:
+            del _H5_INDEX_CACHE[k]
+        _H5_INDEX_CACHE[key] = index
+        for k in list(_H5_INDEX_CACHE)[:max(0, len(_H5_INDEX_CACHE) - _H5_INDEX_CACHE_SIZE)]:
+            del _H5_INDEX_CACHE[k]
+
+
+class H5IndexWorker(QtCore.QThread):
+    """
+    A QThread worker that builds a search index of all datasets in an HDF5 file
+    in the background. Each index entry is a tuple of
+    (path, shape, NX_class, long_name, search text), where NX_class is the
+    class of the parent group and the search text is a lower case concatenation
+    of the other fields. The index is stored in the module level cache when finished
+    (see _store_h5_index).
+    """
+    sigFinished = QtCore.pyqtSignal(bool, object)  # success(bool), index or exception
+
+    def __init__(self, fname):
+        super().__init__()
+        self.fname = fname
+        self.finished.connect(self._cleanup)
+
+    def start(self):
+        """Start building the index in the background."""
+        _H5_INDEX_WORKERS.add(self)
+        super().start()
+
+    def run(self):
+        """Build the index. Executed in the background thread."""
+        try:
+            key = _get_h5_index_key(self.fname)
+            index = []
+            group_classes = {}
+
+            def decode(value):
+                if isinstance(value, bytes):
+                    return value.decode('utf-8', errors='replace')
+                return str(value) if value is not None else ""
+
+            def visit(name):
+                # use the low-level API, as creating high-level objects for
+                # every node is slow for files with many nodes
+                obj = h5.h5o.open(f.id, name)
+                name = name.decode('utf-8', errors='replace')
+                if isinstance(obj, h5.h5g.GroupID):
+                    if h5.h5a.exists(obj, b'NX_class'):
+                        group_classes[name] = decode(h5.Group(obj).attrs['NX_class'])
+                    return
+                if not isinstance(obj, h5.h5d.DatasetID):
+                    return
+                parent = name.rpartition('/')[0]
+                nx_class = group_classes.get(parent, "")
+                long_name = ""
+                if h5.h5a.exists(obj, b'long_name'):
+                    long_name = decode(h5.Dataset(obj).attrs['long_name'])
+                dims = [str(s) for s in obj.shape]
+                shape = ' × '.join(dims)
+                # search the shape both as displayed and typed, e.g. '100x2000'
+                text = f"{name} {nx_class} {long_name} {shape} {'x'.join(dims)}".lower()
+                index.append((name, shape, nx_class, long_name, text))
+
+            with h5.File(self.fname, 'r') as f:
+                h5.h5o.visit(f.id, visit)
+            if key is not None:
+                _store_h5_index(key, index)
+            self.sigFinished.emit(True, index)
+        except Exception as e:
+            self.sigFinished.emit(False, e)
+
+    def _cleanup(self):
+        self.wait()
+        _H5_INDEX_WORKERS.discard(self)
+
 
 
 class H5Dialog(QDialog):
@@ -57,6 +167,23 @@ class H5Dialog(QDialog):
         self.mode = mode
         self.setWindowTitle("Select HDF5 Content")
         self.setLayout(QVBoxLayout())
+
+        # add a search box to find datasets by path, NX_class, long_name or shape
+        self.search_index = None
+        self.search_box = QLineEdit()
+        self.search_box.setPlaceholderText("Search datasets...")
+        self.search_box.setClearButtonEnabled(True)
+        self.search_box.textChanged.connect(self.search)
+        self.layout().addWidget(self.search_box)
+
+        # add a search result tree, shown in place of the file tree while searching
+        self.search_tree = QTreeWidget()
+        self.search_tree.setHeaderLabels(['Path', 'Shape'])
+        self.search_tree.setSortingEnabled(False)
+        self.search_tree.setRootIsDecorated(False)
+        self.search_tree.setVisible(False)
+        self.layout().addWidget(self.search_tree,2)
+        self.search_tree.itemDoubleClicked.connect(self.item_double_clicked)
         
         # add a file tree to the dialog
         self.file_tree = QTreeWidget()
@@ -64,11 +191,13 @@ class H5Dialog(QDialog):
         self.file_tree.setSortingEnabled(False)
         self.layout().addWidget(self.file_tree,2)
         self.file_tree.itemDoubleClicked.connect(self.item_double_clicked)
+        self.file_tree.itemExpanded.connect(self._item_expanded)
         if isinstance(file_path, str):
             with h5.File(file_path, 'r') as file:
                 self._populate_tree(file)
         else:
             self._populate_tree(file_path)
+        self._start_indexing()
         self.file_tree.header().setSectionResizeMode(1,self.file_tree.header().ResizeMode.Fixed)
         self.file_tree.header().setStretchLastSection(False)
 
@@ -139,11 +268,12 @@ class H5Dialog(QDialog):
             elif self.mode == 'any':
                 # If any dataset is allowed, proceed
                 pass
-            alias, shape = item.text(0) , item.text(1)
-            if alias == "data" or alias == "value":
-                alias = item.parent().text(0)  # Use the parent name as alias if it's a data or value item
             # get the full path of the item
             full_path = self._get_path(item)
+            shape = item.text(1)
+            alias = full_path.split('/')[-1]
+            if (alias == "data" or alias == "value") and '/' in full_path:
+                alias = full_path.split('/')[-2]  # Use the parent name as alias if it's a data or value item
             # check if the item is already in the selected tree
             for i in range(self.selected_tree.topLevelItemCount()):
                 selected_item = self.selected_tree.topLevelItem(i)
@@ -231,57 +361,134 @@ class H5Dialog(QDialog):
 
     def _populate_tree(self, f):
         """
-        Populate the tree with the content of the HDF5 file as a tree structure
-        with two columns: the item name and its shape.
+        Populate the tree with the top level content of the HDF5 file as a tree
+        structure with two columns: the item name and its shape.
+        The content of groups is populated lazily when the item is expanded.
         """
         # with h5.File(file_path, 'r') as f:
-        for key in f.keys():
-            shape = f[key].shape if hasattr(f[key], 'shape') and len(f[key].shape) else ""
-            item = QTreeWidgetItem([key, self._shape_to_str(shape)])
-            self.file_tree.addTopLevelItem(item)
-            if isinstance(f[key], h5.Group):
-                has_child_with_shape = self._populate_item(item, f[key])
-            #if not has_child_with_shape:
-                # If no child has a shape, set the item to a lighter color
-                # item.setForeground(0, pg.mkColor("#AAAAAA"))
+        self._populate_item(self.file_tree.invisibleRootItem(), f)
 
     def _populate_item(self, parent_item, group):
         """
-        Recursively populate the tree with the content of a group.
+        Populate the tree with the (immediate) content of a group.
         Each item is represented by a QTreeWidgetItem with two columns:
         the item name and its shape.
-        If the item has no shape and no children with a shape, it is set to a lighter color.
-        If the item throws a KeyError (e.g. dead links), it is set to a red color.
+        Groups are given an expand indicator and are populated when expanded,
+        see _item_expanded. Empty groups and scalar datasets are set to a lighter
+        color. If the item throws a KeyError (e.g. dead links), it is set to a red color.
         Returns True if any child has a shape, otherwise False.
         """
         has_child_with_shape = False
         for key in group.keys():
             try:
-                shape = group[key].shape if hasattr(group[key], 'shape') and len(group[key].shape) else ""
-                item = QTreeWidgetItem([key, self._shape_to_str(shape)])
-                parent_item.addChild(item)
-                if isinstance(group[key], h5.Group):
-                    _has_child_with_shape = self._populate_item(item, group[key])
-                    has_child_with_shape = has_child_with_shape or _has_child_with_shape
-                elif isinstance(group[key], h5.Dataset):
+                obj = group[key]
+                if isinstance(obj, h5.Group):
+                    item = QTreeWidgetItem([key, ""])
+                    parent_item.addChild(item)
+                    if len(obj) > 0:
+                        # show the expand indicator, children are populated on expansion
+                        item.setChildIndicatorPolicy(QTreeWidgetItem.ChildIndicatorPolicy.ShowIndicator)
+                        item.setData(0, QtCore.Qt.ItemDataRole.UserRole, False)
+                    else:
+                        item.setForeground(0, pg.mkColor("#AAAAAA"))
+                else:
+                    shape = obj.shape if hasattr(obj, 'shape') and obj.shape else ""
+                    item = QTreeWidgetItem([key, self._shape_to_str(shape)])
+                    parent_item.addChild(item)
                     if shape:
                         has_child_with_shape = True
                     else:
                         item.setForeground(0, pg.mkColor("#AAAAAA"))
-                if not has_child_with_shape:
-                    # If no child has a shape, set the item to a lighter color
-                    item.setForeground(0, pg.mkColor("#AAAAAA"))
             except KeyError:
                 item = QTreeWidgetItem([key, str("")])
                 parent_item.addChild(item)
                 item.setForeground(0, pg.mkColor("#AA0000"))  # Set to red if key is not found
-        if not has_child_with_shape:
-            # If no child has a shape, set the parent item to a lighter color
-            parent_item.setForeground(0, pg.mkColor("#AAAAAA"))
         return has_child_with_shape
 
+    def _item_expanded(self, item):
+        """
+        Populate the children of a group item the first time it is expanded.
+        Called when an item in the file tree is expanded.
+        """
+        if item.data(0, QtCore.Qt.ItemDataRole.UserRole) is not False:
+            # already populated (or not a group)
+            return
+        item.setData(0, QtCore.Qt.ItemDataRole.UserRole, True)
+        item.setChildIndicatorPolicy(QTreeWidgetItem.ChildIndicatorPolicy.DontShowIndicatorWhenChildless)
+        path = self._get_path(item)
+        try:
+            if isinstance(self.file_path, str):
+                with h5.File(self.file_path, 'r') as f:
+                    self._populate_item(item, f[path])
+            else:
+                self._populate_item(item, self.file_path[path])
+        except Exception as e:
+            print(f"Error reading {path}: {e}")
+            item.setForeground(0, pg.mkColor("#AA0000"))
+
+    def _start_indexing(self):
+        """
+        Start building the search index of the file in a background thread,
+        or use the cached index if the file has been indexed before.
+        """
+        fname = self.file_path if isinstance(self.file_path, str) else getattr(self.file_path, 'filename', None)
+        key = _get_h5_index_key(fname) if fname else None
+        if key is None:
+            self.search_box.setEnabled(False)
+            return
+        self.search_index = _get_h5_index(key)
+        if self.search_index is not None:
+            return
+        self.search_box.setPlaceholderText("Search datasets... (indexing)")
+        self._index_worker = H5IndexWorker(fname)
+        self._index_worker.sigFinished.connect(self._indexing_done)
+        self._index_worker.start()
+
+    def _indexing_done(self, success, result):
+        """Handle the finished search index worker."""
+        self._index_worker = None
+        if not success:
+            print(f"Error indexing {self.file_path}: {result}")
+            self.search_box.setPlaceholderText("Search unavailable")
+            self.search_box.setEnabled(False)
+            return
+        self.search_index = result
+        self.search_box.setPlaceholderText("Search datasets...")
+        # update any search typed while indexing
+        self.search(self.search_box.text())
+
+    def search(self, text, max_results=1000):
+        """
+        Search the indexed datasets for all space-separated terms in text
+        (case insensitive), matching the dataset path, the NX_class of the parent
+        group, the long_name attribute and the shape (e.g. '2000' or '100x2000').
+        Called when the search text is changed.
+        """
+        terms = text.lower().split()
+        self.search_tree.setVisible(bool(terms))
+        self.file_tree.setVisible(not terms)
+        self.search_tree.clear()
+        if not terms or self.search_index is None:
+            return
+        items = []
+        for path, shape, nx_class, long_name, search_text in self.search_index:
+            if all(term in search_text for term in terms):
+                item = QTreeWidgetItem([path, shape])
+                item.setData(0, QtCore.Qt.ItemDataRole.UserRole, path)
+                tooltip = "\n".join([f"{label}: {value}" for label, value in
+                                      (("NX_class", nx_class), ("long_name", long_name)) if value])
+                item.setToolTip(0, tooltip or path)
+                if not shape:
+                    item.setForeground(0, pg.mkColor("#AAAAAA"))
+                items.append(item)
+                if len(items) >= max_results:
+                    break
+        self.search_tree.addTopLevelItems(items)
+
     def _get_path(self, item):
         """Get the full path of the item."""
+        if item.treeWidget() is self.search_tree:
+            return item.data(0, QtCore.Qt.ItemDataRole.UserRole)
         path = item.text(0)
         parent = item.parent()
         while parent is not None:
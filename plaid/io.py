@@ -13,9 +13,14 @@ edit the USER_FILE_PARSER.py file in the plaid directory.
 
 """
 import os
+import json
+import hashlib
+import tempfile
+import threading
+import time
 import h5py as h5
 import numpy as np
-from PyQt6.QtCore import pyqtSignal, QObject, QThread, pyqtSlot
+from PyQt6.QtCore import pyqtSignal, QObject, QThread, pyqtSlot, QStandardPaths
 from nexus import *
 from dialogs import H5Dialog
 from plaid.misc import get_map_shape_and_indices
@@ -157,6 +162,47 @@ class ReadWorker(QObject):
         except Exception:
             pass
         
+class TaskWorker(QObject):
+    """
+    A QObject worker that runs a callable func(*args, progress=progress, **kwargs)
+    in a background thread, e.g. an analysis of the stack (see plaid.analysis).
+    The callable should only access arrays that are not modified while it runs.
+    The progress callable passed to func emits sigProgress and returns False if
+    the task has been cancelled. The signals are delivered in the GUI thread.
+    """
+    sigFinished = pyqtSignal(bool, object)  # success(bool), result or exception
+    sigProgress = pyqtSignal(int)  # progress in 0-100
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._thread = None
+        self.cancelled = False
+
+    def is_running(self):
+        """Return True if a task is running."""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, func, *args, **kwargs):
+        """Start the task in a new thread."""
+        if self.is_running():
+            raise RuntimeError('Worker already running')
+        self.cancelled = False
+        self._thread = threading.Thread(target=self._run, args=(func, args, kwargs), daemon=True)
+        self._thread.start()
+
+    def _run(self, func, args, kwargs):
+        """Execute the callable and emit the result."""
+        try:
+            result = func(*args, progress=self._progress, **kwargs)
+            self.sigFinished.emit(result is not None and not self.cancelled, result)
+        except Exception as e:
+            self.sigFinished.emit(False, e)
+
+    def _progress(self, fraction):
+        """Progress callback passed to the task."""
+        self.sigProgress.emit(int(fraction*100))
+        return not self.cancelled
+
 def read_from_dict(f, file_dict):
     """Read datasets from an HDF5 file based on a provided file dictionary."""
     data = {}
@@ -322,6 +368,299 @@ def load_file(fname, parent=None):
             data_dict.update(read_from_dict(f, file_dict))
     return data_dict
 
+def get_sidecar_path(fname, tag):
+    """
+    Get the path of a small sidecar HDF5 file next to fname, e.g.
+    /data/scan.h5 -> /data/scan_<tag>.h5. If the directory of fname
+    is not writable, the sidecar is placed in the temporary directory.
+    """
+    root, _ = os.path.splitext(os.path.abspath(fname))
+    sidecar = f"{root}_{tag}.h5"
+    if not os.access(os.path.dirname(sidecar), os.W_OK):
+        sidecar = os.path.join(tempfile.gettempdir(), os.path.basename(sidecar))
+    return sidecar
+
+def get_cache_dir():
+    """
+    Get the user cache directory of plaid, e.g. ~/.cache/plaid on Linux,
+    falling back to the temporary directory.
+    """
+    root = QStandardPaths.writableLocation(QStandardPaths.StandardLocation.GenericCacheLocation)
+    cache_dir = os.path.join(root or tempfile.gettempdir(), "plaid")
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        cache_dir = tempfile.gettempdir()
+    return cache_dir
+
+class DerivedCache():
+    """
+    An HDF5 cache for derived products (average patterns, correlation
+    matrices, ...) of one or more source files.
+    Products are stored in NXprocess groups keyed by the identity of the source
+    files (path, size and modification time) and the processing parameters, so
+    that they can be loaded on reopen instead of being recomputed. Groups with
+    an outdated source identity are removed when the cache is opened, and the
+    least recently used groups are evicted when the cache exceeds max_groups or
+    max_total_bytes.
+    The cache file is placed in the user cache directory (see get_cache_dir),
+    or next to the first source file if next_to_data is True.
+    Parameters:
+    - fnames: A list of source file names.
+    - sidecar: The cache file name. Default is determined by next_to_data.
+    """
+    max_bytes = 512 * 1024**2  # Do not cache products larger than this (bytes)
+    max_total_bytes = 2 * 1024**3  # Evict the least recently used groups beyond this size (bytes)
+    max_groups = 64  # Evict the least recently used groups beyond this number of groups
+    next_to_data = False  # Place the cache file next to the source file instead of the user cache directory
+
+    def __init__(self, fnames, sidecar=None):
+        if isinstance(fnames, str):
+            fnames = [fnames]
+        self.fnames = [os.path.abspath(f) for f in fnames]
+        if sidecar is None:
+            tag = "plaid_cache" if len(fnames) == 1 else f"group{len(fnames)}_plaid_cache"
+            if self.next_to_data:
+                sidecar = get_sidecar_path(fnames[0], tag)
+            else:
+                # name the cache file from all source paths, so different groups do not collide
+                digest = hashlib.sha1("\n".join(self.fnames).encode('utf-8')).hexdigest()[:12]
+                root, _ = os.path.splitext(os.path.basename(self.fnames[0]))
+                sidecar = os.path.join(get_cache_dir(), f"{root}_{digest}_{tag}.h5")
+        self.sidecar = sidecar
+        self.identity = self._get_identity()
+        self._prune()
+
+    def _get_identity(self):
+        """Get a string identifying the current state of the source files."""
+        identity = []
+        for fname in self.fnames:
+            stat = os.stat(fname)
+            identity.append(f"{fname}|{stat.st_size}|{stat.st_mtime_ns}")
+        return ";".join(identity)
+
+    def _prune(self):
+        """Remove cached groups with an outdated source identity."""
+        if not os.path.exists(self.sidecar):
+            return
+        try:
+            with h5.File(self.sidecar, 'a') as f:
+                for key in list(f.keys()):
+                    if f[key].attrs.get('source_identity', '') != self.identity:
+                        del f[key]
+        except Exception as e:
+            print(f"Error pruning the cache {self.sidecar}: {e}")
+        self._repack()
+
+    def _evict(self, f):
+        """Remove the least recently used groups of the open cache file f beyond the size bounds."""
+        groups = []
+        for key in f.keys():
+            nbytes = sum(dset.id.get_storage_size() for dset in f[key].values() if isinstance(dset, h5.Dataset))
+            groups.append((f[key].attrs.get('last_access', 0.), key, nbytes))
+        groups.sort()
+        total = sum(nbytes for _, _, nbytes in groups)
+        while groups and (len(groups) > self.max_groups or total > self.max_total_bytes):
+            _, key, nbytes = groups.pop(0)
+            del f[key]
+            total -= nbytes
+
+    def _repack(self):
+        """
+        Rewrite the cache file if much of it is unused, as HDF5 does not
+        reclaim the space of deleted groups.
+        """
+        if not os.path.exists(self.sidecar):
+            return
+        try:
+            with h5.File(self.sidecar, 'r') as f:
+                used = sum(dset.id.get_storage_size() for gr in f.values()
+                           for dset in gr.values() if isinstance(dset, h5.Dataset))
+            if os.path.getsize(self.sidecar) < 2 * used + 2**20:
+                return
+            tmp = self.sidecar + ".tmp"
+            with h5.File(self.sidecar, 'r') as src, h5.File(tmp, 'w') as dst:
+                for key in src.keys():
+                    src.copy(src[key], dst, name=key)
+            os.replace(tmp, self.sidecar)
+        except Exception as e:
+            print(f"Error repacking the cache {self.sidecar}: {e}")
+
+    def get_key(self, params):
+        """Get the group name for a dictionary of processing parameters."""
+        text = json.dumps({"identity": self.identity, "params": params}, sort_keys=True, default=str)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def load(self, name, params):
+        """Load a cached product by name and processing parameters. Returns None if not cached."""
+        if not os.path.exists(self.sidecar):
+            return None
+        key = self.get_key(params)
+        data = None
+        try:
+            with h5.File(self.sidecar, 'r') as f:
+                if key in f and name in f[key]:
+                    data = f[key][name][()]
+        except Exception as e:
+            print(f"Error reading {name} from the cache {self.sidecar}: {e}")
+        if data is not None:
+            # mark the group as recently used
+            try:
+                with h5.File(self.sidecar, 'r+') as f:
+                    f[key].attrs['last_access'] = time.time()
+            except Exception:
+                pass
+        return data
+
+    def save(self, name, data, params):
+        """Save a product by name and processing parameters. Returns True if successful."""
+        if data is None or np.asarray(data).nbytes > self.max_bytes:
+            return False
+        from plaid import __version__ as plaid_version
+        key = self.get_key(params)
+        try:
+            with h5.File(self.sidecar, 'a') as f:
+                if key not in f:
+                    gr = f.create_group(key)
+                    gr.attrs['NX_class'] = 'NXprocess'
+                    gr.attrs['source_identity'] = self.identity
+                    gr['program'] = 'plaid'
+                    gr['version'] = plaid_version
+                    gr['parameters'] = json.dumps(params, sort_keys=True, default=str)
+                gr = f[key]
+                gr.attrs['last_access'] = time.time()
+                if name in gr:
+                    del gr[name]
+                data = np.asarray(data)
+                if data.ndim > 1:
+                    gr.create_dataset(name, data=data, compression='gzip', shuffle=True)
+                else:
+                    gr.create_dataset(name, data=data)
+                self._evict(f)
+        except Exception as e:
+            print(f"Error writing {name} to the cache {self.sidecar}: {e}")
+            return False
+        self._repack()
+        return True
+
+def export_nxazint1d(fname, x, frames, n_frames, is_Q=False, errors=None, energy=None,
+                     I0=None, aux_data=None, map_shape=None, map_indices=None,
+                     instrument_name=None, source_name=None, progress=None):
+    """
+    Export a (processed) stack of azimuthal integration data to a chunked and
+    compressed NXazint1d HDF5 file, following the conventions read by plaid.nexus.
+    The data are written chunk by chunk, so the full stack is never held in memory.
+    Parameters:
+        fname (str): The file name to save the data to.
+        x (np.ndarray): The radial axis data (2theta or q).
+        frames (iterable): Iterable of 2D intensity chunks (frames, radial bins).
+        n_frames (int): The total number of frames in the stack.
+        is_Q (bool, optional): Whether the radial axis is q (True) or 2theta (False).
+        errors (iterable, optional): Iterable of 2D intensity error chunks, matching frames.
+        energy (float, optional): The energy in keV.
+        I0 (np.ndarray, optional): The monitor data, saved as an NXmonitor group.
+        aux_data (dict, optional): Auxiliary 1D data {alias: np.ndarray}, saved in an NXcollection.
+        map_shape (tuple, optional): The map shape, saved as sample translations.
+        map_indices (list, optional): The map pixel index of each frame.
+        instrument_name (str, optional): The name of the instrument.
+        source_name (str, optional): The name of the source.
+        progress (callable, optional): Called with the number of frames written. If it
+                                       returns False, the export is interrupted.
+    Returns:
+        bool or None: True if the export was successful, False if it failed and None
+                      if it was interrupted. The partial file is removed in both cases.
+    """
+    try:
+        completed = _write_nxazint1d(fname, x, frames, n_frames, is_Q, errors, energy, I0, aux_data,
+                                     map_shape, map_indices, instrument_name, source_name, progress)
+    except Exception as e:
+        print(f"Error exporting to {fname}: {e}")
+        completed = False
+    if not completed and os.path.exists(fname):
+        os.remove(fname)
+    return True if completed else (None if completed is None else False)
+
+def _write_nxazint1d(fname, x, frames, n_frames, is_Q, errors, energy, I0, aux_data,
+                     map_shape, map_indices, instrument_name, source_name, progress):
+    """Write the NXazint1d file, see export_nxazint1d. Returns None if interrupted."""
+    n_bins = x.shape[0]
+    # aim for ~1 MB float32 HDF5 chunks
+    chunk_rows = int(np.clip(2**20 // (4 * n_bins), 1, n_frames))
+    with h5.File(fname, 'w') as f:
+        entry = f.create_group('entry')
+        entry.attrs['NX_class'] = 'NXentry'
+        entry.attrs['default'] = 'data'
+        entry['definition'] = 'NXazint1d'
+
+        data = entry.create_group('data')
+        data.attrs['NX_class'] = 'NXdata'
+        data.attrs['signal'] = 'I'
+        data.attrs['axes'] = ['.', 'radial_axis']
+        data.attrs['interpretation'] = 'spectrum'
+        radial_axis = data.create_dataset('radial_axis', data=x)
+        radial_axis.attrs['long_name'] = 'q' if is_Q else '2theta'
+        radial_axis.attrs['units'] = '1/angstrom' if is_Q else 'degrees'
+
+        streams = [('I', frames)]
+        if errors is not None:
+            streams.append(('I_errors', errors))
+        for name, chunks in streams:
+            dset = data.create_dataset(name, shape=(n_frames, n_bins), dtype=np.float32,
+                                       chunks=(chunk_rows, n_bins), compression='gzip',
+                                       compression_opts=4, shuffle=True)
+            dset.attrs['long_name'] = 'intensity' if name == 'I' else 'intensity errors'
+            dset.attrs['units'] = 'arbitrary units'
+            start = 0
+            for chunk in chunks:
+                dset[start:start+chunk.shape[0]] = chunk
+                start += chunk.shape[0]
+                if progress is not None and name == 'I' and progress(start) is False:
+                    return None
+
+        if instrument_name is not None or energy is not None or source_name is not None:
+            instrument = entry.create_group('instrument')
+            instrument.attrs['NX_class'] = 'NXinstrument'
+            if instrument_name is not None:
+                instrument['name'] = instrument_name
+            if energy is not None:
+                monochromator = instrument.create_group('monochromator')
+                monochromator.attrs['NX_class'] = 'NXmonochromator'
+                monochromator['energy'] = energy
+                monochromator['energy'].attrs['units'] = 'keV'
+            if source_name is not None:
+                source = instrument.create_group('source')
+                source.attrs['NX_class'] = 'NXsource'
+                source['name'] = source_name
+
+        if I0 is not None:
+            monitor = entry.create_group('monitor')
+            monitor.attrs['NX_class'] = 'NXmonitor'
+            monitor['data'] = I0
+
+        sample = entry.create_group('sample')
+        sample.attrs['NX_class'] = 'NXsample'
+        if map_shape is not None:
+            # save the map geometry as sample translations in pixel units
+            # with x as the slow axis and y as the fast axis
+            if map_indices is None:
+                map_indices = np.arange(n_frames)
+            x_index, y_index = np.unravel_index(np.asarray(map_indices), map_shape)
+            transformations = sample.create_group('transformations')
+            transformations.attrs['NX_class'] = 'NXtransformations'
+            for name, index, vector in (('x', x_index, [1, 0, 0]), ('y', y_index, [0, 1, 0])):
+                dset = transformations.create_dataset(name, data=index.astype(float))
+                dset.attrs['transformation_type'] = 'translation'
+                dset.attrs['vector'] = vector
+                dset.attrs['units'] = 'pixels'
+
+        if aux_data:
+            auxiliary = entry.create_group('auxiliary')
+            auxiliary.attrs['NX_class'] = 'NXcollection'
+            for alias, values in aux_data.items():
+                if values is not None and np.ndim(values) == 1:
+                    auxiliary[alias] = values
+    return True
+
 def export_xy(fname, x, y, y_e=None, kwargs={}):
     """
     Export the azimuthal integration data to a text file.  
@@ -116,5 +116,331 @@ def average_blocks(arr, reduction_factor=2, axes=(0,)):
         arr = arr.mean(axis=axis+1)
     return arr
 
+def average_blocks_error(arr, reduction_factor=2, axes=(0,)):
+    """
+    Propagate the errors of a numpy array reduced with average_blocks, i.e.
+    the error of the average of N entries is sqrt(sum(error**2))/N, where
+    N is the number of averaged entries (reduction_factor per axis).
+    If the size along any axis is not divisible by reduction_factor, the last entries are dropped.
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        Input error array.
+    reduction_factor : int
+        Number of adjacent entries to average along each axis.
+    axes : int or tuple of int
+        Axes along which to average.
+
+    Returns
+    -------
+    np.ndarray
+        Reduced error array, with the dtype of the input array.
+    """
+    if reduction_factor is None or reduction_factor <= 1:
+        return arr
+    arr = np.asarray(arr)
+    if not hasattr(axes, '__iter__'):
+        axes = (axes,)
+    n = np.prod([min(reduction_factor, arr.shape[axis]) for axis in axes])
+    var = average_blocks(np.square(arr, dtype=np.float64), reduction_factor=reduction_factor, axes=axes)
+    return np.sqrt(var / n).astype(arr.dtype, copy=False)
+
+def get_common_grid(xs):
+    """
+    Get an evenly spaced grid spanning the overlapping range of the (increasing)
+    axes in xs, with a step size equal to the finest step size of the axes.
+    Returns None if the axes do not overlap.
+    """
+    x_min = max(np.min(x) for x in xs)
+    x_max = min(np.max(x) for x in xs)
+    if x_max <= x_min:
+        return None
+    step = min(np.median(np.diff(x)) for x in xs)
+    n = int(np.floor((x_max - x_min) / step + 1e-6)) + 1
+    return np.linspace(x_min, x_min + (n - 1) * step, n)
+
+def regrid(x, y, x_new, is_error=False, chunk_size=1024):
+    """
+    Linearly interpolate y from the (increasing) axis x onto the axis x_new
+    along the last axis. The interpolation indices and weights are computed
+    once and applied to chunk_size frames at a time, in the precision of y
+    (at least float32). Points of x_new on x reproduce y exactly. If is_error
+    is True, y is treated as errors and propagated in quadrature.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Source axis, shape (m,).
+    y : np.ndarray
+        Data on the source axis, shape (m,) or (n, m).
+    x_new : np.ndarray
+        Target axis, shape (k,). Values outside x are clipped to the end points.
+    is_error : bool
+        Propagate y as errors.
+    chunk_size : int
+        Number of frames interpolated at a time.
+
+    Returns
+    -------
+    np.ndarray
+        Data on the target axis, shape (k,) or (n, k), with the dtype of y.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    x_new = np.clip(np.asarray(x_new, dtype=np.float64), x[0], x[-1])
+    idx = np.clip(np.searchsorted(x, x_new), 1, x.shape[0] - 1)
+    y = np.asarray(y)
+    w = ((x_new - x[idx-1]) / (x[idx] - x[idx-1])).astype(np.result_type(y.dtype, np.float32))
+    y_2d = y.reshape(-1, y.shape[-1])
+    out = np.empty((y_2d.shape[0], x_new.shape[0]), dtype=y.dtype)
+    for i in range(0, y_2d.shape[0], chunk_size):
+        a = y_2d[i:i+chunk_size, idx-1]
+        b = y_2d[i:i+chunk_size, idx]
+        if is_error:
+            out[i:i+chunk_size] = np.sqrt(((1 - w) * a)**2 + (w * b)**2)
+        else:
+            out[i:i+chunk_size] = (1 - w) * a + w * b
+    return out.reshape(y.shape[:-1] + x_new.shape)
+
+def snip_background(y, iterations=20):
+    """
+    Estimate the background of the patterns y (frames, bins) with the statistics-sensitive
+    non-linear iterative peak-clipping (SNIP) algorithm, vectorized across frames.
+    The clipping is done on the log-log-square root transformed intensities, with
+    the clipping window increasing from 1 to iterations bins.
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    v = np.log(np.log(np.sqrt(np.clip(y, 0, None) + 1) + 1) + 1)
+    for p in range(1, min(iterations, (y.shape[1] - 1) // 2) + 1):
+        v[:, p:-p] = np.minimum(v[:, p:-p], 0.5 * (v[:, :-2*p] + v[:, 2*p:]))
+    return (np.exp(np.exp(v) - 1) - 1)**2 - 1
+
+def rolling_min_background(y, window=51, iterations=3):
+    """
+    Estimate the background of the patterns y (frames, bins) by an iterative rolling
+    minimum, vectorized across frames. In each iteration, the rolling minimum is
+    smoothed by a rolling mean of the same window and clipped by the current estimate.
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    window = int(max(1, min(window, y.shape[1])))
+    pad = (window // 2, window - 1 - window // 2)
+    bgr = y
+    for _ in range(iterations):
+        padded = np.pad(bgr, ((0, 0), pad), mode='edge')
+        minimum = np.lib.stride_tricks.sliding_window_view(padded, window, axis=1).min(axis=-1)
+        padded = np.pad(minimum, ((0, 0), pad), mode='edge')
+        cumsum = np.cumsum(np.pad(padded, ((0, 0), (1, 0))), axis=1)
+        smoothed = (cumsum[:, window:] - cumsum[:, :-window]) / window if window > 1 else minimum
+        bgr = np.minimum(bgr, smoothed)
+    return bgr
+
+def polynomial_background(y, order=3, iterations=20):
+    """
+    Estimate the background of the patterns y (frames, bins) by an iterative,
+    low-order polynomial fit, vectorized across frames. In each iteration, the
+    patterns are clipped by the fit, so the fit converges to the lower envelope.
+    All frames share the same least-squares projection, which is computed once.
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    t = np.linspace(-1, 1, y.shape[1])
+    V = np.polynomial.legendre.legvander(t, order)  # (bins, order+1)
+    P = np.linalg.pinv(V)  # (order+1, bins)
+    bgr = y
+    for _ in range(iterations):
+        fit = (bgr @ P.T) @ V.T
+        bgr = np.minimum(bgr, fit)
+    return fit
+
+def robust_zscore(x):
+    """
+    Get the robust z-scores of x, i.e. the deviations from the median in units
+    of the median absolute deviation (MAD) scaled to the standard deviation of a
+    normal distribution. NaN values are ignored and return NaN.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    median = np.nanmedian(x)
+    mad = np.nanmedian(np.abs(x - median)) * 1.4826
+    if not mad > 0:
+        # fall back to the mean absolute deviation for (mostly) constant data
+        mad = np.nanmean(np.abs(x - median)) * 1.2533
+    if not mad > 0:
+        return np.zeros_like(x)
+    return (x - median) / mad
+
+def despike_frames(I, window=5, threshold=5.0, chunk_bytes=2**26):
+    """
+    Remove single-frame spikes from the stack I (frames, bins) with a windowed
+    median filter along the frame axis. Values deviating from the median of the
+    neighbouring frames in the window (excluding the frame itself) by more than
+    threshold times the noise level are replaced by the median. The noise level of
+    each bin is the scaled median absolute deviation (MAD) from the windowed median
+    over all frames, falling back to the scaled mean absolute deviation for bins with
+    a MAD of zero (e.g. sparse, low-count data). Bins without deviations are left as is.
+    The windowed medians are computed chunk by chunk (of at least 64 frames) with the
+    windows as strided views, the noise levels are independent of the chunks.
+
+    Parameters
+    ----------
+    I : np.ndarray
+        Intensity stack, shape (frames, bins).
+    window : int
+        Number of frames in the window, rounded up to an odd number.
+    threshold : float
+        Number of scaled MADs a value must deviate from the median to be replaced.
+    chunk_bytes : int
+        Approximate size of the temporary window arrays of each chunk.
+
+    Returns
+    -------
+    np.ndarray
+        Despiked stack with the shape and dtype of I (float64 for non-float input).
+    """
+    I = np.asarray(I)
+    n = I.shape[0]
+    half = max(int(window) // 2, 1)
+    window = 2 * half + 1
+    # the windowed medians are stored in the output array until the spikes are replaced
+    out = np.empty(I.shape, dtype=I.dtype if I.dtype.kind == 'f' else np.float64)
+    mode = 'reflect' if n > half else 'edge'
+    m = max(1, int(np.prod(I.shape[1:])))
+    chunk_size = max(64, chunk_bytes // (8 * window * m))
+    # split the frames in chunks of at least chunk_size frames (or all frames)
+    bounds = np.linspace(0, n, max(1, n // chunk_size) + 1).astype(int)
+    for i, k in zip(bounds[:-1], bounds[1:]):
+        # include half a window of neighbouring frames on each side of the chunk
+        j0, j1 = max(i - half, 0), min(k + half, n)
+        padded = np.pad(I[j0:j1], [(half - (i - j0), half - (j1 - k))] + [(0, 0)] * (I.ndim - 1), mode=mode)
+        windows = np.lib.stride_tricks.sliding_window_view(padded, window, axis=0)
+        neighbours = np.concatenate((windows[..., :half], windows[..., half+1:]), axis=-1)
+        out[i:k] = np.median(neighbours, axis=-1)
+    # noise level of each bin over all frames, computed in blocks of bins
+    I2, out2 = I.reshape(n, m), out.reshape(n, m)
+    sigma = np.empty(m)
+    bin_size = max(1, chunk_bytes // (8 * max(1, n)))
+    for b in range(0, m, bin_size):
+        deviation = np.abs(I2[:, b:b+bin_size] - out2[:, b:b+bin_size])
+        mad = np.median(deviation, axis=0) * 1.4826
+        mean_ad = np.mean(deviation, axis=0) * 1.2533
+        sigma[b:b+bin_size] = np.where(mad > 0, mad, mean_ad)
+    # skip bins without deviations
+    sigma[~(sigma > 0)] = np.inf
+    limit = threshold * sigma.reshape(I.shape[1:])
+    for i, k in zip(bounds[:-1], bounds[1:]):
+        chunk = I[i:k]
+        out[i:k] = np.where(np.abs(chunk - out[i:k]) > limit, out[i:k], chunk)
+    return out
+
+def savgol_kernel(window=5, order=2):
+    """
+    Get the Savitzky-Golay smoothing kernel of an odd window size, i.e. the
+    weights of the least squares polynomial of the given order evaluated at the
+    centre of the window.
+    """
+    half = int(window) // 2
+    if order >= 2 * half + 1:
+        raise ValueError(f"The polynomial order {order} must be less than the window size {2 * half + 1}.")
+    A = np.vander(np.arange(-half, half + 1), order + 1, increasing=True)
+    return np.linalg.pinv(A)[0]
+
+def gaussian_kernel(sigma=1.0, truncate=4.0):
+    """Get a normalized Gaussian smoothing kernel of standard deviation sigma, truncated at truncate*sigma."""
+    if sigma <= 0:
+        raise ValueError(f"The standard deviation {sigma} must be positive.")
+    half = max(int(truncate * sigma + 0.5), 1)
+    kernel = np.exp(-0.5 * (np.arange(-half, half + 1) / sigma)**2)
+    return kernel / kernel.sum()
+
+SMOOTHING_KERNELS = {"savgol": savgol_kernel,
+                     "gaussian": gaussian_kernel,
+                     }
+
+def _correlate_valid(a, kernel, axis):
+    """Correlate a with the kernel along axis, returning only the fully overlapping part."""
+    m = a.shape[axis] - len(kernel) + 1
+    out = np.zeros(a.shape[:axis] + (m,) + a.shape[axis+1:], dtype=np.result_type(a.dtype, np.float32))
+    for j, w in enumerate(kernel):
+        out += w * np.take(a, np.arange(j, j + m), axis=axis)
+    return out
+
+def smooth_stack(I, frame_kernel=None, radial_kernel=None, chunk_bytes=2**26, start=0, stop=None):
+    """
+    Smooth the stack I (frames, bins) with the (symmetric) kernels along the frame
+    and/or radial axis. The edges are padded by reflection. The stack is processed
+    chunk by chunk with half a kernel of neighbouring frames on each side, so the
+    result is identical to smoothing the full stack at once. Only the frames
+    start:stop are smoothed and returned, using their neighbours in I.
+
+    Parameters
+    ----------
+    I : np.ndarray
+        Intensity stack, shape (frames, bins).
+    frame_kernel, radial_kernel : np.ndarray or None
+        Odd-sized smoothing kernels along the frame and radial axis, or None to skip
+        the axis (see savgol_kernel and gaussian_kernel).
+    chunk_bytes : int
+        Approximate size of the temporary arrays of each chunk.
+    start, stop : int
+        Range of frames to smooth, default all frames.
+
+    Returns
+    -------
+    np.ndarray
+        Smoothed frames start:stop of I (at least float32).
+    """
+    I = np.asarray(I)
+    n, m = I.shape[0], int(np.prod(I.shape[1:]))
+    stop = n if stop is None else min(stop, n)
+    out = np.empty((stop - start,) + I.shape[1:], dtype=np.result_type(I.dtype, np.float32))
+    half = len(frame_kernel) // 2 if frame_kernel is not None else 0
+    r_half = len(radial_kernel) // 2 if radial_kernel is not None else 0
+    chunk_size = max(1, chunk_bytes // (8 * max(1, m + 2 * r_half)))
+    for i in range(start, stop, chunk_size):
+        k = min(i + chunk_size, stop)
+        if half:
+            # include half a kernel of neighbouring frames on each side of the chunk
+            j0, j1 = max(i - half, 0), min(k + half, n)
+            pad = [(half - (i - j0), half - (j1 - k))] + [(0, 0)] * (I.ndim - 1)
+            chunk = _correlate_valid(np.pad(I[j0:j1], pad, mode='reflect' if n > half else 'edge'), frame_kernel, 0)
+        else:
+            chunk = I[i:k]
+        if r_half:
+            pad = [(0, 0)] * (I.ndim - 1) + [(r_half, r_half)]
+            mode = 'reflect' if I.shape[-1] > r_half else 'edge'
+            chunk = _correlate_valid(np.pad(chunk, pad, mode=mode), radial_kernel, I.ndim - 1)
+        out[i-start:k-start] = chunk
+    return out
+
+def get_frame_fingerprints(I, chunk_bytes=2**26):
+    """
+    Get a fingerprint of each frame of the stack I (frames, bins), the dot product
+    with a fixed pseudo-random vector, to detect which frames have changed.
+    """
+    I = np.asarray(I)
+    n, m = I.shape[0], int(np.prod(I.shape[1:]))
+    weights = np.random.default_rng(0).random(m)
+    chunk_size = max(1, chunk_bytes // (8 * max(1, m)))
+    fingerprints = np.empty(n)
+    for i in range(0, n, chunk_size):
+        fingerprints[i:i+chunk_size] = I[i:i+chunk_size].reshape(-1, m).astype(np.float64) @ weights
+    return fingerprints
+
+BACKGROUND_METHODS = {"snip": snip_background,
+                      "rolling_min": rolling_min_background,
+                      "polynomial": polynomial_background,
+                      }
+
+def estimate_background(y, method="snip", **kwargs):
+    """
+    Estimate the background of the patterns y (frames, bins) or (bins,) with one of the
+    methods in BACKGROUND_METHODS ('snip', 'rolling_min' or 'polynomial'). kwargs are
+    passed to the method. Returns the background with the shape and dtype of y
+    (float64 for non-float input).
+    """
+    if method not in BACKGROUND_METHODS:
+        raise ValueError(f"Unknown background method '{method}', expected one of {list(BACKGROUND_METHODS)}")
+    y = np.asarray(y)
+    bgr = BACKGROUND_METHODS[method](y, **kwargs).reshape(y.shape)
+    return bgr.astype(y.dtype, copy=False) if y.dtype.kind == 'f' else bgr
+
 if __name__ == "__main__":  
     pass
\ No newline at end of file
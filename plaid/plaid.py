@@ -38,9 +38,9 @@ from plaid.trees import FileTreeWidget, CIFTreeWidget
 from plaid.dialogs import H5Dialog, ExportSettingsDialog, ColorCycleDialog
 from plaid.reference import Reference
 from plaid.plot_widgets import HeatmapWidget, PatternWidget, AuxiliaryPlotWidget, CorrelationMapWidget, DiffractionMapWidget
-from plaid.misc import q_to_tth, tth_to_q, d_to_q, d_to_tth, get_divisors, average_blocks
+from plaid.misc import q_to_tth, tth_to_q, d_to_q, d_to_tth, get_divisors, average_blocks, get_common_grid, regrid
 from plaid.data_containers import AzintData, AuxData
-from plaid.io import load_file, ReadWorker
+from plaid.io import load_file, ReadWorker, TaskWorker, DerivedCache
 from plaid import __version__ as CURRENT_VERSION
 import plaid.resources
 #from plaid.qt_worker import run_in_thread
@@ -181,6 +181,21 @@ def clear_recent_refs_settings():
     settings.setValue("recent-references", [])
     settings.endGroup()
 
+def read_cache_next_to_data_setting():
+    """Read whether the derived product cache is stored next to the data files."""
+    settings = QtCore.QSettings("plaid", "plaid")
+    settings.beginGroup("MainWindow")
+    next_to_data = settings.value("derived-cache-next-to-data", False, type=bool)
+    settings.endGroup()
+    return next_to_data
+
+def save_cache_next_to_data_setting(next_to_data):
+    """Save whether the derived product cache is stored next to the data files."""
+    settings = QtCore.QSettings("plaid", "plaid")
+    settings.beginGroup("MainWindow")
+    settings.setValue("derived-cache-next-to-data", bool(next_to_data))
+    settings.endGroup()
+
 def clear_all_settings():
     """Clear all saved settings."""
     settings = QtCore.QSettings("plaid", "plaid")
@@ -228,6 +243,12 @@ class MainWindow(QMainWindow):
         self.aux_data = {}
 
         self.locked_patterns = []  # list of (is_Q, E) tuples for locked patterns
+        self._roi_aux_labels = []  # labels of the roi quantities in the auxiliary plot
+        self._component_aux_labels = []  # labels of the component weights in the auxiliary plot
+        self.range_average_window = 10  # number of frames in the range average window around a single horizontal line
+        self.radial_reduction_factor = 1  # number of radial bins averaged for display and export (see update_heatmap)
+        self._loading_error = False  # flag to indicate if the data being loaded is I_error
+        self._regrid_x = None  # (x, x_new) to regrid the data being loaded onto a common grid (see load_file)
         
         # initialize the data read worker
         self.read_worker = ReadWorker()
@@ -235,6 +256,13 @@ class MainWindow(QMainWindow):
         # self.read_worker.sigFinished.connect(lambda *_: _loop.quit())
         # self.read_worker.sigError.connect(lambda e: print(f"Error: {e}"))
         self.read_worker.sigProgress.connect(self._load_intensity_data_progress)
+
+        # initialize the analysis worker (see _start_analysis_task)
+        self.analysis_worker = TaskWorker()
+        self.analysis_worker.sigFinished.connect(self._analysis_task_done)
+        self._analysis_progress_dialog = None
+        self._analysis_azint_data = None  # the azint data being analyzed
+        self._analysis_done_func = None  # called with the result of the analysis task
         
         self._load_color_cycle()
         if not self.color_cycle:
@@ -418,9 +446,12 @@ class MainWindow(QMainWindow):
         self.pattern.sigRequestQToggle.connect(self.toggle_q)                                 # --> ()
         self.pattern.sigRequestLockPattern.connect(self.handle_lock_pattern_request)          # --> object
         self.pattern.sigRequestSubtractPattern.connect(self.set_active_pattern_as_background) # --> ()
+        self.pattern.sigRequestScaleBackground.connect(self.scale_background) # --> ()
         self.pattern.sigRequestCorrelationMap.connect(self.show_correlation_map)              # --> ()
         self.pattern.sigRequestDiffractionMap.connect(lambda: self.show_diffraction_map())    # --> ()
         self.pattern.sigRequestExportAvg.connect(self.export_average_pattern)                 # --> ()
+        self.pattern.sigRequestExportRangeAvg.connect(self.export_range_average_pattern)      # --> ()
+        self.pattern.sigRangeAvgVisibilityChanged.connect(self.update_range_average)          # --> bool
         self.pattern.sigRequestExportCurrent.connect(self.export_pattern)                     # --> ()
         self.pattern.sigRequestExportAll.connect(self.export_all_patterns)                    # --> ()
         # Connect the auxiliary plot signals to the appropriate slots
@@ -429,9 +460,15 @@ class MainWindow(QMainWindow):
 
         self.correlation_map_dock.visibilityChanged.connect(self.update_correlation_map)        # --> bool
         self.correlation_map.sigImageDoubleClicked.connect(self.correlation_map_double_clicked) # --> object
+        self.correlation_map.sigModeChanged.connect(self.set_correlation_map)                   # --> ()
+        self.correlation_map.sigTileError.connect(self.correlation_tile_error)                  # --> str
+        self.pattern.sigLinearRegionChangedFinished.connect(lambda _: self.set_correlation_map(force=True) if self.correlation_map.is_roi_checked() else None) # --> object
 
         self.diffraction_map_dock.visibilityChanged.connect(self.update_diffraction_map)        # --> bool
         self.diffraction_map.sigImageDoubleClicked.connect(self.diffraction_map_double_clicked) # --> object
+        self.diffraction_map.sigQuantityChanged.connect(lambda: self.set_diffraction_map(self.pattern.get_linear_region_roi())) # --> ()
+        self.diffraction_map.sigRequestAddRoi.connect(self.pattern.add_linear_region)            # --> ()
+        self.diffraction_map.sigRequestRemoveRoi.connect(self.pattern.remove_linear_region)      # --> ()
 
     def _init_menu_bar(self):
         """Initialize the menu bar with the necessary menus and actions. Called by self.__init__()."""
@@ -439,6 +476,7 @@ class MainWindow(QMainWindow):
         menu_bar = self.menuBar()
         self._init_file_menu(menu_bar)
         self._init_view_menu(menu_bar)
+        self._init_analysis_menu(menu_bar)
         self._init_export_menu(menu_bar)
         self._init_help_menu(menu_bar)
 
@@ -465,6 +503,15 @@ class MainWindow(QMainWindow):
             self.recent_menu.setEnabled(False)
             self.recent_menu.setToolTip("No recent files available")
 
+        # add an action to store the derived product cache next to the data files
+        DerivedCache.next_to_data = read_cache_next_to_data_setting()
+        cache_next_to_data_action = QAction("Store &Cache Next to Data", self)
+        cache_next_to_data_action.setToolTip("Store cached averages and correlation maps next to the data files instead of in the user cache directory")
+        cache_next_to_data_action.setCheckable(True)
+        cache_next_to_data_action.setChecked(DerivedCache.next_to_data)
+        cache_next_to_data_action.triggered.connect(self.toggle_cache_next_to_data)
+        file_menu.addAction(cache_next_to_data_action)
+
         file_menu.addSeparator()
 
         # add an action to load a reference from a cif
@@ -489,6 +536,13 @@ class MainWindow(QMainWindow):
             recent_references_menu.setEnabled(False)
             recent_references_menu.setToolTip("No recent references available")
     
+    def toggle_cache_next_to_data(self, is_checked):
+        """Toggle whether the derived product cache is stored next to the data files."""
+        DerivedCache.next_to_data = is_checked
+        save_cache_next_to_data_setting(is_checked)
+        # reopen the cache of the loaded data at the new location
+        self.azint_data._derived_cache = None
+
     def _add_recent_file_action(self,file,insert_at_top=False):
         """Add a file to the recent files settings."""
         action = QAction(file, self)
@@ -537,6 +591,43 @@ class MainWindow(QMainWindow):
         toggle_q_action.triggered.connect(self.toggle_q)
         view_menu.addAction(toggle_q_action)
         self.toggle_q_action = toggle_q_action
+        # add a radial binning action
+        radial_binning_action = QAction("Radial &Binning", self)
+        radial_binning_action.setToolTip("Average adjacent radial bins for display and export")
+        radial_binning_action.triggered.connect(self.set_radial_reduction_factor)
+        view_menu.addAction(radial_binning_action)
+        # add a toggle per-frame background action
+        toggle_bgr_stack_action = QAction("Per-frame &Background", self)
+        toggle_bgr_stack_action.setToolTip("Toggle the subtraction of an automatic background estimate for each frame")
+        toggle_bgr_stack_action.setCheckable(True)
+        toggle_bgr_stack_action.setChecked(False)
+        toggle_bgr_stack_action.triggered.connect(self.toggle_bgr_stack)
+        view_menu.addAction(toggle_bgr_stack_action)
+        self.toggle_bgr_stack_action = toggle_bgr_stack_action
+        # add a toggle outlier frame mask action
+        toggle_frame_mask_action = QAction("Mask &Outlier Frames", self)
+        toggle_frame_mask_action.setToolTip("Toggle the exclusion of outlier frames from averages, maps and exports")
+        toggle_frame_mask_action.setCheckable(True)
+        toggle_frame_mask_action.setChecked(False)
+        toggle_frame_mask_action.triggered.connect(self.toggle_frame_mask)
+        view_menu.addAction(toggle_frame_mask_action)
+        self.toggle_frame_mask_action = toggle_frame_mask_action
+
+        toggle_despike_action = QAction("&Despike Frames", self)
+        toggle_despike_action.setToolTip("Toggle the replacement of spikes by the median of the neighbouring frames")
+        toggle_despike_action.setCheckable(True)
+        toggle_despike_action.setChecked(False)
+        toggle_despike_action.triggered.connect(self.toggle_despike)
+        view_menu.addAction(toggle_despike_action)
+        self.toggle_despike_action = toggle_despike_action
+
+        toggle_smoothing_action = QAction("&Smoothing", self)
+        toggle_smoothing_action.setToolTip("Toggle Savitzky-Golay or Gaussian smoothing along the frames and/or radial axis")
+        toggle_smoothing_action.setCheckable(True)
+        toggle_smoothing_action.setChecked(False)
+        toggle_smoothing_action.triggered.connect(self.toggle_smoothing)
+        view_menu.addAction(toggle_smoothing_action)
+        self.toggle_smoothing_action = toggle_smoothing_action
         # add a separator
         view_menu.addSeparator()
         # add a change color cycle action
@@ -552,6 +643,32 @@ class MainWindow(QMainWindow):
         toggle_dark_mode_action.triggered.connect(self.toggle_dark_mode)
         view_menu.addAction(toggle_dark_mode_action)
 
+    def _init_analysis_menu(self, menu_bar):
+        """Initialize the Analysis menu with actions to analyze the stack of patterns. Called by self._init_menu_bar()."""
+        # create an analysis menu
+        analysis_menu = menu_bar.addMenu("&Analysis")
+        analysis_menu.setToolTipsVisible(True)
+        # Add an action to decompose the stack into component patterns
+        decompose_action = QAction("&Decompose Stack", self)
+        decompose_action.setToolTip("Decompose the processed stack into component patterns and their per-frame weights (PCA or NMF)")
+        decompose_action.triggered.connect(self.decompose_stack)
+        analysis_menu.addAction(decompose_action)
+        # Add an action to find the frames most similar to the active frame
+        find_similar_action = QAction("Find &Similar Frames", self)
+        find_similar_action.setToolTip("Highlight the frames most similar to the frame of the active horizontal line")
+        find_similar_action.triggered.connect(self.find_similar_frames)
+        analysis_menu.addAction(find_similar_action)
+        # Add an action to cluster the frames by their principal component scores
+        cluster_action = QAction("&Cluster Frames", self)
+        cluster_action.setToolTip("Cluster the frames by k-means on their principal component scores and show the cluster mean patterns")
+        cluster_action.triggered.connect(self.cluster_frames)
+        analysis_menu.addAction(cluster_action)
+        # Add an action to detect change points along the frame axis
+        change_points_action = QAction("Detect C&hange Points", self)
+        change_points_action.setToolTip("Detect transitions along the frame axis from the roi integrals or component scores and add horizontal lines at the detected frames")
+        change_points_action.triggered.connect(self.detect_change_points)
+        analysis_menu.addAction(change_points_action)
+
     def _init_export_menu(self, menu_bar):
         """Initialize the Export menu with actions to export patterns and settings. Called by self._init_menu_bar()."""
         # create an export menu
@@ -562,6 +679,12 @@ class MainWindow(QMainWindow):
         export_average_action.setToolTip("Export the average pattern to a double-column file")
         export_average_action.triggered.connect(self.export_average_pattern)
         export_menu.addAction(export_average_action)
+
+        # add an action to export the range average pattern
+        export_range_average_action = QAction("Export &Range Average Pattern", self)
+        export_range_average_action.setToolTip("Export the average pattern of the frames between the first and last horizontal line (or around the active line) to a double-column file")
+        export_range_average_action.triggered.connect(self.export_range_average_pattern)
+        export_menu.addAction(export_range_average_action)
         
         # Add an action to export the current pattern(s)
         export_pattern_action = QAction("Export &Pattern(s)", self)
@@ -576,6 +699,13 @@ class MainWindow(QMainWindow):
         export_all_action.setEnabled(ALLOW_EXPORT_ALL_PATTERNS)  # Enable only if allowed
         export_menu.addAction(export_all_action) 
 
+        # add an action to export the processed stack as an NXazint1d file
+        export_nxazint_action = QAction("Export Processed &Stack (NXazint1d)", self)
+        export_nxazint_action.setToolTip("Export the processed data stack to a compressed NXazint1d HDF5 file")
+        export_nxazint_action.triggered.connect(self.export_processed_stack)
+        export_nxazint_action.setEnabled(ALLOW_EXPORT_ALL_PATTERNS)  # Enable only if allowed
+        export_menu.addAction(export_nxazint_action)
+
         export_menu.addSeparator()
         
         # Add an action to open the export settings dialog
@@ -633,6 +763,7 @@ class MainWindow(QMainWindow):
         self.pattern.add_pattern()
         self.pattern.set_data(y=y, index=len(self.pattern.pattern_items)-1)
         self.pattern.set_pattern_name(name=f"frame {index}", index=len(self.pattern.pattern_items)-1)
+        self.update_range_average()
 
         # add a vertical line to the auxiliary plot
         if self.auxiliary_plot.n is not None:
@@ -647,6 +778,7 @@ class MainWindow(QMainWindow):
         """
         self.pattern.remove_pattern(index)
         self.auxiliary_plot.remove_v_line(index)
+        self.update_range_average()
 
     def remove_file(self, file):
         """
@@ -786,15 +918,23 @@ class MainWindow(QMainWindow):
         # with an item from the file tree
         is_initial_load = item is None
         self.azint_data = AzintData(self,file_path)
+        self.toggle_bgr_stack_action.setChecked(False)
+        self.toggle_frame_mask_action.setChecked(False)
+        self.toggle_despike_action.setChecked(False)
+        self.toggle_smoothing_action.setChecked(False)
+        self.clear_components()
+        self.clear_clusters()
+        self.heatmap.set_frame_markers([])
+        self.diffraction_map.set_markers([], [])
 
         # ensure all files are HDF5 files
         if not all(fname.endswith('.h5') for fname in self.azint_data.fnames):
             QMessageBox.critical(self, "Error", "File(s) are not HDF5 files.")
             return False
         
-        # read "secondary" data and I, I_error paths and ensure consistent x shapes
-        x = None
+        # read "secondary" data and I, I_error paths and the radial axis of each file
         I_paths, I_error_paths = [], []
+        xs, is_qs, energies = [], [], []
         I0 = np.array([])
         for fname in self.azint_data.fnames:
             data_dict = load_file(fname,parent=self)
@@ -804,28 +944,45 @@ class MainWindow(QMainWindow):
             I_paths.append(data_dict["I"])
             I_error_paths.append(data_dict["I_error"])
             is_q = data_dict["q"] is not None
-            _x = data_dict["q"] if is_q else data_dict["tth"]
-            if x is not None and _x.shape != x.shape:
-                QMessageBox.critical(self, "Error", f"Inconsistent x shapes in {fname}.")
-                return False
-            x = _x
+            xs.append(data_dict["q"] if is_q else data_dict["tth"])
+            is_qs.append(is_q)
+            energies.append(data_dict.get("energy", None))
             if data_dict["I0"] is not None:
                 I0 = np.append(I0, data_dict["I0"]) if I0.size else data_dict["I0"]
 
         self.azint_data.set_secondary_data(data_dict)
 
+        # if the files have different radial axes, regrid them onto a common grid
+        x = xs[-1]
+        x_sources = None
+        if any(_x.shape != x.shape or not np.allclose(_x, x) for _x in xs) or len(set(is_qs)) > 1:
+            x_sources, is_q, E = self._get_regrid_axes(xs, is_qs, energies)
+            x = get_common_grid(x_sources) if x_sources is not None else None
+            if x is None:
+                QMessageBox.critical(self, "Error", "The radial axes of the files cannot be combined on a common grid.")
+                return False
+            self.azint_data.x = x
+            self.azint_data.is_q = is_q
+            self.azint_data.E = E
+
         # read intensity data in a separate thread
         for i,fname in enumerate(self.azint_data.fnames):
+            self._regrid_x = (x_sources[i], x) if x_sources is not None else None
             if not self._load_intensity_data(fname, I_paths[i]):
                 # if the intensity data could not be loaded, clear the azint_data and return
+                self._regrid_x = None
                 self.azint_data = AzintData(self,file_path)
                 return
             
         # read intensity error data in a separate thread
         for i,fname in enumerate(self.azint_data.fnames):
-            self._load_intensity_data(fname, I_error_paths[i])
+            self._regrid_x = (x_sources[i], x) if x_sources is not None else None
+            self._load_intensity_data(fname, I_error_paths[i], is_error=True)
+        self._regrid_x = None
 
         self.azint_data.shape = self.azint_data.I.shape if self.azint_data.I is not None else None
+        # initialize the reduction pyramid along the frame axis (see apply_reduction_factor)
+        self.azint_data.build_reduction_pyramid()
         # self.azint_data.y_avg = self.azint_data.I.mean(axis=0) if self.azint_data.I is not None else None
 
         if is_initial_load and I0.size == self.azint_data.shape[0]:
@@ -925,7 +1082,7 @@ class MainWindow(QMainWindow):
         self.E = self.azint_data.E
 
         # Update the heatmap with the new data
-        self.heatmap.set_data(x, I.T)
+        self.update_heatmap()
         # self.heatmap.set_data(x_edge, y_edge, I)
         self.heatmap.set_xlabel("2theta (deg)" if not is_q else "Q (1/A)")
 
@@ -943,10 +1100,33 @@ class MainWindow(QMainWindow):
         self.update_correlation_map(self.correlation_map_dock.isVisible())
         #self.update_diffraction_map(self.diffraction_map_dock.isVisible())
             
-    def _load_intensity_data(self, file_path, dset_path):
-        """Load intensity data from a file in a separate thread."""
+    def _get_regrid_axes(self, xs, is_qs, energies):
+        """
+        Get the radial axes of heterogeneous files in common units for regridding.
+        2theta axes recorded at the same energy are combined in 2theta, otherwise
+        all axes are converted to Q, which requires the energy of the 2theta files.
+        Returns the list of axes, whether they are in Q, and the common energy
+        (None if the energies differ), or (None, None, None) if not possible.
+        """
+        tth_energies = {E for E, is_q in zip(energies, is_qs) if not is_q}
+        known_energies = {E for E in energies if E is not None}
+        E = known_energies.pop() if len(known_energies) == 1 else None
+        if not any(is_qs) and len(tth_energies) == 1:
+            return xs, False, E
+        if None in tth_energies:
+            print("Cannot convert 2theta to Q without the energy of all files.")
+            return None, None, None
+        x_sources = [x if is_q else tth_to_q(x, E_) for x, is_q, E_ in zip(xs, is_qs, energies)]
+        return x_sources, True, E
+
+    def _load_intensity_data(self, file_path, dset_path, is_error=False):
+        """
+        Load intensity data from a file in a separate thread.
+        If is_error is True, the loaded data is appended to I_error instead of I.
+        """
         if file_path is None or dset_path is None:
             return
+        self._loading_error = is_error
         # show a progress dialog while loading the file
         self.progress = QProgressDialog("Loading data...", "Interrupt", 0, 10000, self)
         self.progress.setWindowModality(QtCore.Qt.WindowModality.ApplicationModal)
@@ -965,18 +1145,23 @@ class MainWindow(QMainWindow):
         """Handle the completion of intensity data loading."""
         if success:
             # append the result to the azint_data.I array
-            if len(self.azint_data._shapes) < len(self.azint_data.fnames):
+            if not self._loading_error:
                 # account for the DanMAX map case
-                if result.ndim == 3 and result.shape[0] - self.azint_data.x.shape[0] in (0,1):
-                    result = self._reshape_danmax_map_data(result, self.azint_data.x.shape[0])
+                n_x = self.azint_data.x.shape[0] if self._regrid_x is None else self._regrid_x[0].shape[0]
+                if result.ndim == 3 and result.shape[0] - n_x in (0,1):
+                    result = self._reshape_danmax_map_data(result, n_x)
+                # regrid the data onto the common radial grid
+                if self._regrid_x is not None:
+                    result = regrid(self._regrid_x[0], result, self._regrid_x[1])
                 if self.azint_data.I is None:
                     self.azint_data.I = result
                 else:
                     self.azint_data.I = np.vstack((self.azint_data.I, result))
                 self.azint_data._shapes.append(result.shape)
-            # if the number of shapes matches the number of files, assume
-            # the loaded data is I_error
+            # otherwise, append the result to the azint_data.I_error array
             else:
+                if self._regrid_x is not None:
+                    result = regrid(self._regrid_x[0], result, self._regrid_x[1], is_error=True)
                 if self.azint_data.I_error is None:
                     self.azint_data.I_error = result
                 else:
@@ -1020,6 +1205,33 @@ class MainWindow(QMainWindow):
         y = self.azint_data.get_I(index=pos)
         self.pattern.set_data(y=y, index=index)
         self.pattern.set_pattern_name(name=f"frame {pos}", index=index)
+        self.update_range_average()
+
+    def get_average_range(self):
+        """
+        Get the frame range [start, stop) for the range average pattern.
+        The range spans the frames between the first and last horizontal line
+        in the heatmap (inclusive) if more than one line is present, otherwise
+        a window of self.range_average_window frames centered on the active line.
+        """
+        positions = self.heatmap.get_h_line_positions()
+        n = self.azint_data.shape[0]
+        if len(positions) > 1:
+            return max(0, min(positions)), min(n, max(positions)+1)
+        pos = positions[0] if positions else 0
+        start = int(np.clip(pos - self.range_average_window//2, 0, max(0, n - self.range_average_window)))
+        return start, min(n, start + self.range_average_window)
+
+    def update_range_average(self, *args):
+        """
+        Update the range average pattern if it is visible. Called when the
+        horizontal lines are moved, added or removed, or when the data are updated.
+        """
+        if self.azint_data.I is None or not self.pattern.is_range_avg_visible():
+            return
+        start, stop = self.get_average_range()
+        y = self.azint_data.get_range_average_I(start, stop)
+        self.pattern.set_range_avg_data(y, name=f"avg {start}-{stop-1}")
 
     def update_map_cursor(self, pos):
         """Update the map cursors in the correlation and diffraction maps."""
@@ -1230,10 +1442,8 @@ class MainWindow(QMainWindow):
             self.aux_data[target_name] = AuxData(self)
         with h5.File(self.h5dialog.get_file_path(), 'r') as f:
             for [alias,file_path,shape] in self.h5dialog.get_selected_items():
+                # store the unreduced data, it is reduced when plotted
                 data = f[file_path][:]
-                if self.azint_data.reduction_factor > 1:
-                    data = average_blocks(data, self.azint_data.reduction_factor)
-                    shape = f"{data.shape[0]}*"
                 self.file_tree.add_auxiliary_item(alias,shape)
                 self.aux_data[target_name].add_data(alias, data)
         
@@ -1285,7 +1495,7 @@ class MainWindow(QMainWindow):
             self.heatmap.set_xlabel("Q (1/A)")
             self.pattern.set_xlabel("Q (1/A)")
             x = self.azint_data.get_q()
-            self.heatmap.set_data(x, self.azint_data.get_I().T)
+            self.update_heatmap()
             self.pattern.x = x
             self.pattern.avg_pattern_item.setData(x=x, y=self.azint_data.get_average_I())
             for index in range(len(self.pattern.pattern_items)):
@@ -1305,7 +1515,7 @@ class MainWindow(QMainWindow):
             self.heatmap.set_xlabel("2theta (deg)")
             self.pattern.set_xlabel("2theta (deg)")
             x = self.azint_data.get_tth()
-            self.heatmap.set_data(x, self.azint_data.get_I().T)
+            self.update_heatmap()
             self.pattern.x = x
             self.pattern.avg_pattern_item.setData(x=x, y=self.azint_data.get_average_I())
             for index in range(len(self.pattern.pattern_items)):
@@ -1320,10 +1530,70 @@ class MainWindow(QMainWindow):
                 if is_Q:
                     self.pattern.locked_pattern_Q_to_tth(i, E)
                     locked_pattern[0] = False  # update the is_Q status
+        self.pattern.set_component_data(self.azint_data.components, self._get_component_names())
+        self._set_cluster_data()
+        self.update_range_average()
+        # update the diffraction map, as roi positions depend on the radial units
+        if self.diffraction_map_dock.isVisible():
+            self.set_diffraction_map(self.pattern.get_linear_region_roi())
         # get the updated x-range from the heatmap
         x_range = self.heatmap.get_xrange()
         self.pattern.set_xrange(x_range)
 
+    def update_heatmap(self):
+        """
+        Update the heatmap with the intensity data, averaging adjacent radial
+        bins by the radial reduction factor to reduce the cost of displaying
+        high-resolution data.
+        """
+        x = self.azint_data.get_binned_x(is_Q=self.is_Q, radial_factor=self.radial_reduction_factor)
+        I = self.azint_data.get_binned_I(radial_factor=self.radial_reduction_factor)
+        if x is None or I is None:
+            return
+        self.heatmap.set_data(x, I.T)
+
+    def set_radial_reduction_factor(self):
+        """
+        Request a radial reduction factor from the user, i.e. the number of
+        adjacent radial bins averaged in the heatmap and in exported data.
+        The intensity data itself is left unchanged.
+        """
+        n = self.azint_data.x.shape[0] if self.azint_data.x is not None else 1
+        radial_factor, ok = QInputDialog.getInt(self,
+                                                "Radial Binning",
+                                                "Enter the number of radial bins to average:\n(1 disables binning)",
+                                                value=self.radial_reduction_factor,
+                                                min=1,
+                                                max=max(n//2, 1),
+                                                )
+        if not ok:
+            return
+        self.radial_reduction_factor = radial_factor
+        if self.azint_data.I is not None:
+            self.update_heatmap()
+
+    def refresh_processed_views(self, heatmap=True):
+        """
+        Update the views of the processed intensity data after a change of the
+        processing, e.g. the background, frame mask, despiking or smoothing.
+        Update the heatmap (optional), patterns and average patterns, and flag
+        the correlation and diffraction maps for update, updating them if visible.
+        """
+        if heatmap:
+            self.update_heatmap()
+        # update patterns and average patterns
+        self.update_all_patterns()
+        y_avg = self.azint_data.get_average_I()
+        self.pattern.set_avg_data(y_avg)
+        self.update_range_average()
+        # flag the correlation and diffraction maps for update
+        self.correlation_map.fnames = None  # force update
+        self.diffraction_map.fnames = None  # force update
+        if self.diffraction_map_dock.isVisible():
+            self.update_diffraction_map(True)
+        if self.correlation_map_dock.isVisible():
+            self.update_correlation_map(True)
+
     def set_active_pattern_as_background(self):
         """Set the currently active pattern as the background to be subtracted from all patterns."""
         if self.azint_data.I is None:
@@ -1335,17 +1605,418 @@ class MainWindow(QMainWindow):
             y_bgr = None
         self.azint_data.set_y_bgr(y_bgr)
         
-        # update heatmap
-        I = self.azint_data.get_I()
-        x = self.heatmap.x
-        self.heatmap.set_data(x, I.T)
-        # update patterns and average pattern
-        self.update_all_patterns()
-        y_avg = self.azint_data.get_average_I()
-        self.pattern.set_avg_data(y_avg)
-        # update diffraction map if visible
+        self.refresh_processed_views()
+
+    def toggle_bgr_stack(self, is_checked):
+        """
+        Toggle the subtraction of a per-frame background estimate. If no estimate
+        is available for the current data, request an estimation method from the
+        user and estimate the background of all frames.
+        """
+        if self.azint_data.I is None:
+            self.toggle_bgr_stack_action.setChecked(False)
+            return
+        if is_checked and self.azint_data.bgr_stack is None:
+            methods = {"SNIP": ("snip", "Number of iterations:", 20),
+                       "Rolling minimum": ("rolling_min", "Window size (bins):", 51),
+                       "Polynomial": ("polynomial", "Polynomial order:", 3)}
+            name, ok = QInputDialog.getItem(self, "Per-frame Background", "Estimation method:", list(methods), 0, False)
+            if not ok:
+                self.toggle_bgr_stack_action.setChecked(False)
+                return
+            method, label, default = methods[name]
+            value, ok = QInputDialog.getInt(self, "Per-frame Background", label, value=default, min=1,
+                                            max=self.azint_data.shape[1])
+            if not ok:
+                self.toggle_bgr_stack_action.setChecked(False)
+                return
+            kwargs = {"snip": {"iterations": value},
+                      "rolling_min": {"window": value},
+                      "polynomial": {"order": value}}[method]
+            n = self.azint_data.shape[0]
+            progress_dialog = QProgressDialog("Estimating background...", "Cancel", 0, n, self)
+            progress_dialog.setWindowModality(QtCore.Qt.WindowModality.WindowModal)
+            def progress(i):
+                progress_dialog.setValue(i)
+                return not progress_dialog.wasCanceled()
+            successful = self.azint_data.estimate_bgr_stack(method, progress=progress, **kwargs)
+            progress_dialog.setValue(n)
+            if not successful:
+                self.toggle_bgr_stack_action.setChecked(False)
+                return
+        self.azint_data.set_use_bgr_stack(is_checked)
+
+        self.refresh_processed_views()
+
+    def scale_background(self):
+        """
+        Fit a per-frame scale and offset of the subtracted pattern to each frame
+        in the radial regions selected by the linear region(s) in the pattern plot.
+        If the background is already scaled, the scaling is removed.
+        """
+        if self.azint_data.I is None:
+            return
+        if self.azint_data.y_bgr is None:
+            QMessageBox.warning(self, "No Background", "Subtract a pattern before scaling the background.")
+            return
+        if self.azint_data.bgr_scale is not None:
+            self.azint_data.clear_bgr_scale()
+        else:
+            rois = self.pattern.get_linear_region_rois()
+            if not rois:
+                QMessageBox.warning(self, "No Regions", "Show the linear region(s) to select the background regions.")
+                return
+            mask = np.any(rois, axis=0)
+            if not self.azint_data.fit_bgr_scale(mask):
+                QMessageBox.critical(self, "Error", "Failed to fit the background scale in the selected regions.")
+                return
+
+        self.refresh_processed_views()
+
+    def toggle_frame_mask(self, is_checked):
+        """
+        Toggle the masking of outlier frames. Request a robust z-score threshold
+        from the user and detect outlier frames, which are then excluded from the
+        averages, the correlation and diffraction maps and the exports.
+        """
+        if self.azint_data.I is None:
+            self.toggle_frame_mask_action.setChecked(False)
+            return
+        if is_checked:
+            threshold, ok = QInputDialog.getDouble(self, "Outlier Frames", "Robust z-score threshold:",
+                                                   value=8.0, min=1.0, max=1000.0, decimals=1)
+            if not ok:
+                self.toggle_frame_mask_action.setChecked(False)
+                return
+            frame_mask = self.azint_data.detect_outlier_frames(threshold)
+            if frame_mask is None or frame_mask.all():
+                QMessageBox.information(self, "Outlier Frames", "No outlier frames detected.")
+                self.toggle_frame_mask_action.setChecked(False)
+                return
+            self.azint_data.set_frame_mask(frame_mask)
+        else:
+            self.azint_data.set_frame_mask(None)
+        self.statusBar().showMessage(self.azint_data.get_info_string())
+
+        # the frame mask does not change the heatmap
+        self.refresh_processed_views(heatmap=False)
+
+    def toggle_despike(self, is_checked):
+        """
+        Toggle the despiking of the intensity data along the frame axis. Request
+        the window size and threshold from the user and replace values deviating
+        from the median of the neighbouring frames.
+        """
+        if self.azint_data.I is None:
+            self.toggle_despike_action.setChecked(False)
+            return
+        if is_checked:
+            window, ok = QInputDialog.getInt(self, "Despike Frames", "Window size (frames):", value=5, min=3,
+                                             max=max(3, self.azint_data.shape[0]))
+            if not ok:
+                self.toggle_despike_action.setChecked(False)
+                return
+            threshold, ok = QInputDialog.getDouble(self, "Despike Frames", "Robust z-score threshold:",
+                                                   value=5.0, min=1.0, max=1000.0, decimals=1)
+            if not ok:
+                self.toggle_despike_action.setChecked(False)
+                return
+            self.azint_data.set_despike(True, window=window, threshold=threshold)
+        else:
+            self.azint_data.set_despike(False)
+
+        self.refresh_processed_views()
+
+    def toggle_smoothing(self, is_checked):
+        """
+        Toggle the smoothing of the intensity data. Request the smoothing method
+        and the window size or standard deviation along the frame and radial axis
+        from the user.
+        """
+        if self.azint_data.I is None:
+            self.toggle_smoothing_action.setChecked(False)
+            return
+        if is_checked:
+            methods = {"Savitzky-Golay": "savgol", "Gaussian": "gaussian"}
+            name, ok = QInputDialog.getItem(self, "Smoothing", "Smoothing method:", list(methods), 0, False)
+            if not ok:
+                self.toggle_smoothing_action.setChecked(False)
+                return
+            method = methods[name]
+            widths = []
+            for axis, n in (("frames", self.azint_data.shape[0]), ("radial bins", self.azint_data.shape[1])):
+                if method == "savgol":
+                    width, ok = QInputDialog.getInt(self, "Smoothing", f"Window size ({axis}, 0 for none):",
+                                                    value=5, min=0, max=n)
+                else:
+                    width, ok = QInputDialog.getDouble(self, "Smoothing", f"Standard deviation ({axis}, 0 for none):",
+                                                       value=1.0, min=0.0, max=n, decimals=1)
+                if not ok:
+                    self.toggle_smoothing_action.setChecked(False)
+                    return
+                widths.append(width)
+            order = 2
+            if method == "savgol":
+                order, ok = QInputDialog.getInt(self, "Smoothing", "Polynomial order:", value=2, min=0, max=10)
+                if not ok:
+                    self.toggle_smoothing_action.setChecked(False)
+                    return
+            if not any(widths) or not self.azint_data.set_smoothing(method, *widths, order=order):
+                QMessageBox.warning(self, "Smoothing", "Invalid smoothing parameters.")
+                self.toggle_smoothing_action.setChecked(False)
+                return
+        else:
+            self.azint_data.set_smoothing(None)
+
+        self.refresh_processed_views()
+
+    def decompose_stack(self):
+        """
+        Decompose the processed stack into component patterns by randomized PCA
+        or NMF. Request the method and number of components from the user and run
+        the decomposition in the background worker, see _decompose_stack_done.
+        """
+        if self.azint_data.I is None or self._analysis_task_running():
+            return
+        methods = {"PCA (randomized SVD)": "pca", "NMF": "nmf"}
+        name, ok = QInputDialog.getItem(self, "Decompose Stack", "Decomposition method:", list(methods), 0, False)
+        if not ok:
+            return
+        n_components, ok = QInputDialog.getInt(self, "Decompose Stack", "Number of components:", value=3, min=1,
+                                               max=max(1, min(50, *self.azint_data.shape)))
+        if not ok:
+            return
+        func = self.azint_data.get_decomposition_func(methods[name], n_components)
+        if func is None:
+            return
+        self._start_analysis_task(func, "Decomposing stack...", self._decompose_stack_done)
+
+    def _decompose_stack_done(self, result):
+        """
+        Handle the result of the decomposition task. Show the component patterns in the
+        pattern plot and their per-frame weights in the auxiliary plot and the diffraction map.
+        """
+        if not self.azint_data.set_decomposition(*result):
+            return
+        names = self._get_component_names()
+        self.pattern.set_component_data(self.azint_data.components, names)
+        for label in self._component_aux_labels:
+            self.auxiliary_plot.remove_named_data(label)
+        self._component_aux_labels = []
+        for z, label in zip(self.azint_data.component_scores.T, names):
+            self.auxiliary_plot.set_named_data(z, label)
+            self._component_aux_labels.append(label)
+        self.diffraction_map.add_quantity("Components", "components")
+        self.diffraction_map.set_quantity("components")
         if self.diffraction_map_dock.isVisible():
-            self.update_diffraction_map(True)
+            self.set_diffraction_map(self.pattern.get_linear_region_roi())
+
+    def find_similar_frames(self):
+        """
+        Find the frames most similar to the frame of the active horizontal line
+        in the heatmap. Request the number of frames and the similarity measure
+        from the user and highlight the frames in the heatmap and diffraction map.
+        """
+        if self.azint_data.I is None or self.heatmap.active_line is None:
+            return
+        measures = {"Pearson correlation": True, "Cosine similarity": False}
+        name, ok = QInputDialog.getItem(self, "Find Similar Frames", "Similarity measure:", list(measures), 0, False)
+        if not ok:
+            return
+        k, ok = QInputDialog.getInt(self, "Find Similar Frames", "Number of frames:", value=10, min=1,
+                                    max=max(1, self.azint_data.shape[0]-1))
+        if not ok:
+            return
+        index = self.heatmap.get_active_h_line_pos()
+        indices, similarity = self.azint_data.find_similar_frames(index, k, centered=measures[name])
+        if indices is None:
+            return
+        self.heatmap.set_frame_markers(indices)
+        # convert the frame indices to diffraction map positions (see diffraction_map_double_clicked)
+        shape = self.diffraction_map.map_shape
+        if shape is not None and np.prod(shape) >= self.azint_data.shape[0]:
+            n = np.asarray(self.azint_data.map_indices)[indices] if self.azint_data.map_indices is not None else indices
+            x, y = np.unravel_index(n, shape)
+            self.diffraction_map.set_markers(x, y)
+        message = ", ".join(f"{i} ({r:.3f})" for i, r in zip(indices, similarity))
+        self.statusBar().showMessage(f"Frames most similar to frame {index}: {message}")
+
+    def _analysis_task_running(self):
+        """Return True, and inform the user, if an analysis task is already running."""
+        if self.analysis_worker.is_running():
+            QMessageBox.information(self, "Analysis", "Another analysis is still running.")
+            return True
+        return False
+
+    def _start_analysis_task(self, func, label, done_func):
+        """
+        Run an analysis task func(progress=None) of the loaded data in the background
+        worker with a progress dialog, and call done_func with its result when finished.
+        """
+        self._analysis_azint_data = self.azint_data
+        self._analysis_done_func = done_func
+        self._analysis_progress_dialog = QProgressDialog(label, "Cancel", 0, 100, self)
+        self._analysis_progress_dialog.canceled.connect(lambda: setattr(self.analysis_worker, "cancelled", True))
+        self.analysis_worker.sigProgress.connect(self._analysis_progress_dialog.setValue)
+        self._analysis_progress_dialog.show()
+        self.analysis_worker.start(func)
+
+    def _analysis_task_done(self, success, result):
+        """
+        Handle the result of the analysis worker, discarding it if the task was
+        cancelled or the data has been reloaded or reduced in the meantime.
+        """
+        if self._analysis_progress_dialog is not None:
+            self.analysis_worker.sigProgress.disconnect(self._analysis_progress_dialog.setValue)
+            self._analysis_progress_dialog.close()
+            self._analysis_progress_dialog = None
+        done_func, self._analysis_done_func = self._analysis_done_func, None
+        if isinstance(result, Exception):
+            print(f"Error in analysis task: {result}")
+            QMessageBox.critical(self, "Error", f"The analysis failed:\n{result}")
+            return
+        if not success or self._analysis_azint_data is not self.azint_data or done_func is None:
+            return
+        done_func(result)
+
+    def cluster_frames(self):
+        """
+        Cluster the frames by k-means on their principal component scores (the scores
+        of a previous PCA decomposition are reused). Request the number of clusters and
+        components from the user and run the clustering in the background worker, see
+        _cluster_frames_done.
+        """
+        if self.azint_data.I is None or self._analysis_task_running():
+            return
+        n_clusters, ok = QInputDialog.getInt(self, "Cluster Frames", "Number of clusters:", value=3, min=2,
+                                             max=max(2, min(50, self.azint_data.shape[0])))
+        if not ok:
+            return
+        n_components = 5
+        params = self.azint_data.decomposition_params
+        if params is None or params["method"] != "pca":
+            n_components, ok = QInputDialog.getInt(self, "Cluster Frames", "Number of principal components:", value=5,
+                                                   min=1, max=max(1, min(50, *self.azint_data.shape)))
+            if not ok:
+                return
+        func = self.azint_data.get_cluster_func(n_clusters, n_components)
+        if func is None:
+            return
+        params = {"n_clusters": n_clusters, "n_components": n_components}
+        self._start_analysis_task(func, "Clustering frames...",
+                                  lambda result: self._cluster_frames_done(result, params))
+
+    def _cluster_frames_done(self, result, params):
+        """
+        Handle the result of the frame clustering task. Color the frames by cluster
+        in the heatmap, show the cluster mean patterns in the pattern plot and the
+        cluster labels (as the 'Clusters' quantity) in the diffraction map.
+        """
+        labels, means = result
+        if not self.azint_data.set_clusters(labels, means, params):
+            return
+        self._set_cluster_data()
+        self.diffraction_map.add_quantity("Clusters", "clusters")
+        self.diffraction_map.set_quantity("clusters")
+        if self.diffraction_map_dock.isVisible():
+            self.set_diffraction_map(self.pattern.get_linear_region_roi())
+        counts = np.bincount(labels[labels >= 0], minlength=len(means))
+        message = ", ".join(f"{i+1}: {c}" for i, c in enumerate(counts))
+        n_masked = np.count_nonzero(labels < 0)
+        if n_masked:
+            message += f", masked (grey): {n_masked}"
+        self.statusBar().showMessage(f"Frames per cluster: {message}")
+
+    def detect_change_points(self):
+        """
+        Detect change points along the frame axis, e.g. phase transitions, from the
+        integrals of the linear regions in the pattern plot or the per-frame weights
+        of a previous decomposition. Request the signal and number of change points
+        from the user and add a horizontal line (and pattern) at each detected frame.
+        """
+        if self.azint_data.I is None:
+            return
+        signals = {}
+        rois = [np.flatnonzero(roi) for roi in self.pattern.get_linear_region_rois()]
+        rois = [(int(roi[0]), int(roi[-1])+1) for roi in rois if roi.size > 0]
+        if rois:
+            signals["ROI integrals"] = "roi"
+        if self.azint_data.component_scores is not None:
+            signals["Component scores"] = "components"
+        if not signals:
+            QMessageBox.information(self, "Detect Change Points",
+                                    "Select a region of interest in the pattern plot or decompose the stack first.")
+            return
+        name, ok = QInputDialog.getItem(self, "Detect Change Points", "Signal:", list(signals), 0, False)
+        if not ok:
+            return
+        n_change_points, ok = QInputDialog.getInt(self, "Detect Change Points",
+                                                  "Number of change points (0 for automatic):", value=0, min=0, max=50)
+        if not ok:
+            return
+        if signals[name] == "roi":
+            signal = self.azint_data.get_roi_maps(rois, "mean", is_Q=self.is_Q,
+                                                  linear_background=self.pattern.linear_region_linear_background,
+                                                  ignore_negative=self.pattern.linear_region_ignore_negative)
+            if signal is None:
+                return
+            signal = signal.T
+        else:
+            signal = self.azint_data.component_scores
+        indices, gains = self.azint_data.detect_change_points(signal, n_change_points or None)
+        if indices is None:
+            return
+        if len(indices) == 0:
+            self.statusBar().showMessage("No change points detected.")
+            return
+        existing = self.heatmap.get_h_line_positions()
+        for index in indices:
+            if index not in existing:
+                self.add_pattern((0, index))
+        message = ", ".join(str(i) for i in indices)
+        self.statusBar().showMessage(f"Change points detected before frames: {message}")
+
+    def _get_cluster_colors(self, n_clusters):
+        """Get the RGBA colors (0-255) of the clusters from the color cycle."""
+        return [pg.mkColor(self.color_cycle[i % len(self.color_cycle)]).getRgb() for i in range(n_clusters)]
+
+    def _set_cluster_data(self):
+        """Show the cluster colors in the heatmap and the cluster mean patterns in the pattern plot."""
+        labels, means = self.azint_data.cluster_labels, self.azint_data.cluster_means
+        if labels is None:
+            return
+        colors = self._get_cluster_colors(len(means))
+        # unclustered (masked) frames are grey
+        frame_colors = np.array(colors + [(128, 128, 128, 255)], dtype=np.uint8)[labels]
+        self.heatmap.set_frame_colors(frame_colors)
+        counts = np.bincount(labels[labels >= 0], minlength=len(means))
+        names = [f"Cluster {i+1} ({c})" for i, c in enumerate(counts)]
+        self.pattern.set_cluster_data(means, names, colors)
+
+    def clear_clusters(self):
+        """Remove the cluster colors and mean patterns of a previous clustering from the plots."""
+        self._analysis_azint_data = None
+        self.heatmap.set_frame_colors(None)
+        self.pattern.clear_clusters()
+        self.diffraction_map.remove_quantity("clusters")
+
+    def _get_component_names(self):
+        """Get the legend names of the component patterns of the current decomposition."""
+        params = self.azint_data.decomposition_params
+        if params is None:
+            return None
+        if params["method"] == "pca":
+            return [f"PC {i+1} ({100*r:.1f}%)" for i, r in enumerate(params["explained_variance_ratio"])]
+        return [f"NMF {i+1}" for i in range(params["n_components"])]
+
+    def clear_components(self):
+        """Remove the component patterns and weights of a previous decomposition from the plots."""
+        self._analysis_azint_data = None
+        self.pattern.clear_components()
+        for label in self._component_aux_labels:
+            self.auxiliary_plot.remove_named_data(label)
+        self._component_aux_labels = []
+        self.diffraction_map.remove_quantity("components")
 
     def lock_active_pattern(self):
         """Lock the currently active pattern in the pattern plot."""
@@ -1464,7 +2135,8 @@ class MainWindow(QMainWindow):
             fname, ok = QFileDialog.getSaveFileName(self, "Save Pattern", fname, f"{ext.upper()} Files (*.{ext});;All Files (*)")
             if ok:
                 if fname:
-                    successful = self.azint_data.export_pattern(fname,index,is_Q, I0_normalized=I0_normalized,kwargs=kwargs)
+                    successful = self.azint_data.export_pattern(fname,index,is_Q, I0_normalized=I0_normalized,
+                                                                   radial_factor=self.radial_reduction_factor,kwargs=kwargs)
                     if not successful:
                         QMessageBox.critical(self, "Error", f"Failed to export pattern to {fname}.")
             else:
@@ -1481,10 +2153,28 @@ class MainWindow(QMainWindow):
         fname, ok = QFileDialog.getSaveFileName(self, "Save Average Pattern", fname, f"{ext.upper()} Files (*.{ext});;All Files (*)")
         if ok:
             if fname:
-                successful = self.azint_data.export_average_pattern(fname,is_Q, I0_normalized=I0_normalized,kwargs=kwargs)
+                successful = self.azint_data.export_average_pattern(fname,is_Q, I0_normalized=I0_normalized,
+                                                                       radial_factor=self.radial_reduction_factor,kwargs=kwargs)
                 if not successful:
                     QMessageBox.critical(self, "Error", f"Failed to export average pattern to {fname}.")
 
+    def export_range_average_pattern(self):
+        """Export the range average pattern to a file."""
+        if not self.azint_data.fnames:
+            QMessageBox.warning(self, "No Data", "No azimuthal integration data loaded.")
+            return
+        start, stop = self.get_average_range()
+        ext, pad, is_Q, I0_normalized, kwargs = self._prepare_export_settings()
+
+        fname = self.azint_data.fnames[0].replace('.h5', "_avg_{start:0{pad}d}-{last:0{pad}d}.{ext}".format(start=start, last=stop-1, pad=pad, ext=ext))
+        fname, ok = QFileDialog.getSaveFileName(self, "Save Range Average Pattern", fname, f"{ext.upper()} Files (*.{ext});;All Files (*)")
+        if ok:
+            if fname:
+                successful = self.azint_data.export_range_average_pattern(fname, start, stop, is_Q, I0_normalized=I0_normalized,
+                                                                             radial_factor=self.radial_reduction_factor, kwargs=kwargs)
+                if not successful:
+                    QMessageBox.critical(self, "Error", f"Failed to export range average pattern to {fname}.")
+
     def export_all_patterns(self):
         """
         Export all patterns to double-column files.
@@ -1522,13 +2212,17 @@ class MainWindow(QMainWindow):
             if progress_dialog.wasCanceled():
                 QMessageBox.information(self, "Cancelled", f"Export cancelled after {index} patterns.")
                 return
+            # skip masked frames
+            if self.azint_data.frame_mask is not None and not self.azint_data.frame_mask[index]:
+                continue
             ending = "_{index:0{pad}d}.{ext}".format(index=index, pad=pad, ext=ext)
             fname = f"{root_file_path}{ending}"
             # Update the progress dialog
             progress_dialog.setValue(index)
             progress_dialog.setLabelText(f"{fname}")
             # Export the pattern
-            successful = self.azint_data.export_pattern(fname, index, is_Q, I0_normalized=I0_normalized, kwargs=kwargs)
+            successful = self.azint_data.export_pattern(fname, index, is_Q, I0_normalized=I0_normalized,
+                                                           radial_factor=self.radial_reduction_factor, kwargs=kwargs)
             if not successful:
                 QMessageBox.critical(self, "Error", f"Failed to export pattern to {fname}.")
                 progress_dialog.cancel()  # Cancel the progress dialog
@@ -1537,17 +2231,95 @@ class MainWindow(QMainWindow):
         # inform the user that the export is done
         QMessageBox.information(self, "Complete", f"Complete!\nExported {self.azint_data.shape[0]} patterns to:\n{directory}")
 
+    def export_processed_stack(self):
+        """
+        Export the processed data stack (I0-normalized, background-subtracted and
+        reduced) to a compressed NXazint1d HDF5 file, including any auxiliary data
+        and map geometry. Uses the Q/2theta and I0 options of the export settings.
+        """
+        if not ALLOW_EXPORT_ALL_PATTERNS:
+            QMessageBox.warning(self, "Export Not Allowed", "Exporting all patterns is not allowed in this version.")
+            return
+        if not self.azint_data.fnames:
+            QMessageBox.warning(self, "No Data", "No azimuthal integration data loaded.")
+            return
+        ext, pad, is_Q, I0_normalized, kwargs = self._prepare_export_settings()
+        fname = self.azint_data.fnames[0].replace('.h5', "_processed.h5")
+        fname, ok = QFileDialog.getSaveFileName(self, "Save Processed Stack", fname, "HDF5 Files (*.h5);;All Files (*)")
+        if not ok or not fname:
+            return
+        if fname in self.azint_data.fnames:
+            QMessageBox.critical(self, "Error", "Cannot overwrite the loaded data file.")
+            return
+        # collect the auxiliary data of the current file (or group)
+        aux_data = None
+        group_path = ";".join(self.azint_data.fnames)
+        if group_path in self.aux_data:
+            aux_data = {alias: average_blocks(data, self.azint_data.reduction_factor)
+                        for alias, data in self.aux_data[group_path].get_dict().items()
+                        if alias != 'I0' and data is not None and data.ndim == 1}
+        
+        n = self.azint_data.shape[0]
+        progress_dialog = QProgressDialog("Exporting processed stack...", "Cancel", 0, n, self)
+        progress_dialog.setWindowModality(QtCore.Qt.WindowModality.WindowModal)
+        def progress(i):
+            progress_dialog.setValue(i)
+            return not progress_dialog.wasCanceled()
+        successful = self.azint_data.export_nxazint1d(fname, is_Q, I0_normalized=I0_normalized,
+                                                      aux_data=aux_data, progress=progress,
+                                                      radial_factor=self.radial_reduction_factor)
+        progress_dialog.setValue(n)
+        if successful is None:
+            # interrupted by the user, the partial file has been removed
+            self.statusBar().showMessage("Export of the processed stack cancelled.")
+        elif not successful:
+            QMessageBox.critical(self, "Error", f"Failed to export the processed stack to {fname}.")
+
+    def correlation_tile_error(self, message):
+        """Report an error computing a full-resolution tile of the correlation map."""
+        print(message)
+        QMessageBox.critical(self, "Error", message)
+
     def update_correlation_map(self, is_checked):
         """Update the correlation map when the correlation map checkbox is toggled."""
         # resize the correlation map dock
         self.correlation_map_dock.resize(self.width()//2, self.height()//2)
         # move the correlation map dock to the bottom right corner of the main window
         self.correlation_map_dock.move(self.geometry().bottomRight() - self.correlation_map_dock.rect().bottomRight())
-        if is_checked and self.azint_data.I is not None:
-            # check if the correlation map is already calculated for the current data
-            if not self.azint_data.fnames == self.correlation_map.fnames:
-                self.correlation_map.set_correlation_data(self.azint_data.get_I())
-                self.correlation_map.fnames = self.azint_data.fnames
+        if is_checked:
+            self.set_correlation_map()
+
+    def set_correlation_map(self, force=False):
+        """
+        Set the correlation map data according to the selected mode, either the
+        frame x frame correlation matrix or the lagged correlation of each frame,
+        computed over the linear region(s) in the pattern plot if the roi option
+        is checked. The map is only recomputed if the data has changed or force is True.
+        """
+        if not self.correlation_map_dock.isVisible() or self.azint_data.I is None:
+            return
+        # check if the correlation map is already calculated for the current data
+        if self.azint_data.fnames == self.correlation_map.fnames and not force:
+            return
+        roi = None
+        if self.correlation_map.is_roi_checked():
+            rois = self.pattern.get_linear_region_rois()
+            if rois:
+                roi = np.any(rois, axis=0)
+            else:
+                self.statusBar().showMessage("Show the linear region(s) to restrict the correlation map to a roi.")
+        n = self.azint_data.shape[0]
+        if self.correlation_map.get_mode() == "lagged":
+            im, factor = self.azint_data.get_lagged_correlation(self.correlation_map.get_max_lag(),
+                                                                self.correlation_map.display_size, roi=roi)
+            self.correlation_map.set_lagged_matrix(im, factor=factor, n=n)
+        else:
+            # compute the correlation matrix at display resolution (or load it from
+            # the derived product cache), full-resolution tiles are computed on zoom
+            im, factor = self.azint_data.get_correlation_matrix(self.correlation_map.display_size, roi=roi)
+            tile_func = self.azint_data.get_correlation_tile_func(roi=roi) if factor > 1 else None
+            self.correlation_map.set_correlation_matrix(im, factor=factor, tile_func=tile_func, n=n)
+        self.correlation_map.fnames = self.azint_data.fnames
 
     def correlation_map_double_clicked(self, pos):
         """Handle double click events on the correlation map."""
@@ -1619,33 +2391,83 @@ class MainWindow(QMainWindow):
   
     def set_diffraction_map(self,roi):
         """
-        Set the diffraction map data according to the provided roi.
+        Set the diffraction map data according to the provided roi and any
+        additional linear regions in the pattern plot, computing the maps of
+        all rois in one pass, or to the per-frame weights of the component
+        patterns or the cluster labels of the frames if the 'Components' or
+        'Clusters' quantity is selected.
         Called when the linear region in the pattern plot is changed and 
         whenever the diffraction map is updated.
         """
         if self.diffraction_map_dock.isVisible() and self.azint_data.I is not None and self.azint_data.shape[0] > 1:
-            if roi is None or np.sum(roi) == 0:
-                z = np.zeros(self.azint_data.shape[0])
+            quantity = self.diffraction_map.get_quantity()
+            if quantity == "components":
+                # map the per-frame weights of the component patterns (see decompose_stack)
+                if self.azint_data.component_scores is None:
+                    return
+                z_rois = self.azint_data.component_scores.T
+                labels = []  # the weights are already shown in the auxiliary plot (see decompose_stack)
+            elif quantity == "clusters":
+                # map the cluster labels of the frames (see cluster_frames), unclustered frames are NaN
+                if self.azint_data.cluster_labels is None:
+                    return
+                z_rois = np.where(self.azint_data.cluster_labels >= 0, self.azint_data.cluster_labels + 1., np.nan)[None]
+                labels = ["Cluster"]
             else:
-                I = self.azint_data.get_I()[:, roi]
-                # if self.pattern.get_log_mode():
-                #     I = np.log10(I, where=(I>0), out=np.zeros_like(I))
-                if self.pattern.linear_region_ignore_negative:
-                    I[I<0] = 0
-                elif self.pattern.linear_region_linear_background:
-                    # perform a simple linear background subtraction
-                    # using the first and last points in the ROI
-                    bgr = np.linspace(I[:,0], I[:,-1], I.shape[1]).T
-                    I = I - bgr
-
-                if self.azint_data.map_indices is None:
-                    z = np.mean(I,axis=1)
-                    # z = np.mean(self.azint_data.get_I()[:, roi],axis=1)
-                else:
-                    z = np.full((np.prod(self.azint_data.map_shape),), np.nan)
-                    z[self.azint_data.map_indices] = np.mean(I,axis=1)
-                    # z[self.azint_data.map_indices] = np.mean(self.azint_data.get_I()[:, roi],axis=1)
+                z_rois = self._get_roi_maps(roi)
+                if z_rois is None:
+                    return
+                labels = [f"ROI {self.diffraction_map.get_quantity_label().lower()}" + (f" {i+1}" if len(z_rois) > 1 else "")
+                          for i in range(len(z_rois))]
+
+            # show the roi quantities in the auxiliary plot
+            for label in self._roi_aux_labels:
+                self.auxiliary_plot.remove_named_data(label)
+            self._roi_aux_labels = []
+            if self.diffraction_map.is_auxiliary_checked():
+                for z_roi, label in zip(z_rois, labels):
+                    self.auxiliary_plot.set_named_data(z_roi, label)
+                    self._roi_aux_labels.append(label)
+                # ensure that a v line exists for each h line in the heatmap
+                for i,pos in enumerate(self.heatmap.get_h_line_positions()):
+                    if len(self.auxiliary_plot.v_lines) <= i:
+                        self.auxiliary_plot.addVLine(pos=pos)
+                    self.auxiliary_plot.set_v_line_pos(i, pos)
+
+            if self.azint_data.map_indices is None:
+                z = z_rois
+                # z = np.mean(self.azint_data.get_I()[:, roi],axis=1)
+            else:
+                z = np.full((len(z_rois), np.prod(self.azint_data.map_shape)), np.nan)
+                z[:, self.azint_data.map_indices] = z_rois
+                # z[self.azint_data.map_indices] = np.mean(self.azint_data.get_I()[:, roi],axis=1)
+            self.diffraction_map.set_diffraction_data(z)
+
+    def _get_roi_maps(self, roi):
+        """
+        Get the maps of the selected roi quantity of the provided roi and any additional
+        linear regions in the pattern plot, shape (number of rois, frames). If no roi is
+        selected, the diffraction map is cleared. Returns None if no roi is selected or
+        the maps could not be computed.
+        """
+        rois = self.pattern.get_linear_region_rois()
+        if not rois and roi is not None:
+            rois = [roi]
+        rois = [np.flatnonzero(roi) for roi in rois]
+        rois = [(int(roi[0]), int(roi[-1])+1) for roi in rois if roi.size > 0]
+        if not rois:
+            z = np.zeros(self.azint_data.shape[0])
             self.diffraction_map.set_diffraction_data(z)
+            return None
+        ignore_negative = self.pattern.linear_region_ignore_negative
+        linear_background = self.pattern.linear_region_linear_background
+        quantity = self.diffraction_map.get_quantity()
+        # the quantities are computed from the radial prefix sums,
+        # independent of the roi width, unless negative values are ignored
+        z_rois = self.azint_data.get_roi_maps(rois, quantity, is_Q=self.is_Q,
+                                              linear_background=linear_background,
+                                              ignore_negative=ignore_negative)
+        return z_rois
 
     def apply_reduction_factor(self,files):
         """
@@ -1658,10 +2480,10 @@ class MainWindow(QMainWindow):
         # request a reduction factor from the user
         reduction_factor, ok = QInputDialog.getInt(self, 
                                                    "Data Reduction", 
-                                                   "Enter reduction factor:\n(Reload to revert)",
-                                                    value=2,
+                                                   "Enter reduction factor:\n(1 reverts to the full data)",
+                                                    value=max(self.azint_data.reduction_factor, 2),
                                                     min=1,
-                                                    max=self.azint_data.shape[0],
+                                                    max=self.azint_data.shape[0]*self.azint_data.reduction_factor,
                                                     )
         if not ok:
             return
@@ -1673,28 +2495,22 @@ class MainWindow(QMainWindow):
                 return
         
         # apply the reduction factor to the azint data
-        self.azint_data.reduce_data(reduction_factor=reduction_factor)
+        self.azint_data.set_reduction_factor(reduction_factor)
+        # the per-frame background estimate is discarded by the reduction
+        self.toggle_bgr_stack_action.setChecked(self.azint_data.use_bgr_stack)
+        self.toggle_frame_mask_action.setChecked(self.azint_data.frame_mask is not None)
+        # the decomposition and clustering no longer match the frames
+        self.clear_components()
+        self.clear_clusters()
         # update the file tree item shape
         for file in (files):
             shape = self.azint_data.shape
-            self.file_tree.add_file(file,shape=shape.__str__().replace(',','*,'))
+            if reduction_factor > 1:
+                self.file_tree.add_file(file,shape=shape.__str__().replace(',','*,'))
+            else:
+                self.file_tree.add_file(file,shape=shape.__str__())
   
-        # update heatmap
-        I = self.azint_data.get_I()
-        x = self.heatmap.x
-        self.heatmap.set_data(x, I.T)
-        # update patterns and average pattern
-        self.update_all_patterns()
-        y_avg = self.azint_data.get_average_I()
-        self.pattern.set_avg_data(y_avg)
-        # flag the correlation and diffraction maps for update
-        self.correlation_map.fnames = None  # force update
-        self.diffraction_map.fnames = None  # force update
-        # update diffraction map if visible
-        if self.diffraction_map_dock.isVisible():
-            self.update_diffraction_map(True)
-        if self.correlation_map_dock.isVisible():
-            self.update_correlation_map(True)
+        self.refresh_processed_views()
         # update the file tree item status tip to indicate the new reduction factor
         for file in files:
             item = self.file_tree.file_tree.topLevelItem(self.file_tree.files.index(file))
@@ -1731,11 +2547,8 @@ class MainWindow(QMainWindow):
         if event.key() == QtCore.Qt.Key.Key_L:
             # Toggle the log scale for the heatmap
             self.heatmap.use_log_scale = not self.heatmap.use_log_scale
-            I = self.azint_data.get_I()
-            x = self.heatmap.x
-            # y = np.arange(I.shape[0])
-            if I is not None:
-                self.heatmap.set_data(x, I.T)
+            if self.azint_data.I is not None:
+                self.update_heatmap()
 
             self.pattern.toggle_log_y(self.heatmap.use_log_scale)
 
@@ -2118,6 +2931,7 @@ class MainWindow(QMainWindow):
         self._save_dock_settings()
         self._save_color_cycle()
         self._save_dark_mode_setting()
+        self.correlation_map.shutdown()
         event.accept()
 
 def parse_args():
@@ -8,9 +8,10 @@ MAX IV Laboratory, Lund University, Sweden
 This module provides classes for plotting heatmaps and patterns using PyQtGraph.
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from PyQt6.QtWidgets import (QVBoxLayout, QHBoxLayout, QWidget, QToolBar, QLabel, QComboBox,
-                            QDoubleSpinBox, QCheckBox, QGraphicsColorizeEffect, QMenu)
+                            QDoubleSpinBox, QSpinBox, QCheckBox, QGraphicsColorizeEffect, QMenu)
 from PyQt6 import QtCore
 from PyQt6.QtGui import QColor, QTransform, QPixmap, QIcon, QFont, QCursor, QAction
 import pyqtgraph as pg
@@ -69,6 +70,18 @@ class HeatmapWidget(QWidget):
 
         self.image_item.hoverEvent = self.hover_event
 
+        # create markers at the left edge of the heatmap for highlighting frames
+        self.frame_markers = pg.ScatterPlotItem(size=10,
+                                                pen=pg.mkPen((255, 255, 255, 200), width=1),
+                                                brush=pg.mkBrush((255, 0, 0, 200)),
+                                                symbol='t2')  # right-pointing triangle
+        self.plot_widget.addItem(self.frame_markers)
+
+        # create a color bar at the left edge of the heatmap for coloring the frames, e.g. by cluster
+        self.frame_color_item = pg.ImageItem()
+        self.frame_color_item.setVisible(False)
+        self.plot_widget.addItem(self.frame_color_item)
+
         self.x_axis = self.plot_widget.getPlotItem().getAxis('bottom')
         self.y_axis = self.plot_widget.getPlotItem().getAxis('left')
 
@@ -127,6 +140,27 @@ class HeatmapWidget(QWidget):
         self.sigHLineRemoved.emit(index)
         self.active_line = self.h_lines[-1] if self.h_lines else None  # Set the active line to the last one if available
 
+    def set_frame_markers(self, indices):
+        """Highlight the frames at the given indices with markers at the left edge of the heatmap."""
+        indices = np.asarray(indices, dtype=float)
+        self.frame_markers.setData(x=np.zeros_like(indices), y=indices+.5)
+
+    def set_frame_colors(self, colors):
+        """
+        Color the frames with a color bar at the left edge of the heatmap.
+        colors is an array of RGBA values (0-255) of shape (frames, 4), or None to remove the color bar.
+        """
+        if colors is None or self.x is None:
+            self.frame_color_item.setVisible(False)
+            return
+        self.frame_color_item.setImage(np.asarray(colors, dtype=np.uint8)[None], autoLevels=False)
+        width = max(1, len(self.x)*0.03)
+        tr = QTransform()
+        tr.translate(-width, 0)
+        tr.scale(width, 1)
+        self.frame_color_item.setTransform(tr)
+        self.frame_color_item.setVisible(True)
+
     def toggle_log_scale(self):
         """Toggle logarithmic scale for the heatmap."""
         if self.image_item.image is not None:
@@ -382,6 +416,8 @@ class HeatmapWidget(QWidget):
     def clear(self):
         """Clear the heatmap data and horizontal lines."""
         self.image_item.clear()
+        self.frame_markers.setData(x=[], y=[])
+        self.frame_color_item.setVisible(False)
         self.x = None
         self.n = None
         for h_line in self.h_lines:
@@ -404,11 +440,16 @@ class PatternWidget(QWidget):
     sigRequestQToggle = QtCore.pyqtSignal()
     sigRequestLockPattern = QtCore.pyqtSignal(object)
     sigRequestSubtractPattern = QtCore.pyqtSignal()
+    sigRequestScaleBackground = QtCore.pyqtSignal()
     sigRequestCorrelationMap = QtCore.pyqtSignal()
     sigRequestDiffractionMap = QtCore.pyqtSignal()
     sigRequestExportAvg = QtCore.pyqtSignal()
+    sigRequestExportRangeAvg = QtCore.pyqtSignal()
+    sigRangeAvgVisibilityChanged = QtCore.pyqtSignal(bool)
     sigRequestExportCurrent = QtCore.pyqtSignal()
     sigRequestExportAll = QtCore.pyqtSignal()
+    # colors of the additional linear regions (see add_linear_region)
+    roi_colors = ["#00AA00", "#0000AA", "#AA00AA", "#00AAAA", "#AA5500", "#5500AA", "#AAAAAA"]
     
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -417,6 +458,8 @@ class PatternWidget(QWidget):
         self.y = None
         self.pattern_items = []
         self.locked_pattern_items = []
+        self.component_items = []
+        self.cluster_items = []
         self.reference_items = []
         self.reference_hkl = {}
 
@@ -443,6 +486,9 @@ class PatternWidget(QWidget):
         self.plot_widget.addItem(self.lr, ignoreBounds=True)
         self.lr.setVisible(False)  # Hide the LinearRegionItem by default
 
+        # additional linear regions for multiple radial rois (see add_linear_region)
+        self.extra_lrs = []
+
         self.fill_plots = [pg.PlotDataItem(pen="#FFFFFF00"), pg.PlotDataItem(pen="#FFFFFF00")]
         for fill_plot in self.fill_plots:
             self.plot_widget.addItem(fill_plot)
@@ -499,10 +545,20 @@ class PatternWidget(QWidget):
         self.avg_pattern_item = pg.PlotDataItem(pen='#AAAAAA', name='Average Pattern')
         self.plot_widget.getPlotItem().addItem(self.avg_pattern_item)
 
+        # create a plot item for the average pattern of a range of frames
+        self.range_avg_pattern_item = pg.PlotDataItem(pen=pg.mkPen('#AAAAAA', style=QtCore.Qt.PenStyle.DashLine),
+                                                      name='Range Average')
+        self.plot_widget.getPlotItem().addItem(self.range_avg_pattern_item)
+
         # Add a legend to the plot
         self.legend = self.plot_widget.getPlotItem().addLegend()
         self.legend.addItem(self.avg_pattern_item, 'Average Pattern')
         self.legend.items[0][0].item.setVisible(False)  # Hide the average pattern by default
+        self.legend.addItem(self.range_avg_pattern_item, 'Range Average')
+        self.legend.items[1][0].item.setVisible(False)  # Hide the range average pattern by default
+        # request a range average update when shown from the legend
+        self.range_avg_pattern_item.visibleChanged.connect(
+            lambda: self.sigRangeAvgVisibilityChanged.emit(self.range_avg_pattern_item.isVisible()))
 
         # Create a plot item for the pattern
         self.add_pattern()
@@ -567,6 +623,10 @@ class PatternWidget(QWidget):
         action.setToolTip("Subtract current pattern")
         action.triggered.connect(lambda: self.sigRequestSubtractPattern.emit())
 
+        action = self.toolbar.addAction("\u00D7bgr")
+        action.setToolTip("Scale the subtracted pattern to each frame in the linear region(s)")
+        action.triggered.connect(lambda: self.sigRequestScaleBackground.emit())
+
         self.toolbar.addSeparator()
 
         icon = QIcon(":/icons/correlation.png")
@@ -588,6 +648,7 @@ class PatternWidget(QWidget):
         menu = QMenu()
         menu.setToolTipsVisible(False)
         menu.addAction("Export average pattern", lambda: self.sigRequestExportAvg.emit())
+        menu.addAction("Export range average pattern", lambda: self.sigRequestExportRangeAvg.emit())
         menu.addAction("Export current pattern(s)", lambda: self.sigRequestExportCurrent.emit())
         menu.addAction("Export all patterns", lambda: self.sigRequestExportAll.emit())
 
@@ -639,8 +700,7 @@ class PatternWidget(QWidget):
         """Set the name of the pattern item."""
         if name is None:
             name = f"frame {index}"
-        offset = 1+len(self.locked_pattern_items)
-        self.legend.items[index+offset][1].setText(name)  # update the legend item text
+        self.set_legend_name(self.pattern_items[index], name)  # update the legend item text
     
     def add_locked_pattern(self,x,y,name):
         """Add a new locked pattern item to the plot."""
@@ -690,6 +750,54 @@ class PatternWidget(QWidget):
         self.plot_widget.getPlotItem().removeItem(pattern)
         self.legend.removeItem(pattern)
 
+    def set_component_data(self, components, names=None):
+        """
+        Set the component patterns (e.g. from a decomposition of the stack),
+        shown as dotted lines on the current x-axis. Replaces any previous components.
+        """
+        self.clear_components()
+        if components is None:
+            return
+        if names is None:
+            names = [f"component {i+1}" for i in range(len(components))]
+        for i, (y, name) in enumerate(zip(components, names)):
+            color = self.color_cycle[i % len(self.color_cycle)]
+            pen = pg.mkPen(color=color, width=1, style=QtCore.Qt.PenStyle.DotLine)
+            item = self.plot_widget.getPlotItem().plot(self.x, y, pen=pen, name=name)
+            item.setZValue(-1)
+            self.component_items.append(item)
+
+    def clear_components(self):
+        """Remove the component patterns from the plot."""
+        for item in self.component_items:
+            self.plot_widget.getPlotItem().removeItem(item)
+            self.legend.removeItem(item)
+        self.component_items = []
+
+    def set_cluster_data(self, means, names=None, colors=None):
+        """
+        Set the mean patterns of frame clusters, shown as thick lines on the current
+        x-axis in the given colors. Replaces any previous cluster patterns.
+        """
+        self.clear_clusters()
+        if means is None:
+            return
+        if names is None:
+            names = [f"cluster {i+1}" for i in range(len(means))]
+        if colors is None:
+            colors = [self.color_cycle[i % len(self.color_cycle)] for i in range(len(means))]
+        for y, name, color in zip(means, names, colors):
+            item = self.plot_widget.getPlotItem().plot(self.x, y, pen=pg.mkPen(color=color, width=2), name=name)
+            item.setZValue(-1)
+            self.cluster_items.append(item)
+
+    def clear_clusters(self):
+        """Remove the cluster mean patterns from the plot."""
+        for item in self.cluster_items:
+            self.plot_widget.getPlotItem().removeItem(item)
+            self.legend.removeItem(item)
+        self.cluster_items = []
+
     def add_reference(self, hkl, x, I,color=None):
         """Add a reference pattern to the plot."""
         if color is None:
@@ -807,6 +915,25 @@ class PatternWidget(QWidget):
         self.avg_pattern_item.setData(self.x, y_avg)
         self.y_avg = y_avg
 
+    def set_range_avg_data(self, y_avg, name='Range Average'):
+        """Set the range average data and legend name for the pattern."""
+        if y_avg is None:
+            self.range_avg_pattern_item.setData([], [])
+            return
+        self.range_avg_pattern_item.setData(self.x, y_avg)
+        self.set_legend_name(self.range_avg_pattern_item, name)
+
+    def set_legend_name(self, item, name):
+        """Set the legend name of a plot item."""
+        for sample, label in self.legend.items:
+            if sample.item is item:
+                label.setText(name)
+                return
+
+    def is_range_avg_visible(self):
+        """Return True if the range average pattern is visible."""
+        return self.range_avg_pattern_item.isVisible()
+
     def set_xlabel(self, label):
         """Set the x-axis label."""
         self.get_axis('x').setLabel(label)
@@ -847,6 +974,8 @@ class PatternWidget(QWidget):
                 self.lr.setRegion([np.clip(x_min,self.x[0],self.x[-10]),
                                    np.clip(x_max,self.x[10],self.x[-1])])
         self.lr.setVisible(show)
+        for lr in self.extra_lrs:
+            lr.setVisible(show)
         self.fill_area.setVisible(show)
         self.button_default.setVisible(show)
         self.button_ign_neg.setVisible(show)
@@ -862,6 +991,44 @@ class PatternWidget(QWidget):
         roi = (self.x >= x_min) & (self.x <= x_max)
         return roi
     
+    def get_linear_region_rois(self):
+        """
+        Get the roi boolean masks of all linear regions, starting with the
+        primary linear region, or an empty list if the regions are hidden.
+        """
+        if not self.lr.isVisible() or self.x is None:
+            return []
+        rois = []
+        for lr in [self.lr] + self.extra_lrs:
+            x_min, x_max = lr.getRegion()
+            rois.append((self.x >= x_min) & (self.x <= x_max))
+        return rois
+
+    def add_linear_region(self):
+        """Add a linear region for an additional radial roi next to the last linear region."""
+        x_min, x_max = (self.extra_lrs[-1] if self.extra_lrs else self.lr).getRegion()
+        width = x_max - x_min
+        color = self.roi_colors[len(self.extra_lrs) % len(self.roi_colors)]
+        lr = pg.LinearRegionItem(values=[x_max + width/2, x_max + width*1.5],
+                                 orientation="vertical",
+                                 brush=color+"50",
+                                 hoverBrush=color+"80",
+                                 pen=color+"AA",
+                                 )
+        self.plot_widget.addItem(lr, ignoreBounds=True)
+        lr.setVisible(self.lr.isVisible())
+        lr.sigRegionChangeFinished.connect(lambda: self.sigLinearRegionChangedFinished.emit(self.get_linear_region_roi()))
+        self.extra_lrs.append(lr)
+        self.sigLinearRegionChangedFinished.emit(self.get_linear_region_roi())
+
+    def remove_linear_region(self):
+        """Remove the last added linear region."""
+        if not self.extra_lrs:
+            return
+        lr = self.extra_lrs.pop(-1)
+        self.plot_widget.removeItem(lr)
+        self.sigLinearRegionChangedFinished.emit(self.get_linear_region_roi())
+
     def update_fill_area(self):
         """Update the fill area between the linear region box."""
         roi = self.get_linear_region_roi()
@@ -1078,6 +1245,23 @@ class AuxiliaryPlotWidget(QWidget):
                 continue
             self.plot_item.addItem(v_line)
 
+    def set_named_data(self, y, label):
+        """Set the data of the plot item with the given label, adding it if not present."""
+        if y is None:
+            return
+        for plot_data_item in self.plot_data_items:
+            if plot_data_item.name() == label:
+                plot_data_item.setData(np.arange(len(y)), y)
+                self.n = len(y)
+                return
+        self.set_data(y, label=label)
+
+    def remove_named_data(self, label):
+        """Remove the plot item(s) with the given label."""
+        for plot_data_item in [item for item in self.plot_data_items if item.name() == label]:
+            self.plot_item.removeItem(plot_data_item)
+            self.plot_data_items.remove(plot_data_item)
+
     def addVLine(self, pos=0):
         """Add a horizontal line to the plot."""
         pen = pg.mkPen(color=self.color_cycle[len(self.v_lines) % len(self.color_cycle)], width=1)
@@ -1244,6 +1428,14 @@ class BasicMapWidget(QWidget):
         
         self.plot_widget.addItem(self.cursor)
 
+        # create markers for highlighting map positions
+        self.markers = pg.ScatterPlotItem(size=0.6,
+                                          pen=pg.mkPen((255, 0, 0, 200), width=2),
+                                          brush=pg.mkBrush(None),
+                                          symbol='o',
+                                          pxMode=False)
+        self.plot_widget.addItem(self.markers)
+
         tr = QTransform()
         tr.translate(-0.5, -0.5)
         self.image_item.setTransform(tr)       
@@ -1277,11 +1469,19 @@ class BasicMapWidget(QWidget):
         if im is None:
             return
         if self.transposed:
-            im = im.T
-        if self.log_scale:
+            im = self._transpose(im)
+        if self.log_scale and im.ndim == 2:
             im = np.log10(im, where=(im>0), out=np.zeros_like(im))
         self.image_item.setImage(im)
 
+    def _transpose(self, im):
+        """Transpose the spatial axes of a (color) image."""
+        return np.swapaxes(im, 0, 1)
+
+    def image_to_map_pos(self, x, y):
+        """Convert an image pixel position to a map position. Reimplemented by subclasses."""
+        return x, y
+
     def image_double_clicked(self, event):
         """Handle the double click event on the image item."""
         if event.button() == QtCore.Qt.MouseButton.LeftButton and self.image_item.image is not None:
@@ -1291,9 +1491,10 @@ class BasicMapWidget(QWidget):
             x, y = int(pos.x()+0.5), int(pos.y()+0.5)
             # ignore clicks outside the image area or on nan values
             if x < 0 or x >= shape[0] or y < 0 or y >= shape[1] \
-            or np.isnan(self.image_item.image[x, y]):
+            or np.all(np.isnan(self.image_item.image[x, y])):
                 self.hide_cursor()
             else:
+                x, y = self.image_to_map_pos(x, y)
                 self.move_cursor(x, y)
                 self.sigImageDoubleClicked.emit((x, y))
     
@@ -1305,6 +1506,10 @@ class BasicMapWidget(QWidget):
         """Hide the cursor."""
         self.cursor.setData(x=[], y=[])
 
+    def set_markers(self, x, y):
+        """Highlight the specified positions with markers."""
+        self.markers.setData(x=x, y=y)
+
     def updateBackground(self):
         """
         Update the background color of the plot widget to the current default
@@ -1350,11 +1555,11 @@ class BasicMapWidget(QWidget):
         """Toggle logarithmic scale for the color map."""
         im = self.image_item.image
         # if already in log scale, bring back to linear scale before updating the data
-        if self.log_scale:
+        if self.log_scale and im.ndim == 2:
             im = 10**im
         # if already transposed, bring back to original orientation before updating the data
         if self.transposed:
-            im = im.T
+            im = self._transpose(im)
         self.log_scale = checked
         self.set_data(im)
 
@@ -1362,32 +1567,260 @@ class BasicMapWidget(QWidget):
 class CorrelationMapWidget(BasicMapWidget):
     """
     A widget to display a correlation map. Inherits from BasicMapWidget.
+    Large matrices are shown binned to display resolution (see set_correlation_matrix),
+    and full-resolution tiles of the visible region are computed in a worker thread
+    when the user zooms in to at most max_tile_size frames.
+    Alternatively, the correlation of each frame with the following frames can be
+    shown versus the lag (see set_lagged_matrix).
+    Signals:
+    - sigModeChanged: Emitted when the map mode, maximum lag or roi option is changed.
+    - sigTileError: Emitted with an error message if a full-resolution tile could not be computed.
     """
     sigImageDoubleClicked = QtCore.pyqtSignal(object)  # Signal emitted when the image is double-clicked
+    sigTileReady = QtCore.pyqtSignal(int, object)  # Signal emitted by the worker thread when a tile is computed
+    sigModeChanged = QtCore.pyqtSignal()
+    sigTileError = QtCore.pyqtSignal(str)
     def __init__(self, parent=None):
         super().__init__(parent)
         self.n = None  # Number of data points in the x-axis
+        self.factor = 1  # Binning factor of the displayed matrix
+        self.is_lagged = False  # True if the displayed matrix is a lagged correlation (frames x lags)
+        self.display_size = 1024  # Maximum size of the displayed (binned) matrix (see AzintData.get_correlation_matrix)
+        self.max_tile_size = 2048  # Maximum number of frames of a full-resolution tile
+        self.tile_func = None  # Callable func(rows, cols) returning full-resolution tiles
         self.x_axis.setLabel("frame number #")
         self.y_axis.setLabel("frame number #")
 
-    def set_correlation_data(self, z):
-        """Set the data for the correlation map."""
-        if z is None:
+        self.toolbar.setHidden(False)
+
+        # create a map mode combo box
+        self.mode_combo = QComboBox(self)
+        self.mode_combo.setToolTip("Select the correlation of all pairs of frames, or of each frame\n"
+                                   "with the following frames versus the lag")
+        self.mode_combo.addItem("Frame \u00d7 frame", "full")
+        self.mode_combo.addItem("Frame \u00d7 lag", "lagged")
+        self.mode_combo.setSizeAdjustPolicy(QComboBox.SizeAdjustPolicy.AdjustToContents)
+        self.mode_combo.activated.connect(lambda _: self._mode_changed())
+        self.toolbar.addWidget(QLabel("Mode: "))
+        self.toolbar.addWidget(self.mode_combo)
+
+        # create a maximum lag spin box
+        self.max_lag_spin = QSpinBox(self)
+        self.max_lag_spin.setToolTip("Set the maximum lag (frames) of the lagged correlation")
+        self.max_lag_spin.setRange(1, 100000)
+        self.max_lag_spin.setValue(50)
+        self.max_lag_spin.setEnabled(False)
+        self.max_lag_spin.editingFinished.connect(self._mode_changed)
+        self.toolbar.addWidget(QLabel("Max lag: "))
+        self.toolbar.addWidget(self.max_lag_spin)
+
+        self.toolbar.addSeparator()
+
+        # create a "restrict to roi" checkbox
+        self.roi_check = QCheckBox("ROI", self)
+        self.roi_check.setToolTip("Compute the correlation over the linear region(s) of the pattern plot only")
+        self.roi_check.checkStateChanged.connect(lambda _: self._mode_changed())
+        self.toolbar.addWidget(self.roi_check)
+
+        # create an image item for the full-resolution tile of the visible region
+        self.tile_item = pg.ImageItem()
+        self.tile_item.setVisible(False)
+        self.plot_widget.addItem(self.tile_item)
+        self._tile_key = None  # (x0, x1, y0, y1, log_scale) of the current tile
+        self._tile_generation = 0
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._executor_shut_down = False
+        self.sigTileReady.connect(self._set_tile)
+        # shut down the tile worker with the widget (see shutdown)
+        executor = self._executor
+        self.destroyed.connect(lambda *_: executor.shutdown(wait=False, cancel_futures=True))
+
+        # use the color map and levels of the binned matrix for the tile
+        self.histogram.item.sigLevelsChanged.connect(lambda _: self._sync_tile_item())
+        self.histogram.item.sigLookupTableChanged.connect(lambda _: self._sync_tile_item())
+
+        # request a tile shortly after the view range has changed
+        self._tile_timer = QtCore.QTimer(self)
+        self._tile_timer.setSingleShot(True)
+        self._tile_timer.setInterval(200)
+        self._tile_timer.timeout.connect(self._request_tile)
+        self.plot_widget.getPlotItem().getViewBox().sigRangeChanged.connect(lambda *_: self._tile_timer.start())
+
+    def _mode_changed(self):
+        """Handle changes of the map mode, maximum lag or roi option."""
+        self.max_lag_spin.setEnabled(self.get_mode() == "lagged")
+        self.fnames = None  # force update
+        self.sigModeChanged.emit()
+
+    def get_mode(self):
+        """Get the map mode, 'full' (frame x frame) or 'lagged' (frame x lag)."""
+        return self.mode_combo.currentData()
+
+    def get_max_lag(self):
+        """Get the maximum lag of the lagged correlation."""
+        return self.max_lag_spin.value()
+
+    def is_roi_checked(self):
+        """Return True if the correlation should be computed over the linear region(s) only."""
+        return self.roi_check.isChecked()
+
+    def set_lagged_matrix(self, im, factor=1, n=None):
+        """
+        Set a precomputed lagged correlation matrix of shape (frames/factor, max_lag),
+        i.e. the correlation of each (block of) frame(s) with the frames 1 to max_lag
+        frames later (see plaid.analysis.lagged_correlation). n is the number of frames.
+        """
+        if im is None:
+            return
+        self.is_lagged = True
+        self.factor = factor
+        self.tile_func = None
+        self._tile_generation += 1  # discard pending tiles
+        self._tile_key = None
+        self.tile_item.setVisible(False)
+        self.set_data(im)
+        # the first column is a lag of one frame
+        tr = QTransform()
+        tr.translate(-0.5, 0.5)
+        tr.scale(factor, 1)
+        self.image_item.setTransform(tr)
+        self.y_axis.setLabel("lag (frames)")
+
+        n = n if n is not None else im.shape[0]*factor
+        self.n = n
+        max_lag = im.shape[1]
+        self.plot_widget.setLimits(xMin=-n*.1, xMax=n*1.1, yMin=-max_lag*0.1, yMax=max_lag*1.1+1)
+
+    def set_correlation_matrix(self, im, factor=1, tile_func=None, n=None):
+        """
+        Set a precomputed correlation matrix for the correlation map, binned by
+        factor x factor frames (see plaid.analysis.binned_correlation). tile_func
+        is an optional callable func(rows, cols) returning full-resolution tiles,
+        called from a worker thread. n is the number of frames (im.shape[0]*factor by default).
+        """
+        if im is None:
             return
-        # compute the correlation matrix
-        im = np.corrcoef(z)
+        self.is_lagged = False
+        self.y_axis.setLabel("frame number #")
+        self.factor = factor
+        self.tile_func = tile_func
+        self._tile_generation += 1  # discard pending tiles
+        self._tile_key = None
+        self.tile_item.setVisible(False)
         self.set_data(im)
+        tr = QTransform()
+        tr.translate(-0.5, -0.5)
+        tr.scale(factor, factor)
+        self.image_item.setTransform(tr)
 
-        n = im.shape[0]
+        n = n if n is not None else im.shape[0]*factor
         self.n = n
         # update the limits of the plot
         self.plot_widget.setLimits(xMin=-n*.1, xMax=n*1.1, yMin=-n*0.1, yMax=n*1.1)
 
+    def image_double_clicked(self, event):
+        """
+        Handle the double click event on the image item, emitting the frame numbers
+        of the clicked position, i.e. the frame and the frame lag frames later for
+        a lagged correlation matrix.
+        """
+        if self.factor == 1 and not self.is_lagged:
+            return super().image_double_clicked(event)
+        if event.button() == QtCore.Qt.MouseButton.LeftButton and self.image_item.image is not None:
+            event.accept()
+            pos = self.plot_widget.getPlotItem().vb.mapSceneToView(event.pos())
+            x, y = int(pos.x()+0.5), int(pos.y()+0.5)
+            # for a lagged correlation matrix, y is the lag
+            y_frame = x + y if self.is_lagged else y
+            if (x < 0 or x >= self.n or y_frame < 0 or y_frame >= self.n
+                    or (self.is_lagged and not 1 <= y <= self.image_item.image.shape[1])):
+                self.hide_cursor()
+            else:
+                self.move_cursor(x, y)
+                self.sigImageDoubleClicked.emit((x, y_frame))
+
+    def _request_tile(self):
+        """Compute a full-resolution tile of the visible region in the worker thread, if zoomed in sufficiently."""
+        if self.factor == 1 or self.tile_func is None or self.n is None or self._executor_shut_down:
+            self.tile_item.setVisible(False)
+            return
+        (x0, x1), (y0, y1) = self.plot_widget.getPlotItem().getViewBox().viewRange()
+        x0, x1 = max(0, int(np.floor(x0+0.5))), min(self.n, int(np.ceil(x1+0.5)))
+        y0, y1 = max(0, int(np.floor(y0+0.5))), min(self.n, int(np.ceil(y1+0.5)))
+        if x1 <= x0 or y1 <= y0 or (x1-x0)*(y1-y0) > self.max_tile_size**2:
+            self._tile_generation += 1  # discard pending tiles
+            self._tile_key = None
+            self.tile_item.setVisible(False)
+            return
+        key = (x0, x1, y0, y1, self.log_scale)
+        if key == self._tile_key:
+            return
+        self._tile_key = key
+        self._tile_generation += 1
+        generation, tile_func = self._tile_generation, self.tile_func
+        future = self._executor.submit(tile_func, slice(x0, x1), slice(y0, y1))
+        # the signal is emitted from the worker thread and queued to the GUI thread
+        future.add_done_callback(lambda f: self.sigTileReady.emit(generation, (x0, y0, f)))
+
+    def _set_tile(self, generation, result):
+        """Show a computed tile, unless it has been superseded by a later request."""
+        x0, y0, future = result
+        if generation != self._tile_generation:
+            return
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self.sigTileError.emit(f"Error computing the correlation tile: {future.exception()}")
+            return
+        tile = future.result()
+        if self.log_scale:
+            tile = np.log10(tile, where=(tile>0), out=np.zeros_like(tile))
+        self.tile_item.setImage(tile, autoLevels=False)
+        tr = QTransform()
+        tr.translate(x0-0.5, y0-0.5)
+        self.tile_item.setTransform(tr)
+        self._sync_tile_item()
+        self.tile_item.setVisible(True)
+
+    def shutdown(self):
+        """Discard any pending tiles and shut down the tile worker thread."""
+        self._tile_timer.stop()
+        self._tile_generation += 1
+        self.tile_func = None
+        self._executor_shut_down = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def closeEvent(self, event):
+        """Shut down the tile worker thread when the widget is closed."""
+        self.shutdown()
+        super().closeEvent(event)
+
+    def _sync_tile_item(self):
+        """Apply the levels and color map of the histogram to the tile."""
+        if self.tile_item.image is None:
+            return
+        self.tile_item.setLevels(self.histogram.item.getLevels())
+        self.tile_item.setLookupTable(self.histogram.item.getLookupTable(n=256))
+
 
 class DiffractionMapWidget(BasicMapWidget):
     """
     A widget to display a diffraction map. Inherits from BasicMapWidget.
+    Multiple maps (one per radial roi) can be shown either as a single map,
+    as an RGB composite of the first three maps or as a grid of maps.
+    Signals:
+    - sigQuantityChanged: Emitted when the roi quantity or the auxiliary plot option is changed.
+    - sigRequestAddRoi: Emitted when the user requests an additional roi.
+    - sigRequestRemoveRoi: Emitted when the user requests the removal of the last roi.
     """
+    sigQuantityChanged = QtCore.pyqtSignal()
+    sigRequestAddRoi = QtCore.pyqtSignal()
+    sigRequestRemoveRoi = QtCore.pyqtSignal()
+    # roi quantities {label: quantity} (see AzintData.get_roi_maps)
+    quantities = {"Mean": "mean",
+                  "Area": "area",
+                  "Centroid": "centroid",
+                  "Variance": "variance"}
 
     def __init__(self, parent=None,map_shape_options=None):
         super().__init__(parent)
@@ -1424,6 +1857,47 @@ class DiffractionMapWidget(BasicMapWidget):
         self.flip_rows_check.checkStateChanged.connect(self.update_map)
         self.toolbar.addWidget(self.flip_rows_check)
 
+        self.toolbar.addSeparator()
+
+        # create a roi quantity combo box
+        self.quantity_combo = QComboBox(self)
+        self.quantity_combo.setToolTip("Select the quantity of the linear region to map")
+        self.quantity_combo.setSizeAdjustPolicy(QComboBox.SizeAdjustPolicy.AdjustToContents)
+        for label, quantity in self.quantities.items():
+            self.quantity_combo.addItem(label, quantity)
+        self.quantity_combo.activated.connect(lambda _: self.sigQuantityChanged.emit())
+        self.toolbar.addWidget(QLabel("Quantity: "))
+        self.toolbar.addWidget(self.quantity_combo)
+
+        # create a "show in auxiliary plot" checkbox
+        self.auxiliary_check = QCheckBox("Auxiliary", self)
+        self.auxiliary_check.setToolTip("Plot the quantity in the auxiliary plot")
+        self.auxiliary_check.checkStateChanged.connect(lambda _: self.sigQuantityChanged.emit())
+        self.toolbar.addWidget(self.auxiliary_check)
+
+        self.toolbar.addSeparator()
+
+        # add actions to add and remove rois
+        action = self.toolbar.addAction("+ROI")
+        action.setToolTip("Add a linear region for an additional roi")
+        action.triggered.connect(lambda: self.sigRequestAddRoi.emit())
+        action = self.toolbar.addAction("\u2212ROI")
+        action.setToolTip("Remove the last added linear region")
+        action.triggered.connect(lambda: self.sigRequestRemoveRoi.emit())
+
+        # create a multiple roi view combo box
+        self.view_combo = QComboBox(self)
+        self.view_combo.setToolTip("Select how to show the maps of multiple rois:\n"
+                                   "Single: the first roi only\n"
+                                   "RGB: the first three rois as red, green and blue\n"
+                                   "Grid: all rois side by side")
+        self.view_combo.addItems(["Single", "RGB", "Grid"])
+        self.view_combo.setCurrentIndex(2)
+        self.view_combo.setSizeAdjustPolicy(QComboBox.SizeAdjustPolicy.AdjustToContents)
+        self.view_combo.activated.connect(lambda _: self.update_map())
+        self.toolbar.addWidget(QLabel("View: "))
+        self.toolbar.addWidget(self.view_combo)
+
         self.x_axis.setLabel("x-axis (px)")
         self.y_axis.setLabel("y-axis (px)")
 
@@ -1434,12 +1908,14 @@ class DiffractionMapWidget(BasicMapWidget):
 
     def set_diffraction_data(self, z):
         """
-        Set the data for the diffraction map. Takes a 1D array and
-        reshapes it into a square 2D array for display.
+        Set the data for the diffraction map. Takes a 1D array, or a 2D
+        array of shape (number of maps, pixels), and reshapes it into 2D
+        array(s) of the map shape for display.
         """
         if z is None or self.map_shape is None:
             return
-        if len(z) != np.prod(self.map_shape):
+        z = np.asarray(z)
+        if z.shape[-1] != np.prod(self.map_shape):
             raise ValueError("The length of z does not match the product of map_shape.")
         self.z = z
         self.is_snake = False
@@ -1449,13 +1925,52 @@ class DiffractionMapWidget(BasicMapWidget):
         """Update the diffraction map with the current data and shape."""
         if self.z is None or self.map_shape is None:
             return
-        im = self.z.reshape(self.map_shape)
+        ims = self._reshape(self.z)
         if self.flip_rows_check.isChecked() != self.is_snake:
-            im[1::2] = im[1::2, ::-1]
+            ims[:, 1::2] = ims[:, 1::2, ::-1]
             self.is_snake = self.flip_rows_check.isChecked()
+        view = self.view_combo.currentText()
+        if len(ims) == 1 or view == "Single":
+            im = ims[0]
+        elif view == "RGB":
+            im = np.zeros(ims.shape[1:] + (3,))
+            for i, _im in enumerate(ims[:3]):
+                im[..., i] = self._normalize(_im)
+            im[np.all(np.isnan(ims[:3]), axis=0)] = np.nan
+        else:
+            # tile the normalized maps in a grid, separated by nan pixels
+            n_rows = int(np.ceil(np.sqrt(len(ims))))
+            n_cols = int(np.ceil(len(ims) / n_rows))
+            h, w = ims.shape[1:]
+            im = np.full((n_rows*(h+1)-1, n_cols*(w+1)-1), np.nan)
+            for i, _im in enumerate(ims):
+                row, col = i % n_rows, i // n_rows
+                im[row*(h+1):row*(h+1)+h, col*(w+1):col*(w+1)+w] = self._normalize(_im)
         self.set_data(im)
         self.autoRange()
 
+    def _reshape(self, z):
+        """Reshape the data to an array of maps (view) of shape (number of maps, *map_shape)."""
+        return z.reshape((-1,) + tuple(self.map_shape))
+
+    def _normalize(self, im):
+        """Normalize a map to [0, 1] between its 1st and 99th percentiles."""
+        if np.all(np.isnan(im)):
+            return im
+        lo, hi = np.nanpercentile(im, [1, 99])
+        if hi <= lo:
+            return np.zeros_like(im)
+        return np.clip((im - lo) / (hi - lo), 0, 1)
+
+    def image_to_map_pos(self, x, y):
+        """Convert an image pixel position to a map position, accounting for grid view."""
+        if self.z is None or self.z.ndim == 1 or len(self.z) == 1 or self.view_combo.currentText() != "Grid":
+            return x, y
+        h, w = self.map_shape
+        if self.transposed:
+            h, w = w, h
+        return x % (h+1), y % (w+1)
+
     def set_map_shape_options(self, options,current_index=None):
         """Set the options for the map shape combo boxes. Options should be a list of integers."""
         self.map_shape_combo.clear()
@@ -1472,6 +1987,35 @@ class DiffractionMapWidget(BasicMapWidget):
             self.map_shape_combo.setCurrentIndex(len(options)//2)
         self.map_shape = self.map_shape_combo.itemData(self.map_shape_combo.currentIndex())
 
+    def add_quantity(self, label, quantity):
+        """Add a quantity option to the quantity combo box, if not already present."""
+        if self.quantity_combo.findData(quantity) < 0:
+            self.quantity_combo.addItem(label, quantity)
+
+    def set_quantity(self, quantity):
+        """Select a quantity in the quantity combo box, if present."""
+        index = self.quantity_combo.findData(quantity)
+        if index >= 0:
+            self.quantity_combo.setCurrentIndex(index)
+
+    def remove_quantity(self, quantity):
+        """Remove a quantity option from the quantity combo box, if present."""
+        index = self.quantity_combo.findData(quantity)
+        if index >= 0:
+            self.quantity_combo.removeItem(index)
+
+    def get_quantity(self):
+        """Get the selected roi quantity, e.g. 'mean' or 'centroid'."""
+        return self.quantity_combo.currentData()
+
+    def get_quantity_label(self):
+        """Get the label of the selected roi quantity, e.g. 'Mean' or 'Centroid'."""
+        return self.quantity_combo.currentText()
+
+    def is_auxiliary_checked(self):
+        """Return True if the quantity should be shown in the auxiliary plot."""
+        return self.auxiliary_check.isChecked()
+
     def map_shape_changed(self, index):
         """Handle the change of the map shape combo box."""
         shape = self.map_shape_combo.itemData(index)
@@ -1479,8 +2023,8 @@ class DiffractionMapWidget(BasicMapWidget):
             # check if the rows need to be "unflipped" (snake)
             # before the shape is changed
             if self.is_snake:
-                im = self.z.reshape(self.map_shape)
-                im[1::2] = im[1::2, ::-1]
+                ims = self._reshape(self.z)
+                ims[:, 1::2] = ims[:, 1::2, ::-1]
                 self.is_snake = False
             self.map_shape = shape
             self.update_map()
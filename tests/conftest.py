@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures of the plaid tests, based on the demo file scan-0100_1D_demo.h5
+(100 frames of 2000 radial bins).
+"""
+import os
+import sys
+import numpy as np
+import h5py as h5
+import pytest
+
+# run Qt headless and resolve the package the same way as plaid/plaid.py
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+if os.path.join(ROOT, "plaid") not in sys.path:
+    sys.path.append(os.path.join(ROOT, "plaid"))
+
+from plaid.data_containers import AzintData  # noqa: E402
+
+DEMO_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scan-0100_1D_demo.h5")
+
+
+@pytest.fixture(scope="session")
+def demo():
+    """The (x, I, I0) arrays of the demo file."""
+    with h5.File(DEMO_FILE, 'r') as f:
+        x = f['entry/data/radial_axis'][()]
+        I = f['entry/data/I'][()]
+        I0 = f['entry/monitor/data'][()]
+    return x, I, I0
+
+
+@pytest.fixture
+def azint_data(demo):
+    """An AzintData instance holding a copy of the demo data, without a derived product cache."""
+    x, I, _ = demo
+    azint_data = AzintData()
+    azint_data.x = x.copy()
+    azint_data.I = I.copy()
+    azint_data.shape = azint_data.I.shape
+    azint_data.build_reduction_pyramid()
+    return azint_data
+
+
+@pytest.fixture(scope="session")
+def qapp():
+    """The (offscreen) QApplication of the widget tests."""
+    from PyQt6.QtWidgets import QApplication
+    return QApplication.instance() or QApplication([])
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
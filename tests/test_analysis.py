@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""Tests of the stack analysis functions in plaid.analysis."""
+import numpy as np
+import pytest
+
+from plaid.analysis import (randomized_pca, nmf, decompose_stack, standardize_frames, binned_correlation,
+                            correlation_tile, lagged_correlation, kmeans, cluster_frames,
+                            detect_change_points)
+
+
+def get_chunk_func(I):
+    return lambda i, j: I[i:j]
+
+
+def test_randomized_pca(demo):
+    _, I, _ = demo
+    I = I.astype(np.float64)
+    mean, components, scores, explained_variance_ratio = randomized_pca(get_chunk_func(I), I.shape, 3, seed=0,
+                                                                        chunk_bytes=2**16)
+    np.testing.assert_allclose(mean, I.mean(axis=0), rtol=1e-10, atol=1e-8)
+    s = np.linalg.svd(I - I.mean(axis=0), compute_uv=False)
+    np.testing.assert_allclose(explained_variance_ratio, s[:3]**2 / np.sum(s**2), rtol=1e-4)
+    np.testing.assert_allclose(np.sqrt(np.mean(scores**2, axis=0)), 1.)
+    # the approximation equals the projection on the leading right singular vectors
+    _, _, Vt = np.linalg.svd(I - I.mean(axis=0), full_matrices=False)
+    expected = (I - I.mean(axis=0)) @ Vt[:3].T @ Vt[:3]
+    np.testing.assert_allclose(scores @ components, expected, atol=1e-3 * np.abs(expected).max())
+
+
+def test_nmf(rng):
+    H = rng.random((2, 50))
+    W = rng.random((80, 2))
+    I = W @ H
+    components, scores = nmf(get_chunk_func(I), I.shape, 2, n_iter=500, seed=0, chunk_bytes=2**12)
+    assert np.all(components >= 0) and np.all(scores >= 0)
+    np.testing.assert_allclose(scores.mean(axis=0), 1.)
+    assert np.linalg.norm(scores @ components - I) < 0.01 * np.linalg.norm(I)
+
+
+def test_decompose_stack(demo):
+    _, I, _ = demo
+    frame_mask = np.ones(I.shape[0], dtype=bool)
+    frame_mask[10:20] = False
+    components, scores, params = decompose_stack(I, "pca", 3, frame_mask=frame_mask, fill=I.mean(axis=0), seed=0)
+    assert components.shape == (3, I.shape[1]) and scores.shape == (I.shape[0], 3)
+    assert np.isnan(scores[~frame_mask]).all() and np.isfinite(scores[frame_mask]).all()
+    assert params["method"] == "pca" and params["n_components"] == 3
+    assert decompose_stack(I, "pca", 3, progress=lambda fraction: False) is None
+    with pytest.raises(ValueError):
+        decompose_stack(I, "ica", 3)
+
+
+@pytest.mark.parametrize("centered", [True, False])
+def test_standardize_frames(demo, centered):
+    _, I, _ = demo
+    Z = standardize_frames(I, centered, chunk_bytes=2**16)
+    assert Z.dtype == np.float32
+    np.testing.assert_allclose(np.linalg.norm(Z, axis=1), 1., rtol=1e-5)
+    if centered:
+        np.testing.assert_allclose(Z @ Z.T, np.corrcoef(I.astype(np.float64)), atol=1e-5)
+
+
+def test_binned_correlation(demo):
+    _, I, _ = demo
+    Z = standardize_frames(I)
+    C = np.corrcoef(I.astype(np.float64))
+    np.testing.assert_allclose(binned_correlation(Z, 1, chunk_bytes=2**16), C, atol=1e-5)
+    # the binned matrix is the average of the correlations in each block
+    factor = 3
+    n_bins = -(-I.shape[0] // factor)
+    expected = np.array([[C[a*factor:(a+1)*factor, b*factor:(b+1)*factor].mean() for b in range(n_bins)]
+                         for a in range(n_bins)])
+    np.testing.assert_allclose(binned_correlation(Z, factor, chunk_bytes=2**16), expected, atol=1e-5)
+
+
+def test_binned_correlation_frame_mask(demo):
+    _, I, _ = demo
+    Z = standardize_frames(I)
+    frame_mask = np.ones(I.shape[0], dtype=bool)
+    frame_mask[[0, 1, 5]] = False
+    C = np.corrcoef(I.astype(np.float64))
+    im = binned_correlation(Z, 2, frame_mask)
+    assert np.isnan(im[0]).all() and np.isnan(im[:, 0]).all()
+    np.testing.assert_allclose(im[2, 3], C[5:6, 6:8].mean(), atol=1e-5)
+    np.testing.assert_allclose(im[4, 4], C[8:10, 8:10].mean(), atol=1e-5)
+
+
+@pytest.mark.parametrize("rows, cols", [(slice(None), slice(None)), (slice(5, 70), slice(5, 70)),
+                                        (slice(0, 40), slice(30, 100)), (slice(0, 100, 3), slice(1, 99, 2))])
+def test_correlation_tile(demo, rows, cols):
+    _, I, _ = demo
+    Z = standardize_frames(I)
+    C = np.corrcoef(I.astype(np.float64))
+    frame_mask = np.ones(I.shape[0], dtype=bool)
+    frame_mask[33] = False
+    expected = C[rows, cols].copy()
+    expected[~frame_mask[rows], :] = np.nan
+    expected[:, ~frame_mask[cols]] = np.nan
+    np.testing.assert_allclose(correlation_tile(Z, rows, cols, frame_mask, tile_size=16), expected, atol=1e-5)
+
+
+def test_lagged_correlation(demo):
+    _, I, _ = demo
+    Z = standardize_frames(I)
+    C = np.corrcoef(I.astype(np.float64))
+    n, max_lag = I.shape[0], 10
+    frame_mask = np.ones(n, dtype=bool)
+    frame_mask[50] = False
+    im = lagged_correlation(Z, max_lag, frame_mask)
+    assert im.shape == (n, max_lag)
+    for i in range(n):
+        for lag in range(1, max_lag + 1):
+            j = i + lag
+            if j >= n or not (frame_mask[i] and frame_mask[j]):
+                assert np.isnan(im[i, lag-1])
+            else:
+                assert np.isclose(im[i, lag-1], C[i, j], atol=1e-5)
+
+
+def blobs(rng, n=300, centers=((0, 0), (10, 0), (0, 10))):
+    labels = np.arange(n) % len(centers)
+    return np.asarray(centers, dtype=float)[labels] + rng.normal(0, 0.5, (n, 2)), labels
+
+
+def same_partition(a, b):
+    """Check that two label arrays define the same partition up to a permutation of the labels."""
+    return np.all((a[:, None] == a[None, :]) == (b[:, None] == b[None, :]))
+
+
+def test_kmeans(rng):
+    X, labels = blobs(rng)
+    result, centers = kmeans(X, 3, seed=0, chunk_size=64)
+    assert same_partition(result, labels)
+    for c in range(3):
+        np.testing.assert_allclose(centers[c], X[result == c].mean(axis=0))
+    assert kmeans(X, 3, seed=0, progress=lambda fraction: False) is None
+
+
+def test_cluster_frames(rng):
+    X, labels = blobs(rng, n=120)
+    patterns = rng.random((2, 200))
+    I = X @ patterns + rng.normal(0, 0.01, (120, 200))
+    frame_mask = np.ones(len(I), dtype=bool)
+    frame_mask[[7, 8]] = False
+    I[[7, 8]] = 1e3  # masked outliers must not affect the fit
+    result, means = cluster_frames(I, 3, n_components=2, frame_mask=frame_mask, seed=0)
+    assert np.all(result[~frame_mask] == -1)
+    assert same_partition(result[frame_mask], labels[frame_mask])
+    for c in range(3):
+        np.testing.assert_allclose(means[c], I[result == c].mean(axis=0))
+
+
+@pytest.mark.parametrize("n_change_points", [None, 2])
+def test_detect_change_points(rng, n_change_points):
+    X = np.repeat([[0., 0.], [3., 0.], [3., -2.]], [40, 35, 50], axis=0) + rng.normal(0, 0.3, (125, 2))
+    indices, gains = detect_change_points(X, n_change_points)
+    np.testing.assert_array_equal(indices, [40, 75])
+    assert np.all(gains > 0)
+
+
+def test_detect_change_points_non_finite(rng):
+    x = np.repeat([1., 4.], [30, 30]) + rng.normal(0, 0.2, 60)
+    x[[10, 45]] = np.nan
+    indices, _ = detect_change_points(x, 1)
+    np.testing.assert_array_equal(indices, [30])
+    indices, _ = detect_change_points(rng.normal(0, 1., 200))
+    assert len(indices) == 0
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""Tests of the processing of the intensity data in plaid.data_containers.AzintData."""
+import numpy as np
+import pytest
+
+from plaid.misc import average_blocks, savgol_kernel, smooth_stack, despike_frames, estimate_background
+
+
+@pytest.fixture
+def processed(azint_data, demo):
+    """The demo AzintData with I0, a background and a frame mask set."""
+    _, I, I0 = demo
+    azint_data.set_I0(I0.copy())
+    azint_data.set_y_bgr(I[:10].mean(axis=0))
+    frame_mask = np.ones(I.shape[0], dtype=bool)
+    frame_mask[[3, 50, 51]] = False
+    azint_data.set_frame_mask(frame_mask)
+    return azint_data
+
+
+def reference_I(azint_data):
+    """The background subtracted and I0 normalized stack computed directly."""
+    I = azint_data.I.astype(np.float64)
+    return (I - azint_data.y_bgr) / azint_data.I0[:, None]
+
+
+def test_get_I(processed):
+    I = processed.get_I()
+    assert not I.flags.writeable
+    np.testing.assert_allclose(I, reference_I(processed), rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(processed.get_I(index=7), reference_I(processed)[7], rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(processed.get_I(index=slice(20, 30)), reference_I(processed)[20:30],
+                               rtol=1e-5, atol=1e-6)
+    np.testing.assert_array_equal(processed.get_I(I0_normalized=False, bgr_subtracted=False), processed.I)
+
+
+def test_get_I_cache_invalidation(processed):
+    first = processed.get_I()
+    assert processed.get_I() is first
+    processed.set_y_bgr(processed.I[-5:].mean(axis=0))
+    second = processed.get_I()
+    assert second is not first
+    np.testing.assert_allclose(second, reference_I(processed), rtol=1e-5, atol=1e-6)
+
+
+def test_get_average_I(processed):
+    valid = processed.frame_mask
+    expected = reference_I(processed)[valid].mean(axis=0)
+    np.testing.assert_allclose(processed.get_average_I(), expected, rtol=1e-5, atol=1e-4)
+    expected = processed.I[valid].astype(np.float64).mean(axis=0)
+    np.testing.assert_allclose(processed.get_average_I(I0_normalized=False, bgr_subtracted=False), expected,
+                               rtol=1e-5, atol=1e-4)
+
+
+def test_get_average_I_bgr_scale(processed):
+    mask = processed.x > 20
+    assert processed.fit_bgr_scale(mask)
+    I = processed.I.astype(np.float64)
+    I_bgr = np.multiply.outer(processed.bgr_scale, processed.y_bgr) + processed.bgr_offset[:, None]
+    expected = ((I - I_bgr) / processed.I0[:, None])[processed.frame_mask].mean(axis=0)
+    np.testing.assert_allclose(processed.get_average_I(), expected, rtol=1e-5, atol=1e-4)
+
+
+def test_fit_bgr_scale(azint_data, demo):
+    _, I, _ = demo
+    y_bgr = I[0].astype(np.float64)
+    scale = np.linspace(0.5, 2., I.shape[0])
+    azint_data.I = np.multiply.outer(scale, y_bgr) + 3.
+    azint_data.set_y_bgr(y_bgr)
+    assert azint_data.fit_bgr_scale(np.ones(y_bgr.shape, dtype=bool))
+    np.testing.assert_allclose(azint_data.bgr_scale, scale, rtol=1e-6)
+    np.testing.assert_allclose(azint_data.bgr_offset, 3., rtol=1e-6)
+
+
+@pytest.mark.parametrize("start, stop", [(0, 100), (10, 11), (40, 60), (97, 100)])
+def test_get_range_average_I(processed, start, stop):
+    valid = processed.frame_mask[start:stop]
+    expected = reference_I(processed)[start:stop][valid].mean(axis=0)
+    np.testing.assert_allclose(processed.get_range_average_I(start, stop), expected, rtol=1e-5, atol=1e-4)
+
+
+def test_get_range_average_I_masked_range(processed):
+    assert processed.get_range_average_I(50, 52) is None
+
+
+@pytest.mark.parametrize("linear_background", [False, True])
+def test_get_roi_sums(processed, linear_background):
+    start, stop = 500, 620
+    I = reference_I(processed) * processed.I0[:, None]  # background subtracted, not normalized
+    if linear_background:
+        w1 = np.arange(stop - start) / (stop - start - 1)
+        I_roi = I[:, start:stop] - np.outer(I[:, start], 1 - w1) - np.outer(I[:, stop-1], w1)
+    else:
+        I_roi = I[:, start:stop]
+    I_roi = I_roi / processed.I0[:, None]
+    x = processed.x[start:stop]
+    m, sum_I, sum_xI, sum_x2I = processed.get_roi_sums(start, stop, linear_background=linear_background)
+    assert m == stop - start
+    np.testing.assert_allclose(sum_I, I_roi.sum(axis=1), rtol=1e-6, atol=1e-3)
+    np.testing.assert_allclose(sum_xI, I_roi @ x, rtol=1e-6, atol=1e-3)
+    np.testing.assert_allclose(sum_x2I, I_roi @ x**2, rtol=1e-6, atol=1e-3)
+
+
+def test_get_roi_maps(processed):
+    rois = [(100, 150), (500, 620), (1990, 2000)]
+    maps = processed.get_roi_maps(rois, quantity="mean")
+    assert maps.shape == (len(rois), processed.shape[0])
+    I = reference_I(processed)
+    for (start, stop), z in zip(rois, maps):
+        expected = I[:, start:stop].mean(axis=1)
+        expected[~processed.frame_mask] = np.nan
+        np.testing.assert_allclose(z, expected, rtol=1e-6, atol=1e-6)
+    centroids = processed.get_roi_maps(rois, quantity="centroid", ignore_negative=True)
+    for (start, stop), z in zip(rois, centroids):
+        I_roi = np.clip(I[:, start:stop], 0, None)
+        expected = I_roi @ processed.x[start:stop] / I_roi.sum(axis=1)
+        expected[~processed.frame_mask] = np.nan
+        np.testing.assert_allclose(z, expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize("factor", [2, 4, 3])
+def test_reduction_factor(azint_data, demo, factor):
+    _, I, I0 = demo
+    azint_data.set_I0(I0.copy())
+    azint_data.set_reduction_factor(factor)
+    np.testing.assert_allclose(azint_data.I, average_blocks(I, reduction_factor=factor), rtol=1e-6)
+    np.testing.assert_allclose(azint_data.I0, average_blocks(I0, reduction_factor=factor))
+    assert azint_data.shape == azint_data.I.shape
+    # the pyramid keeps the unreduced data and at most max_pyramid_levels reduced levels
+    azint_data.set_reduction_factor(2 * factor)
+    azint_data.set_reduction_factor(8 * factor)
+    assert 1 in azint_data._pyramid
+    assert len(azint_data._pyramid) <= azint_data.max_pyramid_levels + 1
+    azint_data.set_reduction_factor(1)
+    np.testing.assert_array_equal(azint_data.I, I)
+    np.testing.assert_array_equal(azint_data.I0, I0)
+
+
+def test_smoothing(azint_data, demo):
+    _, I, _ = demo
+    assert azint_data.set_smoothing("savgol", frames=5, radial=7)
+    expected = smooth_stack(I, savgol_kernel(5), savgol_kernel(7))
+    np.testing.assert_allclose(azint_data.get_I(), expected, rtol=1e-6)
+    # radial-only smoothing of single frames without processing the full stack
+    assert azint_data.set_smoothing("gaussian", radial=2)
+    full = azint_data.get_I()
+    np.testing.assert_allclose(azint_data.get_I(index=5), full[5], rtol=1e-6)
+    assert not azint_data.set_smoothing("savgol", frames=3, order=3)
+    assert azint_data.set_smoothing(None)
+    np.testing.assert_array_equal(azint_data.get_I(), I)
+
+
+def test_incremental_smoothing(azint_data):
+    azint_data.set_smoothing("savgol", frames=7)
+    azint_data.get_I()
+    # changing a few frames (e.g. by despiking) only smooths their neighbourhood again
+    I = azint_data.I.copy()
+    I[[10, 60], 300] += 1e5
+    azint_data.I = I
+    azint_data.pipeline.invalidate()
+    incremental = azint_data.get_I()
+    azint_data._smooth_state = None
+    azint_data.pipeline.invalidate()
+    np.testing.assert_array_equal(incremental, azint_data.get_I())
+
+
+def test_despike(azint_data):
+    I = azint_data.I.copy()
+    I[42, 1000] += 1e5
+    azint_data.I = I
+    azint_data.set_despike(window=5, threshold=5.)
+    despiked = azint_data.get_I()
+    assert despiked[42, 1000] < 1e4
+    assert np.mean(despiked != I) < 0.01
+    azint_data.set_despike(False)
+    np.testing.assert_array_equal(azint_data.get_I(), I)
+
+
+def test_estimate_bgr_stack(azint_data, demo):
+    _, I, _ = demo
+    azint_data.set_despike(window=5, threshold=5.)
+    azint_data.set_smoothing("savgol", frames=5)
+    assert azint_data.estimate_bgr_stack("snip", iterations=20)
+    # estimated from the despiked data, upstream of the smoothing
+    despiked = despike_frames(I, window=5, threshold=5.)
+    np.testing.assert_allclose(azint_data.bgr_stack, estimate_background(despiked, "snip", iterations=20), rtol=1e-5)
+    assert azint_data.bgr_stack_params == {"method": "snip", "iterations": 20, "despike": azint_data.despike_params}
+    azint_data.set_use_bgr_stack(True)
+    expected = smooth_stack(despiked - azint_data.bgr_stack, savgol_kernel(5))
+    np.testing.assert_allclose(azint_data.get_I(), expected, rtol=1e-5, atol=1e-3)
+    # the derived products are keyed by the source state of the estimate
+    params = azint_data.get_processing_params()
+    azint_data.set_despike(False)
+    assert azint_data.estimate_bgr_stack("snip", iterations=20)
+    assert azint_data.get_processing_params()["bgr_stack"] != params["bgr_stack"]
+
+
+def test_detect_outlier_frames(azint_data, demo):
+    _, I, _ = demo
+    assert azint_data.detect_outlier_frames().all()
+    # scaled and zeroed frames on a smooth intensity ramp
+    ramp = np.linspace(1., 3., I.shape[0])[:, None] * I
+    azint_data.I = ramp
+    assert azint_data.detect_outlier_frames().all()
+    outliers = [20, 55, 80]
+    azint_data.I = ramp.copy()
+    azint_data.I[20] *= 0.2
+    azint_data.I[55] = 0.
+    azint_data.I[80] *= 3.
+    np.testing.assert_array_equal(np.flatnonzero(~azint_data.detect_outlier_frames(chunk_bytes=2**16)), outliers)
+    # a step in the data is not flagged
+    azint_data.I = I * np.where(np.arange(I.shape[0]) < 50, 1., 2.)[:, None]
+    assert azint_data.detect_outlier_frames().all()
+    # deviating I0 values are flagged
+    azint_data.I = I
+    I0 = np.ones(I.shape[0])
+    I0[outliers] = 0.01
+    azint_data.set_I0(I0)
+    np.testing.assert_array_equal(np.flatnonzero(~azint_data.detect_outlier_frames()), outliers)
+    assert azint_data.detect_outlier_frames(use_I0=False).all()
+
+
+@pytest.mark.parametrize("centered", [True, False])
+def test_find_similar_frames(azint_data, centered):
+    I = azint_data.I.astype(np.float64)
+    if centered:
+        S = np.corrcoef(I)
+    else:
+        norm = np.linalg.norm(I, axis=1)
+        S = (I @ I.T) / np.outer(norm, norm)
+    index, k = 30, 5
+    indices, similarities = azint_data.find_similar_frames(index, k, centered=centered)
+    expected = np.argsort(-np.where(np.arange(len(I)) == index, -np.inf, S[index]))[:k]
+    np.testing.assert_array_equal(indices, expected)
+    np.testing.assert_allclose(similarities, S[index, expected], atol=1e-5)
+    # masked frames are excluded
+    frame_mask = np.ones(len(I), dtype=bool)
+    frame_mask[expected[:2]] = False
+    azint_data.set_frame_mask(frame_mask)
+    indices, _ = azint_data.find_similar_frames(index, k, centered=centered)
+    assert not set(indices) & set(expected[:2])
+    np.testing.assert_array_equal(indices[:3], expected[2:])
+    # k larger than the number of candidates returns all valid frames but the frame itself
+    indices, similarities = azint_data.find_similar_frames(index, len(I) + 10, centered=centered)
+    assert len(indices) == len(I) - 3 and index not in indices
+    assert np.all(np.diff(similarities) <= 0)
+
+
+def test_frame_mask(azint_data):
+    frame_mask = np.ones(azint_data.shape[0], dtype=bool)
+    azint_data.set_frame_mask(frame_mask)
+    assert azint_data.frame_mask is None
+    azint_data.set_frame_mask(~frame_mask)
+    assert azint_data.frame_mask is None
+    azint_data.set_frame_mask(frame_mask[1:])
+    assert azint_data.frame_mask is None
+
+
+def test_correlation_matrix(azint_data):
+    I = azint_data.I.astype(np.float64)
+    im, factor = azint_data.get_correlation_matrix(max_size=1024)
+    assert factor == 1
+    np.testing.assert_allclose(im, np.corrcoef(I), atol=1e-5)
+    im, factor = azint_data.get_correlation_matrix(max_size=50)
+    assert factor == 2 and im.shape == (50, 50)
+    tile = azint_data.get_correlation_tile_func()(slice(10, 30), slice(60, 100))
+    np.testing.assert_allclose(tile, np.corrcoef(I)[10:30, 60:100], atol=1e-5)
+
+
+def test_decompose(processed):
+    assert processed.decompose("pca", n_components=3, seed=0)
+    assert processed.components.shape == (3, processed.shape[1])
+    assert processed.component_scores.shape == (processed.shape[0], 3)
+    assert np.isnan(processed.component_scores[~processed.frame_mask]).all()
+    assert np.isfinite(processed.component_scores[processed.frame_mask]).all()
+
+
+def test_cluster_frames(processed):
+    labels, means = processed.get_cluster_func(n_clusters=2, n_components=3)()
+    assert np.all(labels[~processed.frame_mask] == -1)
+    assert set(labels[processed.frame_mask]) == {0, 1}
+    I = processed.get_I()
+    for c in range(2):
+        np.testing.assert_allclose(means[c], I[labels == c].mean(axis=0), rtol=1e-5, atol=1e-6)
+
+
+def test_detect_change_points(processed):
+    signal = np.where(np.arange(processed.shape[0]) < 30, 1., 5.)
+    signal += np.random.default_rng(0).normal(0, 0.1, signal.shape)
+    signal[3] = 100.  # masked outlier
+    indices, _ = processed.detect_change_points(signal, n_change_points=1)
+    np.testing.assert_array_equal(indices, [30])
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Tests of the HDF5 content dialog in plaid.dialogs."""
+import pytest
+from PyQt6 import QtCore
+
+import plaid.dialogs
+from plaid.dialogs import H5Dialog, H5IndexWorker, _get_h5_index_key, _get_h5_index, _store_h5_index
+
+from conftest import DEMO_FILE
+
+
+def get_child(item, name):
+    """Get the child item of a tree item by name."""
+    return next(item.child(i) for i in range(item.childCount()) if item.child(i).text(0) == name)
+
+
+def test_lazy_population(qapp):
+    dialog = H5Dialog(file_path=DEMO_FILE)
+    root = dialog.file_tree.invisibleRootItem()
+    assert [root.child(i).text(0) for i in range(root.childCount())] == ["entry"]
+    entry = root.child(0)
+    # unexpanded groups show the expand indicator without loading their children
+    assert entry.childCount() == 0
+    assert entry.childIndicatorPolicy() == entry.ChildIndicatorPolicy.ShowIndicator
+    dialog.file_tree.expandItem(entry)
+    assert entry.data(0, QtCore.Qt.ItemDataRole.UserRole) is True
+    assert {"data", "instrument", "monitor", "sample"} <= {entry.child(i).text(0) for i in range(entry.childCount())}
+    data = get_child(entry, "data")
+    assert data.childCount() == 0
+    dialog.file_tree.expandItem(data)
+    intensity = get_child(data, "I")
+    assert intensity.text(1) == dialog._shape_to_str((100, 2000))
+    assert dialog._get_path(intensity) == "entry/data/I"
+    # expanding again does not duplicate the children
+    n = data.childCount()
+    dialog.file_tree.collapseItem(data)
+    dialog.file_tree.expandItem(data)
+    assert data.childCount() == n
+    # scalar datasets are not expandable
+    definition = get_child(entry, "definition")
+    assert definition.childCount() == 0 and definition.data(0, QtCore.Qt.ItemDataRole.UserRole) is None
+    if getattr(dialog, "_index_worker", None) is not None:
+        dialog._index_worker.wait()
+    dialog.close()
+
+
+@pytest.fixture
+def demo_index(qapp):
+    """The search index of the demo file, built synchronously."""
+    results = []
+    worker = H5IndexWorker(DEMO_FILE)
+    worker.sigFinished.connect(lambda success, result: results.append((success, result)))
+    worker.run()
+    success, index = results[0]
+    assert success
+    return index
+
+
+def test_index_contents(demo_index):
+    entries = {entry[0]: entry for entry in demo_index}
+    # only datasets are indexed
+    assert "entry/data" not in entries and "entry" not in entries
+    assert "entry/monitor/data" in entries and "entry/reduction/input/poni" in entries
+    path, shape, nx_class, long_name, text = entries["entry/data/I"]
+    assert (shape, nx_class, long_name) == ("100 \u00d7 2000", "NXdata", "intensity")
+    assert text == text.lower()
+    for term in ("entry/data/i", "nxdata", "intensity", "100 \u00d7 2000", "100x2000"):
+        assert term in text
+    assert entries["entry/instrument/source/name"][1:3] == ("", "NXsource")
+    assert _get_h5_index(_get_h5_index_key(DEMO_FILE)) is demo_index
+
+
+def search(dialog, text):
+    dialog.search(text)
+    tree = dialog.search_tree
+    return [tree.topLevelItem(i).text(0) for i in range(tree.topLevelItemCount())]
+
+
+def test_search(qapp, demo_index):
+    dialog = H5Dialog(file_path=DEMO_FILE)
+    assert dialog.search_index is demo_index
+    # all terms must match, case insensitive, in any field
+    assert search(dialog, "100x2000") == ["entry/data/I"]
+    assert search(dialog, "NXdata INTENSITY") == ["entry/data/I"]
+    assert search(dialog, "2theta 2000") == ["entry/data/radial_axis"]
+    assert set(search(dialog, "2theta")) == {"entry/data/radial_axis", "entry/data/radial_axis_edges"}
+    assert set(search(dialog, "nxdata 2000")) == {"entry/data/I", "entry/data/norm", "entry/data/radial_axis"}
+    assert search(dialog, "intensity nxmonitor") == []
+    assert set(search(dialog, "data 100")) >= {"entry/data/I", "entry/monitor/data"}
+    # the search results replace the file tree while searching
+    assert dialog.search_tree.isVisibleTo(dialog) and not dialog.file_tree.isVisibleTo(dialog)
+    assert search(dialog, "  ") == []
+    assert not dialog.search_tree.isVisibleTo(dialog) and dialog.file_tree.isVisibleTo(dialog)
+    assert len(search(dialog, "entry")) == len(demo_index)
+    dialog.search("entry", max_results=3)
+    assert dialog.search_tree.topLevelItemCount() == 3
+    dialog.close()
+
+
+def test_index_cache_bound(monkeypatch):
+    monkeypatch.setattr(plaid.dialogs, "_H5_INDEX_CACHE", {})
+    monkeypatch.setattr(plaid.dialogs, "_H5_INDEX_CACHE_SIZE", 2)
+    _store_h5_index(("a.h5", 1, 1), ["a"])
+    _store_h5_index(("b.h5", 1, 1), ["b"])
+    assert _get_h5_index(("a.h5", 1, 1)) == ["a"]
+    _store_h5_index(("c.h5", 1, 1), ["c"])
+    # the least recently used index is evicted
+    assert _get_h5_index(("b.h5", 1, 1)) is None
+    assert _get_h5_index(("a.h5", 1, 1)) == ["a"]
+    # a modified file replaces its outdated index
+    _store_h5_index(("a.h5", 2, 2), ["a2"])
+    assert _get_h5_index(("a.h5", 1, 1)) is None
+    assert list(plaid.dialogs._H5_INDEX_CACHE) == [("c.h5", 1, 1), ("a.h5", 2, 2)]
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Tests of the HDF5 helpers in plaid.io."""
+import os
+import shutil
+import numpy as np
+import h5py as h5
+import pytest
+
+from plaid.io import DerivedCache, export_nxazint1d
+from plaid.data_containers import AzintData
+
+from conftest import DEMO_FILE
+
+
+@pytest.fixture
+def demo_copy(tmp_path):
+    """A copy of the demo file in a temporary directory."""
+    fname = str(tmp_path / "scan.h5")
+    shutil.copy(DEMO_FILE, fname)
+    return fname
+
+
+def test_derived_cache(demo_copy, tmp_path):
+    cache = DerivedCache(demo_copy, sidecar=str(tmp_path / "cache.h5"))
+    data = np.arange(12.).reshape(3, 4)
+    assert cache.load("average", {"a": 1}) is None
+    assert cache.save("average", data, {"a": 1})
+    np.testing.assert_array_equal(cache.load("average", {"a": 1}), data)
+    assert cache.load("average", {"a": 2}) is None
+    # products of a modified source file are outdated
+    with h5.File(demo_copy, 'a') as f:
+        f['entry/extra'] = 1
+    assert DerivedCache(demo_copy, sidecar=cache.sidecar).load("average", {"a": 1}) is None
+
+
+def test_derived_cache_eviction(demo_copy, tmp_path, monkeypatch):
+    monkeypatch.setattr(DerivedCache, "max_groups", 3)
+    cache = DerivedCache(demo_copy, sidecar=str(tmp_path / "cache.h5"))
+    for i in range(5):
+        assert cache.save("average", np.full(4, i), {"i": i})
+        if i >= 2:
+            # keep the first group recently used
+            assert cache.load("average", {"i": 0}) is not None
+    with h5.File(cache.sidecar, 'r') as f:
+        assert len(f) == 3
+    assert cache.load("average", {"i": 1}) is None
+    assert cache.load("average", {"i": 2}) is None
+    np.testing.assert_array_equal(cache.load("average", {"i": 4}), np.full(4, 4))
+    monkeypatch.setattr(DerivedCache, "max_bytes", 16)
+    assert not cache.save("average", np.zeros(4), {"i": 5})
+
+
+def test_derived_cache_average(demo_copy, monkeypatch):
+    monkeypatch.setattr(DerivedCache, "next_to_data", True)
+    with h5.File(demo_copy, 'r') as f:
+        I = f['entry/data/I'][()]
+        x = f['entry/data/radial_axis'][()]
+    azint_data = AzintData(fnames=demo_copy)
+    azint_data.x, azint_data.I, azint_data.shape = x, I, I.shape
+    expected = azint_data.get_average_I()
+    sidecar = azint_data.get_derived_cache().sidecar
+    assert os.path.dirname(sidecar) == os.path.dirname(demo_copy)
+    # a new instance loads the average from the cache into its memo
+    azint_data = AzintData(fnames=demo_copy)
+    azint_data.x, azint_data.I, azint_data.shape = x, I, I.shape
+    monkeypatch.setattr(azint_data, "_compute_average_base", None)
+    np.testing.assert_allclose(azint_data.get_average_I(), expected, rtol=1e-6)
+    assert azint_data._average_memo[False][0] is I
+    np.testing.assert_allclose(azint_data.get_average_I(), expected, rtol=1e-6)
+
+
+def test_export_nxazint1d(tmp_path, demo):
+    x, I, I0 = demo
+    fname = str(tmp_path / "export.h5")
+    chunks = (I[i:i+32] for i in range(0, I.shape[0], 32))
+    assert export_nxazint1d(fname, x, chunks, I.shape[0], I0=I0, energy=35.) is True
+    with h5.File(fname, 'r') as f:
+        np.testing.assert_allclose(f['entry/data/I'][()], I)
+        np.testing.assert_allclose(f['entry/data/radial_axis'][()], x)
+
+
+def test_export_nxazint1d_interrupted(tmp_path, demo):
+    x, I, _ = demo
+    fname = str(tmp_path / "export.h5")
+    chunks = (I[i:i+32] for i in range(0, I.shape[0], 32))
+    assert export_nxazint1d(fname, x, chunks, I.shape[0], progress=lambda n: n < 64) is None
+    assert not os.path.exists(fname)
+
+    def failing_chunks():
+        yield I[:32]
+        raise RuntimeError("read error")
+    assert export_nxazint1d(fname, x, failing_chunks(), I.shape[0]) is False
+    assert not os.path.exists(fname)
+
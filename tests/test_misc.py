@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Tests of the array helpers in plaid.misc."""
+import numpy as np
+import pytest
+
+from plaid.misc import (average_blocks, average_blocks_error, despike_frames, savgol_kernel,
+                        gaussian_kernel, smooth_stack, get_frame_fingerprints, estimate_background,
+                        get_common_grid, regrid)
+
+
+def test_average_blocks():
+    arr = np.arange(21, dtype=float).reshape(7, 3)
+    np.testing.assert_array_equal(average_blocks(arr, 2), (arr[0:6:2] + arr[1:6:2]) / 2)
+    np.testing.assert_array_equal(average_blocks(arr, 1), arr)
+    errors = np.ones((6, 3))
+    np.testing.assert_allclose(average_blocks_error(errors, 3), np.full((2, 3), np.sqrt(3) / 3))
+
+
+def test_get_common_grid():
+    x1 = np.linspace(1., 10., 91)  # step 0.1
+    x2 = np.linspace(2.5, 12., 39)  # step 0.25
+    x = get_common_grid([x1, x2])
+    assert x[0] == 2.5 and np.isclose(x[-1], 10.)
+    np.testing.assert_allclose(np.diff(x), 0.1)
+    assert get_common_grid([x1, x1 + 20.]) is None
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_regrid_identity(rng, dtype):
+    x = np.sort(rng.random(50))
+    y = rng.random((7, 50)).astype(dtype)
+    np.testing.assert_array_equal(regrid(x, y, x), y)
+    np.testing.assert_array_equal(regrid(x, y, x, is_error=True), y)
+    assert regrid(x, y, x).dtype == dtype
+
+
+def test_regrid_linear(rng):
+    x = np.sort(rng.random(40)) * 10
+    x_new = np.linspace(x[0], x[-1], 123)
+    y = np.stack([2.*x + 1., -0.5*x + 3.])
+    np.testing.assert_allclose(regrid(x, y, x_new, chunk_size=1), np.stack([2.*x_new + 1., -0.5*x_new + 3.]),
+                               rtol=1e-12)
+    # a single pattern, with the target clipped to the end points
+    np.testing.assert_allclose(regrid(x, y[0], [x[0] - 1., x[-1] + 1.]), [y[0, 0], y[0, -1]], rtol=1e-12)
+
+
+def test_regrid_error(rng):
+    x = np.arange(10.)
+    e = rng.random((3, 10))
+    x_new = np.array([0., 2.25, 4.5, 8.9])
+    i = np.floor(x_new).astype(int)
+    w = x_new - i
+    # the interpolated value (1-w)*y[i] + w*y[i+1] has the error sqrt(((1-w)*e[i])**2 + (w*e[i+1])**2)
+    expected = np.sqrt(((1 - w) * e[:, i])**2 + (w * e[:, i + 1])**2)
+    np.testing.assert_allclose(regrid(x, e, x_new, is_error=True), expected, rtol=1e-12)
+
+
+def test_despike_low_counts(rng):
+    # sparse Poisson data has a MAD of zero in most bins
+    I = rng.poisson(0.3, size=(400, 300)).astype(np.float64)
+    despiked = despike_frames(I, window=5, threshold=5.)
+    assert np.mean(despiked != I) < 0.01
+    # the noise levels are independent of the chunks
+    np.testing.assert_array_equal(despike_frames(I, window=5, threshold=5., chunk_bytes=2**12), despiked)
+
+
+def test_despike_spikes(rng):
+    I = rng.poisson(100., size=(200, 50)).astype(np.float64)
+    spikes = (np.array([5, 80, 150, 199]), np.array([3, 20, 20, 49]))
+    I_spiked = I.copy()
+    I_spiked[spikes] += 1e4
+    despiked = despike_frames(I_spiked, window=5, threshold=5.)
+    assert np.all(despiked[spikes] < 200)
+    assert np.mean(despiked != I_spiked) < 0.01
+    assert despiked.dtype == I_spiked.dtype
+    assert despike_frames(I_spiked.astype(np.float32)).dtype == np.float32
+    assert despike_frames(I_spiked.astype(np.int32)).dtype == np.float64
+
+
+def test_despike_constant():
+    I = np.full((20, 10), 3.)
+    np.testing.assert_array_equal(despike_frames(I), I)
+
+
+@pytest.mark.parametrize("window, order", [(5, 2), (9, 3), (7, 0)])
+def test_savgol_kernel(window, order):
+    kernel = savgol_kernel(window, order)
+    assert kernel.shape == (window,)
+    # polynomials up to the order are preserved
+    t = np.arange(-(window // 2), window // 2 + 1)
+    for p in range(order + 1):
+        assert np.isclose(kernel @ t**p, float(p == 0))
+
+
+def test_kernel_errors():
+    with pytest.raises(ValueError):
+        savgol_kernel(3, 3)
+    with pytest.raises(ValueError):
+        gaussian_kernel(0)
+    assert np.isclose(gaussian_kernel(2.).sum(), 1.)
+
+
+def test_smooth_stack(rng):
+    I = rng.random((60, 40))
+    frame_kernel, radial_kernel = savgol_kernel(5), gaussian_kernel(1.5)
+    # reference: reflection padding and a direct convolution along each axis
+    h, r = len(frame_kernel) // 2, len(radial_kernel) // 2
+    padded = np.pad(I, [(h, h), (0, 0)], mode='reflect')
+    expected = np.stack([np.convolve(padded[:, j], frame_kernel[::-1], mode='valid') for j in range(I.shape[1])], axis=1)
+    padded = np.pad(expected, [(0, 0), (r, r)], mode='reflect')
+    expected = np.stack([np.convolve(row, radial_kernel[::-1], mode='valid') for row in padded])
+    np.testing.assert_allclose(smooth_stack(I, frame_kernel, radial_kernel), expected, rtol=1e-10)
+    # chunked and partial smoothing give the same frames
+    np.testing.assert_allclose(smooth_stack(I, frame_kernel, radial_kernel, chunk_bytes=1024), expected, rtol=1e-10)
+    np.testing.assert_allclose(smooth_stack(I, frame_kernel, radial_kernel, start=1, stop=17), expected[1:17],
+                               rtol=1e-10)
+    assert smooth_stack(I.astype(np.float32), frame_kernel).dtype == np.float32
+
+
+def test_get_frame_fingerprints(rng):
+    I = rng.random((30, 20))
+    fingerprints = get_frame_fingerprints(I)
+    np.testing.assert_allclose(get_frame_fingerprints(I, chunk_bytes=64), fingerprints, rtol=1e-12)
+    I[7, 3] += 1.
+    changed = get_frame_fingerprints(I) != fingerprints
+    np.testing.assert_array_equal(np.flatnonzero(changed), [7])
+
+
+@pytest.mark.parametrize("method, kwargs, rtol", [("snip", {"iterations": 30}, 0.01),
+                                                  ("rolling_min", {"window": 51}, 0.05),
+                                                  ("polynomial", {"order": 2}, 0.05)])
+def test_estimate_background(method, kwargs, rtol):
+    # narrow peaks on a smooth baseline, scaled differently in each frame
+    x = np.linspace(0, 1, 1000)
+    baseline = 200 + 100*x - 50*x**2
+    peaks = sum(a * np.exp(-0.5 * ((x - c) / 0.004)**2) for a, c in [(1000, .2), (500, .45), (800, .7)])
+    y = np.stack([baseline + peaks, 2*baseline + 0.5*peaks])
+    expected = np.stack([baseline, 2*baseline])
+    bgr = estimate_background(y, method, **kwargs)
+    assert bgr.shape == y.shape and bgr.dtype == y.dtype
+    np.testing.assert_allclose(bgr, expected, rtol=rtol)
+    assert np.all(bgr <= y * 1.001)
+    # single patterns and float32 data keep their shape and dtype
+    bgr = estimate_background(y[0].astype(np.float32), method, **kwargs)
+    assert bgr.shape == y[0].shape and bgr.dtype == np.float32
+    with pytest.raises(ValueError):
+        estimate_background(y, "unknown")